@@ -0,0 +1,157 @@
+'''
+Хранилище загруженных логотипов и подписей: файлы по хэшу содержимого на диске и индекс в памяти.
+Загрузка возвращает короткий ID, который можно передать в logo= / signature= вместо base64
+'''
+
+import base64
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+from fetch import ASSET_MAX_BYTES
+
+ASSET_DIR = os.environ.get('ASSET_DIR', os.path.join(tempfile.gettempdir(), 'generate-pdf-assets'))
+ASSET_STORE_MAX_BYTES = int(os.environ.get('ASSET_STORE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+ASSET_ID = re.compile(r'^ast_[0-9a-f]{32}$')
+UPLOAD_FORMAT = 'Upload must be an image, a data URI or {"data": "<data URI>"}'
+
+class AssetError(ValueError):
+    pass
+
+def is_asset_id(data: Optional[str]) -> bool:
+    return bool(data) and ASSET_ID.match(data) is not None
+
+def parse_upload(body: str, is_base64: bool) -> bytes:
+    if is_base64:
+        try:
+            raw = base64.b64decode(body)
+        except ValueError:
+            raise AssetError(UPLOAD_FORMAT)
+        # Шлюз кодирует в base64 любое тело, поэтому JSON и data URI распознаём уже после декодирования
+        if not raw.lstrip().startswith((b'{', b'data:image')):
+            return raw
+        body = raw.decode('utf-8', 'replace')
+    text = body.strip()
+    if text.startswith('{'):
+        try:
+            text = json.loads(text).get('data', '')
+        except (json.JSONDecodeError, AttributeError):
+            raise AssetError(UPLOAD_FORMAT)
+        if not isinstance(text, str):
+            raise AssetError(UPLOAD_FORMAT)
+    if text.startswith('data:image'):
+        text = text.split(',', 1)[1]
+    try:
+        return base64.b64decode(text, validate=True)
+    except ValueError:
+        raise AssetError(UPLOAD_FORMAT)
+
+def image_size(data: bytes) -> Tuple[int, int]:
+    from PIL import Image
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image.verify()
+            return image.size
+    except Exception:
+        raise AssetError('Upload is not a supported image')
+
+class AssetStore:
+    def __init__(self, root: str = ASSET_DIR, max_bytes: int = ASSET_STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._index: Optional[Dict[str, Tuple[str, int]]] = None
+        self._lock = threading.Lock()
+
+    def _path(self, asset_id: str) -> str:
+        digest = asset_id[4:]
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def _load(self) -> Dict[str, Tuple[str, int]]:
+        if self._index is None:
+            self._index = {}
+            if os.path.isdir(self.root):
+                for shard in os.scandir(self.root):
+                    if shard.is_dir():
+                        for entry in os.scandir(shard.path):
+                            if entry.is_file() and not entry.name.endswith('.tmp'):
+                                self._index[f'ast_{shard.name}{entry.name}'] = (entry.path, entry.stat().st_size)
+            self.size = sum(size for _, size in self._index.values())
+        return self._index
+
+    def _evict(self) -> None:
+        index = self._load()
+        if self.size <= self.max_bytes:
+            return
+        by_age = sorted(index.items(), key=lambda item: _mtime(item[1][0]))
+        for asset_id, (path, size) in by_age:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            del index[asset_id]
+            self.size -= size
+
+    def put(self, data: bytes) -> str:
+        if len(data) > ASSET_MAX_BYTES:
+            raise AssetError(f'Asset is larger than {ASSET_MAX_BYTES} bytes')
+        asset_id = 'ast_' + hashlib.sha256(data).hexdigest()[:32]
+        path = self._path(asset_id)
+        with self._lock:
+            index = self._load()
+            if asset_id in index and os.path.exists(path):
+                os.utime(path)
+                return asset_id
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+            index[asset_id] = (path, len(data))
+            self.size += len(data)
+            self._evict()
+        return asset_id
+
+    def get(self, asset_id: str) -> Optional[bytes]:
+        if not is_asset_id(asset_id):
+            return None
+        with self._lock:
+            entry = self._load().get(asset_id)
+        path = entry[0] if entry else self._path(asset_id)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if entry is None:
+            with self._lock:
+                self._load()[asset_id] = (path, len(data))
+                self.size += len(data)
+        return data
+
+    def __contains__(self, asset_id: str) -> bool:
+        if not is_asset_id(asset_id):
+            return False
+        with self._lock:
+            if asset_id in self._load():
+                return True
+        return os.path.exists(self._path(asset_id))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'items': len(self._load()), 'bytes': self.size, 'maxBytes': self.max_bytes}
+
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0.0
+
+asset_store = AssetStore()
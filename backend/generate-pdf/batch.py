@@ -0,0 +1,157 @@
+'''
+Пакетная генерация: много клиентов в одном POST, рендер на пуле процессов или потоков, ответ ZIP-архивом
+'''
+
+import atexit
+import json
+import multiprocessing
+import os
+import threading
+import traceback
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+from clock import now, use_clock
+from compression import get_profile
+from fonts import freeze_fonts
+
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', str(os.cpu_count() or 1)))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '1000'))
+BATCH_MODE = os.environ.get('BATCH_MODE', 'processes')
+
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+_pool = None
+_threads: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+class BatchError(ValueError):
+    pass
+
+def parse_batch(body: str, params: Dict[str, str],
+                limit: int = BATCH_MAX_ITEMS) -> Tuple[str, Optional[str], Optional[str], List[Any]]:
+    doc_type = params.get('type', 'loan')
+    logo = params.get('logo')
+    signature = params.get('signature')
+
+    text = body.strip()
+    if not text:
+        raise BatchError('Empty batch')
+
+    try:
+        payload = json.loads(text)
+    except json.JSONDecodeError:
+        payload = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    if isinstance(payload, dict) and 'clients' in payload:
+        doc_type = payload.get('type', doc_type)
+        logo = payload.get('logo', logo)
+        signature = payload.get('signature', signature)
+        records = payload['clients']
+    elif isinstance(payload, dict):
+        records = [payload]
+    else:
+        records = payload
+
+    if not isinstance(records, list):
+        raise BatchError('Batch must be a list of client records')
+    if len(records) > limit:
+        raise BatchError(f'Batch is limited to {limit} records')
+    return doc_type, logo, signature, records
+
+def _init_worker():
+    import index
+    index.warm_up()
+
+def render_item(task: Tuple[int, str, Optional[str], Optional[str], Any, Optional[str], bool, datetime, Optional[str]]) -> Tuple[int, Optional[bytes], Optional[str]]:
+    position, doc_type, logo, signature, record, profile, deterministic, moment, engine = task
+    try:
+        import index
+        if not isinstance(record, dict):
+            raise BatchError('Client record must be an object')
+        client_data = index.client_data_from(record)
+        with use_clock(moment):
+            return position, index.render_documents(doc_type, logo, signature, client_data, profile, deterministic, engine), None
+    except Exception as e:
+        return position, None, f'{type(e).__name__}: {e}'
+
+def get_pool():
+    global _pool
+    if _pool is None and BATCH_WORKERS > 1:
+        with _pool_lock:
+            if _pool is None:
+                try:
+                    _pool = multiprocessing.get_context('fork').Pool(BATCH_WORKERS, initializer=_init_worker)
+                    atexit.register(shutdown_pool)
+                except (OSError, ValueError):
+                    traceback.print_exc()
+    return _pool
+
+def get_threads() -> Optional[ThreadPoolExecutor]:
+    global _threads
+    if _threads is None and BATCH_WORKERS > 1:
+        with _pool_lock:
+            if _threads is None:
+                # Потоки делят реестр шрифтов и кэши процесса: всё прогревается и замораживается до первого рендера
+                _init_worker()
+                freeze_fonts()
+                _threads = ThreadPoolExecutor(BATCH_WORKERS, thread_name_prefix='pdf-batch')
+                atexit.register(shutdown_pool)
+    return _threads
+
+def shutdown_pool():
+    global _pool, _threads
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+            _pool = None
+        if _threads is not None:
+            _threads.shutdown()
+            _threads = None
+
+def zip_entry(name: str, deterministic: bool):
+    if not deterministic:
+        return name
+    info = zipfile.ZipInfo(name, date_time=ZIP_EPOCH)
+    info.external_attr = 0o644 << 16
+    return info
+
+def render_batch(doc_type: str, logo: Optional[str], signature: Optional[str], records: List[Any],
+                 filename: str, profile: Optional[str] = None,
+                 deterministic: bool = False, engine: Optional[str] = None,
+                 mode: Optional[str] = None) -> Tuple[bytes, List[Dict[str, Any]]]:
+    moment = now()
+    tasks = [(position, doc_type, logo, signature, record, profile, deterministic, moment, engine)
+             for position, record in enumerate(records, 1)]
+    if (mode or BATCH_MODE) == 'threads':
+        threads = get_threads() if len(tasks) > 1 else None
+        results = threads.map(render_item, tasks) if threads else map(render_item, tasks)
+    else:
+        pool = get_pool() if len(tasks) > 1 else None
+        if pool:
+            # Порядок записей в архиве входит в его байты, поэтому детерминированный режим ждёт результаты по порядку
+            imap = pool.imap if deterministic else pool.imap_unordered
+            results = imap(render_item, tasks, chunksize=max(1, len(tasks) // (BATCH_WORKERS * 4)))
+        else:
+            results = map(render_item, tasks)
+
+    manifest: List[Dict[str, Any]] = []
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for position, pdf_content, error in results:
+            record = records[position - 1]
+            entry = {'index': position, 'fullName': record.get('fullName', '') if isinstance(record, dict) else ''}
+            if error:
+                entry['error'] = error
+            else:
+                entry['file'] = f'{position:04d}-{filename}'
+                entry['size'] = len(pdf_content)
+                zf.writestr(zip_entry(entry['file'], deterministic), pdf_content)
+            manifest.append(entry)
+        manifest.sort(key=lambda entry: entry['index'])
+        zf.writestr(zip_entry('manifest.json', deterministic), json.dumps({'type': doc_type, 'profile': get_profile(profile).name, 'items': manifest},
+                                                ensure_ascii=False, indent=2))
+    return archive.getvalue(), manifest
@@ -0,0 +1,906 @@
+'''
+Бенчмарки генератора PDF, запускаются вручную: python bench.py [suite|skeletons|batch|output|coldstart|profiles|server|determinism|jobs|templates|replay|soak|engines|threads|loans|subsetting]
+Набор suite пишет результаты в JSON и сверяет их с порогами из bench-thresholds.json
+'''
+
+import base64
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+from typing import Callable, Dict, List
+from reportlab.pdfgen import canvas
+
+os.environ.setdefault('PDF_TIMING_LOG', '0')
+import index
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+THRESHOLDS_FILE = os.path.join(HERE, 'bench-thresholds.json')
+
+CLIENT = {
+    'fullName': 'Иванов Иван Иванович',
+    'birthDate': '1990-01-02',
+    'passportSeries': '4510',
+    'passportNumber': '123456',
+    'amount': '15000',
+    'term': '30',
+    'phone': '+7 (999) 123-45-67',
+    'email': 'ivanov@example.ru'
+}
+
+LONG_CLIENT = dict(
+    CLIENT,
+    fullName='Константинопольская-Преображенская Александра-Мария Владиславовна ' * 3,
+    phone='+7 (999) 123-45-67 доб. 1234567890, +7 (999) 765-43-21 доб. 0987654321',
+    email='aleksandra.konstantinopolskaya-preobrazhenskaya.work.mailbox@example-corporation.ru'
+)
+
+RENDERERS = {
+    'loan': index.create_loan_agreement,
+    'consent': index.create_consent_form,
+    'refund': index.create_refund_policy,
+}
+
+def measure_draw(render: Callable[[], bytes], rounds: int) -> List[float]:
+    marks: List[float] = []
+    original_save = canvas.Canvas.getpdfdata
+
+    def timed_save(c):
+        marks.append(time.perf_counter())
+        return original_save(c)
+
+    samples = []
+    canvas.Canvas.getpdfdata = timed_save
+    try:
+        for _ in range(rounds):
+            marks.clear()
+            start = time.perf_counter()
+            render()
+            samples.append(marks[0] - start)
+    finally:
+        canvas.Canvas.getpdfdata = original_save
+    return samples
+
+def bench_skeletons(rounds: int = 200) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for doc_type, create in RENDERERS.items():
+        row = {}
+        for enabled in (False, True):
+            index.SKELETONS_ENABLED = enabled
+            create(None, None, CLIENT)
+            samples = measure_draw(lambda: create(None, None, CLIENT), rounds)
+            row['skeleton' if enabled else 'direct'] = statistics.median(samples) * 1000
+        results[doc_type] = row
+        print(f"{doc_type:8} draw direct {row['direct']:.3f} ms  skeleton {row['skeleton']:.3f} ms  "
+              f"(-{(1 - row['skeleton'] / row['direct']) * 100:.0f}%)")
+    index.SKELETONS_ENABLED = True
+    return results
+
+def bench_batch(items: int = 200) -> Dict[int, float]:
+    import batch
+    records = [dict(CLIENT, fullName=f'Клиент {i}') for i in range(items)]
+    results = {}
+    workers = 1
+    while workers <= max(os.cpu_count() or 1, 1):
+        batch.shutdown_pool()
+        batch.BATCH_WORKERS = workers
+        batch.render_batch('loan', None, None, records[:workers * 2], 'warmup.pdf')
+        start = time.perf_counter()
+        batch.render_batch('loan', None, None, records, 'dogovor-zajma.pdf')
+        results[workers] = items / (time.perf_counter() - start)
+        print(f"batch    workers {workers:3}  {results[workers]:8.1f} docs/s  "
+              f"(x{results[workers] / results[1]:.2f})")
+        workers *= 2
+    batch.shutdown_pool()
+    return results
+
+def photo_data_uri(width: int = 1600, height: int = 1200) -> str:
+    from PIL import Image
+    image = Image.effect_noise((width, height), 64).convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, 'PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def _draw(c, doc_type, logo, signature):
+    font_name = index.get_font_name()
+    pages = index.registry.pages(doc_type)
+    skeleton = index.prepare_skeleton(c, pages, font_name)
+    for position, template in enumerate(pages):
+        if position:
+            c.showPage()
+        index.draw_document(c, template, logo, signature, CLIENT, font_name, skeleton)
+
+def _legacy_output(doc_type, logo, signature) -> str:
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=index.A4)
+    _draw(c, doc_type, logo, signature)
+    tracemalloc.reset_peak()
+    c.save()
+    buffer.seek(0)
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+def _streaming_output(doc_type, logo, signature) -> str:
+    from output import encode_base64
+    c = canvas.Canvas(None, pagesize=index.A4)
+    _draw(c, doc_type, logo, signature)
+    tracemalloc.reset_peak()
+    return encode_base64(c.getpdfdata())
+
+def bench_output() -> Dict[str, Dict[str, float]]:
+    photo = photo_data_uri()
+    results = {}
+    for label in ('loan', 'bundle'):
+        for mode, render in (('legacy', _legacy_output), ('streaming', _streaming_output)):
+            render(label, photo, photo)
+            tracemalloc.start()
+            body = render(label, photo, photo)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[f'{label}.{mode}'] = {'peakMB': peak / 2**20, 'bodyMB': len(body) / 2**20}
+            print(f"output   {label:7} {mode:10} serialize+encode peak {peak / 2**20:7.2f} MB  body {len(body) / 2**20:6.2f} MB")
+    return results
+
+def bench_profiles(rounds: int = 20) -> Dict[str, Dict[str, float]]:
+    from compression import PROFILES, embedded_font_sizes
+    from fonts import _candidates
+    font_paths = [path for _, path in _candidates() if os.path.exists(path)]
+    font_size = os.path.getsize(font_paths[0]) if font_paths else 0
+    photo = photo_data_uri(600, 300)
+    results = {}
+    for label, logo in (('plain', None), ('images', photo)):
+        for profile in PROFILES:
+            index.create_client_package(logo, logo, CLIENT, profile)
+            samples = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                pdf = index.create_client_package(logo, logo, CLIENT, profile)
+                samples.append((time.perf_counter() - start) * 1000)
+            fonts = embedded_font_sizes(pdf)
+            subset = bool(fonts) and all(size < font_size / 4 for size in fonts)
+            results[f'{label}.{profile}'] = row = {'p50Ms': statistics.median(samples), 'sizeKB': len(pdf) / 1024,
+                                                   'fontKB': sum(fonts) / 1024, 'subset': subset}
+            print(f"profile  {label:6} {profile:8} p50 {row['p50Ms']:7.2f} ms  size {row['sizeKB']:7.1f} KB  "
+                  f"fonts {row['fontKB']:6.1f} KB of {font_size / 1024:.0f} KB  subset {'ok' if subset else 'FAILED'}")
+    return results
+
+def start_server(workers: int, concurrency: int = 2, max_queue: int = 64):
+    import subprocess
+    env = dict(os.environ, PDF_TIMING_LOG='0')
+    process = subprocess.Popen([sys.executable, 'server.py', '--host', '127.0.0.1', '--port', '0',
+                                '--workers', str(workers), '--concurrency', str(concurrency), '--max-queue', str(max_queue)],
+                               cwd=HERE, env=env, stdout=subprocess.PIPE, text=True)
+    banner = process.stdout.readline()
+    return process, int(banner.split(':')[-1].split()[0])
+
+def load_test(port: int, clients: int, duration: float, path: str = '/?type=loan') -> Dict[str, float]:
+    import http.client
+    import threading
+    from urllib.parse import quote
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(number: int):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        sequence = 0
+        while time.perf_counter() < deadline:
+            sequence += 1
+            start = time.perf_counter()
+            try:
+                conn.request('GET', f"{path}&fullName={quote(f'Клиент {number}-{sequence}')}")
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                status = 0
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(elapsed)
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'rps': len(latencies) / elapsed,
+        'p50Ms': percentile(latencies, 50) if latencies else 0.0,
+        'p95Ms': percentile(latencies, 95) if latencies else 0.0,
+        'ok': len(latencies),
+        'rejected': statuses.get(503, 0),
+        'errors': sum(count for status, count in statuses.items() if status not in (200, 503))
+    }
+
+def bench_server(duration: float = 5.0, clients: int = 16) -> Dict[int, Dict[str, float]]:
+    import signal
+    results = {}
+    workers = 1
+    while workers <= max(4, os.cpu_count() or 1):
+        process, port = start_server(workers)
+        try:
+            load_test(port, 2, 1.0)
+            results[workers] = row = load_test(port, clients, duration)
+        finally:
+            process.send_signal(signal.SIGTERM)
+            exit_code = process.wait(timeout=60)
+        print(f"server   workers {workers:3}  {row['rps']:7.1f} req/s  p50 {row['p50Ms']:7.1f} ms  p95 {row['p95Ms']:7.1f} ms  "
+              f"ok {row['ok']:5}  503 {row['rejected']:4}  errors {row['errors']:3}  exit {exit_code}")
+        workers *= 2
+    return results
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    stages = {}
+    for entry in header.split(','):
+        name, _, duration = entry.strip().partition(';dur=')
+        if duration:
+            stages[name] = float(duration)
+    return stages
+
+def suite_scenarios() -> Dict[str, Dict[str, str]]:
+    logo = photo_data_uri(600, 300)
+    signature = photo_data_uri(400, 150)
+    scenarios = {}
+    for doc_type in list(RENDERERS) + ['bundle']:
+        for images in ('plain', 'images'):
+            for fields, client in (('short', CLIENT), ('long', LONG_CLIENT)):
+                params = dict(client, type=doc_type)
+                if images == 'images':
+                    params.update(logo=logo, signature=signature)
+                scenarios[f'{doc_type}/{images}/{fields}'] = params
+    return scenarios
+
+COLD_START_SCRIPT = '''
+import json, resource, sys, time
+def peak_rss_mb():
+    # ru_maxrss наследует пик родителя через fork, VmHWM считает только память этого интерпретатора
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+start = time.perf_counter()
+import index
+imported = time.perf_counter()
+index.warm_up()
+warmed = time.perf_counter()
+response = index.handler({'httpMethod': 'GET', 'queryStringParameters': {'type': sys.argv[1]}}, None)
+done = time.perf_counter()
+print(json.dumps({
+    'importMs': (imported - start) * 1000,
+    'warmUpMs': (warmed - imported) * 1000,
+    'firstRequestMs': (done - warmed) * 1000,
+    'totalMs': (done - start) * 1000,
+    'status': response['statusCode'],
+    'peakRssMB': peak_rss_mb()
+}))
+'''
+
+DETERMINISM_SCRIPT = '''
+import base64, hashlib, json, sys
+import index
+params = json.load(sys.stdin)
+response = index.handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+print(hashlib.sha256(base64.b64decode(response['body'])).hexdigest())
+'''
+
+COLD_START_METRICS = ('importMs', 'warmUpMs', 'firstRequestMs', 'totalMs', 'peakRssMB')
+
+def cold_env() -> Dict[str, str]:
+    return dict(os.environ, PDF_WARM_ON_IMPORT='0', PDF_TIMING_LOG='0')
+
+def measure_cold_start(doc_type: str, runs: int = 3) -> Dict[str, float]:
+    import json
+    import subprocess
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT, doc_type], cwd=HERE, env=cold_env(),
+                                capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {key: statistics.median(sample[key] for sample in samples) for key in COLD_START_METRICS}
+
+def import_profile(top: int = 15) -> List[Dict[str, float]]:
+    import subprocess
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import index'], cwd=HERE, env=cold_env(),
+                            capture_output=True, text=True, check=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append({'module': name.strip(), 'selfMs': int(self_us) / 1000, 'cumulativeMs': int(cumulative_us) / 1000})
+    modules.sort(key=lambda m: m['cumulativeMs'], reverse=True)
+    return modules[:top]
+
+def bench_coldstart(output: str = 'bench-coldstart.json') -> Dict:
+    import json
+    results = {'profile': import_profile(), 'coldStart': {}}
+    for row in results['profile']:
+        print(f"import   {row['module']:40} self {row['selfMs']:7.1f} ms  cumulative {row['cumulativeMs']:7.1f} ms")
+    for doc_type in list(RENDERERS) + ['bundle']:
+        results['coldStart'][doc_type] = row = measure_cold_start(doc_type)
+        print(f"cold     {doc_type:8} import {row['importMs']:6.1f}  warm-up {row['warmUpMs']:6.1f}  "
+              f"first request {row['firstRequestMs']:6.1f}  total {row['totalMs']:6.1f} ms  rss {row['peakRssMB']:5.1f} MB")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"results written to {output}")
+    return results
+
+def check_thresholds(results: Dict, thresholds: Dict) -> List[str]:
+    from fnmatch import fnmatch
+    regressions = []
+    for name, row in results['scenarios'].items():
+        limits = dict(thresholds.get('default', {}))
+        for pattern, overrides in thresholds.get('scenarios', {}).items():
+            if fnmatch(name, pattern):
+                limits.update(overrides)
+        for metric, limit in limits.items():
+            if metric in row and row[metric] > limit:
+                regressions.append(f'{name}: {metric} {row[metric]:.1f} > {limit}')
+    for doc_type, row in results['coldStart'].items():
+        for metric, limit in thresholds.get('coldStart', {}).items():
+            if metric in row and row[metric] > limit:
+                regressions.append(f'cold {doc_type}: {metric} {row[metric]:.1f} > {limit}')
+    for metric, limit in thresholds.get('process', {}).items():
+        if results['process'].get(metric, 0) > limit:
+            regressions.append(f'process: {metric} {results["process"][metric]:.1f} > {limit}')
+    return regressions
+
+def bench_suite(rounds: int = 30, output: str = 'bench-results.json', thresholds: str = THRESHOLDS_FILE) -> Dict:
+    import json
+    import platform
+    import resource
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'rounds': rounds,
+        'scenarios': {},
+        'coldStart': {},
+    }
+
+    for doc_type in list(RENDERERS) + ['bundle']:
+        results['coldStart'][doc_type] = row = measure_cold_start(doc_type)
+        print(f"cold     {doc_type:8} import {row['importMs']:6.1f}  warm-up {row['warmUpMs']:6.1f}  "
+              f"first request {row['firstRequestMs']:6.1f}  total {row['totalMs']:6.1f} ms  rss {row['peakRssMB']:5.1f} MB")
+
+    for name, params in suite_scenarios().items():
+        event = {'httpMethod': 'GET', 'queryStringParameters': params}
+        index.handler(event, None)
+        samples = []
+        stages: Dict[str, List[float]] = {}
+        size = 0
+        started = time.perf_counter()
+        for _ in range(rounds):
+            index.pdf_cache.clear()
+            start = time.perf_counter()
+            response = index.handler(event, None)
+            samples.append((time.perf_counter() - start) * 1000)
+            size = len(base64.b64decode(response['body']))
+            for stage_name, ms in parse_server_timing(response['headers'].get('Server-Timing', '')).items():
+                stages.setdefault(stage_name, []).append(ms)
+        elapsed = time.perf_counter() - started
+        row = results['scenarios'][name] = {
+            'p50Ms': percentile(samples, 50),
+            'p95Ms': percentile(samples, 95),
+            'p99Ms': percentile(samples, 99),
+            'meanMs': statistics.mean(samples),
+            'throughputRps': rounds / elapsed,
+            'sizeKB': size / 1024,
+            'stagesMs': {stage_name: statistics.median(values) for stage_name, values in stages.items()}
+        }
+        print(f"warm     {name:24} p50 {row['p50Ms']:7.2f}  p95 {row['p95Ms']:7.2f}  p99 {row['p99Ms']:7.2f} ms  "
+              f"{row['throughputRps']:6.1f} rps  {row['sizeKB']:7.1f} KB")
+
+    results['process'] = {'peakRssMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+    if thresholds and os.path.exists(thresholds):
+        with open(thresholds, encoding='utf-8') as f:
+            results['regressions'] = check_thresholds(results, json.load(f))
+    else:
+        results['regressions'] = []
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"results written to {output}")
+    for regression in results['regressions']:
+        print(f"REGRESSION {regression}")
+    return results
+
+def bench_determinism() -> Dict[str, List[str]]:
+    import hashlib
+    import json
+    import subprocess
+    from batch import render_batch
+    from clock import parse_date, use_clock
+
+    def digest(params: Dict[str, str]) -> str:
+        response = index.handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+        return hashlib.sha256(base64.b64decode(response['body'])).hexdigest()
+
+    failures = []
+    for name, params in suite_scenarios().items():
+        params = dict(params, deterministic='1', date='2024-03-01')
+        first = digest(params)
+        index.pdf_cache.clear()
+        again = digest(params)
+        other = digest(dict(params, date='2024-03-02'))
+        fresh = subprocess.run([sys.executable, '-c', DETERMINISM_SCRIPT], input=json.dumps(params), cwd=HERE,
+                               env=cold_env(), capture_output=True, text=True, check=True).stdout.strip()
+        ok = first == again == fresh and first != other
+        if not ok:
+            failures.append(name)
+        print(f"determinism {name:28} {first[:16]}  {'ok' if ok else 'FAILED'}")
+
+    with use_clock(parse_date('2024-03-01')):
+        archives = [render_batch('loan', None, None, [CLIENT, LONG_CLIENT], 'dogovor-zajma.pdf', None, True)[0]
+                    for _ in range(2)]
+    ok = archives[0] == archives[1]
+    if not ok:
+        failures.append('batch')
+    print(f"determinism {'batch':28} {hashlib.sha256(archives[0]).hexdigest()[:16]}  {'ok' if ok else 'FAILED'}")
+    return {'failures': failures}
+
+def bench_jobs(jobs: int = 100) -> Dict[str, float]:
+    import json
+    from jobs import job_queue
+
+    def call(params: Dict[str, str]) -> Dict:
+        return index.handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+
+    submit_ms, ids, depth = [], [], 0
+    start = time.perf_counter()
+    for position in range(jobs):
+        started = time.perf_counter()
+        response = call({'type': 'bundle', 'async': '1', **dict(CLIENT, fullName=f'Клиент {position}')})
+        submit_ms.append((time.perf_counter() - started) * 1000)
+        ids.append(json.loads(response['body'])['id'])
+        depth = max(depth, job_queue.queued)
+
+    pending = set(ids)
+    while pending:
+        for job_id in list(pending):
+            if json.loads(call({'job': job_id})['body'])['status'] in ('done', 'failed'):
+                pending.discard(job_id)
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    sizes = [len(base64.b64decode(call({'job': job_id, 'download': '1'})['body'])) for job_id in ids]
+    stats = job_queue.stats()
+    result = {'submitP50Ms': statistics.median(submit_ms), 'submitP95Ms': percentile(submit_ms, 95),
+              'jobsPerSec': jobs / elapsed, 'peakQueueDepth': depth, 'failed': stats['failed'],
+              'avgSizeKB': statistics.mean(sizes) / 1024}
+    print(f"jobs     {jobs} bundles  submit p50 {result['submitP50Ms']:6.2f} p95 {result['submitP95Ms']:6.2f} ms  "
+          f"{result['jobsPerSec']:6.1f} jobs/s  peak queue {depth}  failed {stats['failed']}  "
+          f"store {stats['store']['bytes'] / 1024:.0f} KB")
+    return result
+
+def bench_templates(lookups: int = 100000) -> Dict[str, float]:
+    from templates import load_template, registry
+    registry.refresh(force=True)
+    start = time.perf_counter()
+    for _ in range(lookups):
+        registry.get('loan')
+    lookup_us = (time.perf_counter() - start) / lookups * 1e6
+    compile_ms = {}
+    for name in registry.names():
+        start = time.perf_counter()
+        load_template(name, os.path.join(registry.root, f'{name}.json'))
+        compile_ms[name] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    registry.refresh(force=True)
+    rescan_ms = (time.perf_counter() - start) * 1000
+    print(f"templates lookup {lookup_us:.3f} us  unchanged rescan {rescan_ms:.3f} ms  compile " +
+          '  '.join(f'{name} {ms:.2f} ms' for name, ms in compile_ms.items()))
+    return {'lookupUs': lookup_us, 'rescanMs': rescan_ms, **{f'compile.{name}': ms for name, ms in compile_ms.items()}}
+
+def bench_replay(requests: int = 600, concurrency: int = 4) -> Dict[int, Dict]:
+    import replay
+    traffic = replay.synthetic_requests(requests, 'loan=5,consent=3,refund=2,bundle=1')
+    results = {}
+    for processes in (1, 2, 4):
+        index.pdf_cache.clear()
+        summary = replay.summarize(*replay.replay(traffic, concurrency, processes))
+        results[processes] = summary
+        replay.print_summary(summary, concurrency, processes)
+    return results
+
+def extract_text(pdf: bytes) -> List[str]:
+    from pypdf import PdfReader
+    return [page.extract_text() for page in PdfReader(BytesIO(pdf)).pages]
+
+def bench_engines(rounds: int = 30) -> Dict:
+    try:
+        import pypdf  # noqa: F401
+        compare = True
+    except ImportError:
+        compare = False
+        print('engines  pypdf is not installed, text comparison skipped')
+    results, failures = {}, []
+    for name, params in suite_scenarios().items():
+        client = index.client_data_from(params)
+        args = (params['type'], params.get('logo'), params.get('signature'), client)
+        row = {}
+        for engine in index.ENGINES:
+            index.render_documents(*args, engine=engine)
+            samples = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                pdf = index.render_documents(*args, engine=engine)
+                samples.append((time.perf_counter() - start) * 1000)
+            row[engine] = {'p50Ms': statistics.median(samples), 'sizeKB': len(pdf) / 1024, 'pdf': pdf}
+        texts = {engine: extract_text(row[engine].pop('pdf')) for engine in index.ENGINES} if compare else {}
+        same = all(text == texts['reportlab'] for text in texts.values()) if compare else None
+        if same is False:
+            failures.append(name)
+        results[name] = row
+        base = row['reportlab']['p50Ms']
+        timings = '  '.join(f"{engine} {row[engine]['p50Ms']:6.2f} ms x{base / row[engine]['p50Ms']:5.1f}"
+                            for engine in index.ENGINES[1:])
+        sizes = ' / '.join(f"{row[engine]['sizeKB']:6.1f}" for engine in index.ENGINES)
+        print(f"engines  {name:24} reportlab {base:6.2f} ms  {timings}  size {sizes} KB  "
+              f"text {'-' if same is None else 'same' if same else 'DIFFERENT'}")
+    return {'scenarios': results, 'failures': failures}
+
+def scalar_totals(records: List[Dict[str, str]], rate: float, moment) -> List[tuple]:
+    from datetime import timedelta
+    rows = []
+    for record in records:
+        amount, term = float(record['amount']), int(record['term'])
+        interest = amount * term * rate
+        rows.append((interest, amount + interest, (moment + timedelta(days=term)).date()))
+    return rows
+
+def scalar_schedule(amount: float, term: int, rate: float) -> List[tuple]:
+    return [(day, amount * rate, amount * day * rate, amount + amount * day * rate) for day in range(1, term + 1)]
+
+def bench_loans(loans: int = 100000, schedules: int = 2000) -> Dict:
+    import random
+    from datetime import datetime
+    import loans as portfolio_math
+    from clock import use_clock
+    from templates import build_context, registry
+    
+    rng = random.Random(25)
+    records = [{'amount': str(rng.randrange(1000, 500000) + rng.randrange(100) / 100), 'term': str(rng.randrange(1, 366))}
+               for _ in range(loans)]
+    moment = datetime(2024, 3, 1, 12)
+    rate = registry.get('loan').daily_rate
+    failures = []
+    
+    start = time.perf_counter()
+    expected = scalar_totals(records, rate, moment)
+    scalar_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    portfolio = portfolio_math.parse_portfolio(records, rate)
+    parse_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    totals = portfolio_math.loan_totals(portfolio, moment)
+    vector_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    report = portfolio_math.portfolio_report(records, rate, moment)
+    report_ms = (time.perf_counter() - start) * 1000
+    
+    due = totals.due.astype(object).tolist()
+    same = all(interest == totals.interest[position] and total == totals.total[position] and day == due[position]
+               for position, (interest, total, day) in enumerate(expected))
+    with use_clock(moment):
+        contexts = [build_context(registry.get('loan'), record, None) for record in records[:1000]]
+    same_text = all(item['interestAmount'] == context['interestAmount'] and item['totalAmount'] == context['totalAmount']
+                    and item['returnDate'] == context['returnDate']
+                    for item, context in zip(report['items'], contexts))
+    if not (same and same_text):
+        failures.append('totals')
+    print(f"loans    totals {loans} loans  python {scalar_ms:8.1f} ms  numpy {vector_ms:8.2f} ms x{scalar_ms / vector_ms:6.1f}  "
+          f"parse {parse_ms:7.1f} ms  report {report_ms:7.1f} ms  {'same' if same and same_text else 'DIFFERENT'}")
+    
+    subset = portfolio_math.parse_portfolio(records[:schedules], rate)
+    start = time.perf_counter()
+    expected = [scalar_schedule(float(record['amount']), int(record['term']), rate) for record in records[:schedules]]
+    scalar_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    schedule = portfolio_math.build_schedules(subset, portfolio_math.loan_totals(subset, moment), moment)
+    vector_ms = (time.perf_counter() - start) * 1000
+    rows = list(zip(schedule.day.tolist(), schedule.accrued.tolist(), schedule.interest.tolist(), schedule.due.tolist()))
+    same = rows == [row for loan in expected for row in loan]
+    if not same:
+        failures.append('schedules')
+    print(f"loans    schedules {schedules} loans {len(rows)} days  python {scalar_ms:8.1f} ms  numpy {vector_ms:8.2f} ms "
+          f"x{scalar_ms / vector_ms:6.1f}  {'same' if same else 'DIFFERENT'}")
+    
+    for term in ('30', '365'):
+        client = dict(CLIENT, term=term)
+        row = []
+        for engine in index.ENGINES:
+            index.create_loan_agreement(client_data=client, engine=engine)
+            samples = []
+            for _ in range(10):
+                start = time.perf_counter()
+                pdf = index.create_loan_agreement(client_data=client, engine=engine)
+                samples.append((time.perf_counter() - start) * 1000)
+            row.append(f'{engine} {statistics.median(samples):7.2f} ms {len(pdf) / 1024:6.1f} KB')
+        print(f"loans    agreement term {term:>3}  " + '  '.join(row))
+    return {'failures': failures}
+
+THREADS_SCRIPT = '''
+import hashlib, json, sys
+from concurrent.futures import ThreadPoolExecutor
+sys.setswitchinterval(1e-6)
+import index
+from clock import parse_date, use_clock
+cases = json.load(sys.stdin)
+def render(case):
+    with use_clock(parse_date('2024-03-01')):
+        return hashlib.sha256(index.render_documents(*case)).hexdigest()
+with ThreadPoolExecutor(8) as pool:
+    print(json.dumps(list(pool.map(render, cases))))
+'''
+
+def bench_threads(documents: int = 240, workers: int = 4) -> Dict:
+    import hashlib
+    import json
+    import random
+    import subprocess
+    import batch
+    import fastpdf
+    import replay
+    import stamping
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.parse import parse_qsl, urlsplit
+    from clock import parse_date, use_clock
+
+    images = photo_data_uri(300, 150)
+    cases = [[doc_type, logo, logo, client, profile, True, engine]
+             for doc_type in list(RENDERERS) + ['bundle'] for engine in index.ENGINES for profile in ('default', 'fast')
+             for client in (CLIENT, LONG_CLIENT) for logo in (None, images)]
+
+    def render(case) -> str:
+        with use_clock(parse_date('2024-03-01')):
+            return hashlib.sha256(index.render_documents(*case)).hexdigest()
+
+    serial = [render(case) for case in cases]
+    failures = []
+
+    # Кэши пустеют, чтобы потоки одновременно собирали скелеты, штампы и изображения, а не только читали их
+    replay.reset_caches()
+    stamping.stamps.clear()
+    fastpdf.image_objects.clear()
+    order = list(range(len(cases))) * 3
+    random.Random(7).shuffle(order)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(workers * 2) as pool:
+            digests = list(pool.map(lambda position: render(cases[position]), order))
+    finally:
+        sys.setswitchinterval(interval)
+    mismatched = {position for position, digest in zip(order, digests) if digest != serial[position]}
+    if mismatched:
+        failures.append('warm')
+    print(f"threads  warm  {len(order):4} concurrent renders  {len(mismatched)} differ from serial  "
+          f"{'ok' if not mismatched else 'FAILED'}")
+
+    output = subprocess.run([sys.executable, '-c', THREADS_SCRIPT], input=json.dumps(cases), cwd=HERE,
+                            env=cold_env(), capture_output=True, text=True, check=True).stdout
+    cold = json.loads(output)
+    differ = sum(digest != expected for digest, expected in zip(cold, serial))
+    if differ or len(cold) != len(serial):
+        failures.append('cold')
+    print(f"threads  cold  {len(cold):4} concurrent renders  {differ} differ from serial  {'ok' if not differ else 'FAILED'}")
+
+    mix = [dict(parse_qsl(urlsplit(request.path).query))
+           for request in replay.synthetic_requests(documents, 'loan=5,consent=3,refund=2,bundle=1')]
+    moment = index.now()
+    tasks = [(position, params['type'], None, None, params, None, False, moment, None)
+             for position, params in enumerate(mix, 1)]
+    throughput = {}
+    count = 1
+    while count <= workers:
+        row = {}
+        for mode in ('threads', 'processes'):
+            batch.shutdown_pool()
+            batch.BATCH_WORKERS = count
+            if count == 1:
+                run = lambda: list(map(batch.render_item, tasks))
+            elif mode == 'threads':
+                run = lambda: list(batch.get_threads().map(batch.render_item, tasks))
+            else:
+                run = lambda: list(batch.get_pool().imap_unordered(batch.render_item, tasks, chunksize=4))
+            run()
+            start = time.perf_counter()
+            run()
+            row[mode] = documents / (time.perf_counter() - start)
+        throughput[count] = row
+        print(f"threads  workers {count:3}  threads {row['threads']:8.1f} docs/s  processes {row['processes']:8.1f} docs/s  "
+              f"(cpus {os.cpu_count()})")
+        count *= 2
+    batch.shutdown_pool()
+    return {'failures': failures, 'throughput': throughput}
+
+SUBSETTING_SCRIPT = '''
+import hashlib, json, sys
+from concurrent.futures import ThreadPoolExecutor
+sys.setswitchinterval(1e-6)
+import index
+from clock import parse_date, use_clock
+cases = json.load(sys.stdin)
+def render(client):
+    with use_clock(parse_date('2024-03-01')):
+        return hashlib.sha256(index.render_documents('bundle', client_data=client, deterministic=True,
+                                                     engine='reportlab')).hexdigest()
+serial = [render(client) for client in cases]
+errors = mismatches = 0
+for _ in range(int(sys.argv[1])):
+    with ThreadPoolExecutor(8) as pool:
+        try:
+            mismatches += sum(a != b for a, b in zip(pool.map(render, cases), serial))
+        except Exception:
+            errors += 1
+print(json.dumps({'errors': errors, 'mismatches': mismatches}))
+'''
+
+def bench_subsetting(rounds: int = 20) -> Dict:
+    import json
+    import subprocess
+    # Каждый клиент даёт своё подмножество глифов, и reportlab строит его при каждом сохранении
+    names = ['Иванов', 'Петров Пётр', 'Сидорова Анна', 'Ёлкин Юрий', 'Щукин Эдуард', 'Жуков Фёдор']
+    cases = [dict(CLIENT, fullName=name * (position % 3 + 1), term=str(position % 40 + 1))
+             for position, name in enumerate(names * 8)]
+    results = {}
+    for lock in ('0', '1'):
+        output = subprocess.run([sys.executable, '-c', SUBSETTING_SCRIPT, str(rounds)], cwd=HERE,
+                                env=dict(os.environ, PDF_SUBSET_LOCK=lock, PDF_FREEZE_FONTS='0', PDF_TIMING_LOG='0'),
+                                input=json.dumps(cases), capture_output=True, text=True, check=True).stdout
+        results[lock] = row = json.loads(output.strip().splitlines()[-1])
+        print(f"subsetting lock {'on ' if lock == '1' else 'off'}  {rounds} rounds x {len(cases)} concurrent bundles  "
+              f"errors {row['errors']}  differ from serial {row['mismatches']}")
+    return {'failures': ['lock'] if results['1']['errors'] or results['1']['mismatches'] else []}
+
+def bench_fetch() -> Dict:
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from fetch import AssetFetcher, FetchError, public_address
+    png = BytesIO()
+    from PIL import Image
+    Image.new('RGB', (4, 4)).save(png, 'PNG')
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == '/drip':
+                # Отдаёт заголовки по байту: каждая пауза короче таймаута сокета, а вся загрузка — нет
+                for byte in b'HTTP/1.1 200 OK\r\nContent-Type: image/png\r\n':
+                    self.wfile.write(bytes([byte]))
+                    self.wfile.flush()
+                    time.sleep(0.05)
+                return
+            if self.path.startswith('/redirect/'):
+                self.send_response(302)
+                self.send_header('Location', self.path.split('/redirect/', 1)[1] or '/redirect/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = png.getvalue() * (400 if self.path == '/big' else 1)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            if self.path != '/big':
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_port}'
+    local = AssetFetcher(timeout=0.5, max_bytes=4096, allowed_hosts=['127.0.0.1'], workers=1,
+                         deadline=1.0, allow_private=True)
+    cases = [
+        ('small image', lambda: local.fetch(f'{base}/ok'), None),
+        ('size limit', lambda: local.fetch(f'{base}/big'), 'larger than'),
+        ('redirect cap', lambda: local.fetch(f'{base}/redirect/'), 'Too many redirects'),
+        ('redirect off allowlist', lambda: local.fetch(f'{base}/redirect/http://metadata.internal/'), 'not allowed'),
+        ('slow drip deadline', lambda: local.fetch(f'{base}/drip'), 'longer than'),
+        ('default allowlist', lambda: AssetFetcher(workers=1).fetch(f'{base}/ok'), 'not allowed'),
+        ('loopback address', lambda: AssetFetcher(allowed_hosts=['*'], workers=1).fetch(f'{base}/ok'), 'non-public'),
+        ('link-local address', lambda: public_address('169.254.169.254', 80), 'non-public'),
+    ]
+    failures = []
+    for name, call, expected in cases:
+        start = time.perf_counter()
+        try:
+            call()
+            outcome = 'ok'
+        except FetchError as e:
+            outcome = str(e)
+        elapsed = time.perf_counter() - start
+        passed = outcome == 'ok' if expected is None else expected in outcome
+        # Ни один отказ не должен держать воркер заметно дольше общего срока загрузки
+        passed = passed and elapsed < local.deadline + 0.5
+        if not passed:
+            failures.append(name)
+        print(f"fetch {name:<24} {elapsed * 1000:7.1f} ms  {'pass' if passed else 'FAIL'}  {outcome}")
+    local.close()
+    server.shutdown()
+    return {'failures': failures}
+
+def bench_soak(requests: int = 3000, interval: int = 500) -> Dict:
+    import replay
+    traffic = replay.synthetic_requests(requests + interval, 'loan=5,consent=3,refund=2,bundle=1',
+                                        images=replay.sample_images(8))
+    summary = replay.soak(traffic, interval, warmup=interval)
+    replay.print_soak(summary)
+    return summary
+
+BENCHMARKS = {
+    'suite': bench_suite,
+    'skeletons': bench_skeletons,
+    'batch': bench_batch,
+    'output': bench_output,
+    'coldstart': bench_coldstart,
+    'profiles': bench_profiles,
+    'server': bench_server,
+    'determinism': bench_determinism,
+    'jobs': bench_jobs,
+    'templates': bench_templates,
+    'replay': bench_replay,
+    'soak': bench_soak,
+    'engines': bench_engines,
+    'threads': bench_threads,
+    'loans': bench_loans,
+    'subsetting': bench_subsetting,
+    'fetch': bench_fetch,
+}
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='PDF generator benchmarks')
+    parser.add_argument('names', nargs='*', default=['suite'], help=', '.join(BENCHMARKS))
+    parser.add_argument('--rounds', type=int, default=30, help='warm requests per suite scenario')
+    parser.add_argument('--output', default='bench-results.json', help='suite results file')
+    parser.add_argument('--thresholds', default=THRESHOLDS_FILE, help='suite regression thresholds')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+
+    failed = False
+    for name in args.names:
+        if name == 'suite':
+            failed = bool(bench_suite(args.rounds, args.output, args.thresholds)['regressions']) or failed
+        elif name == 'determinism':
+            failed = bool(bench_determinism()['failures']) or failed
+        elif name == 'engines':
+            failed = bool(bench_engines()['failures']) or failed
+        elif name == 'threads':
+            failed = bool(bench_threads()['failures']) or failed
+        elif name == 'subsetting':
+            failed = bool(bench_subsetting()['failures']) or failed
+        elif name == 'fetch':
+            failed = bool(bench_fetch()['failures']) or failed
+        elif name == 'loans':
+            failed = bool(bench_loans()['failures']) or failed
+        elif name == 'soak':
+            failed = bench_soak()['leaking'] or failed
+        else:
+            BENCHMARKS[name]()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,53 @@
+'''
+Единые часы для дат в документах. Детерминированный режим делает байты PDF зависящими только от входных данных
+и только в нём (или с PDF_ALLOW_DATE=1) запрос может зафиксировать дату (date=YYYY-MM-DD)
+'''
+
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional
+
+DETERMINISTIC = os.environ.get('PDF_DETERMINISTIC', '0') != '0'
+FIXED_DATE = os.environ.get('PDF_FIXED_DATE', '')
+ALLOW_DATE = os.environ.get('PDF_ALLOW_DATE', '0') != '0'
+
+_local = threading.local()
+
+class DateNotAllowed(ValueError):
+    '''Дата договора задаётся клиентом только для воспроизводимых документов'''
+
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, '%Y-%m-%d')
+
+FIXED_MOMENT = parse_date(FIXED_DATE) if FIXED_DATE else None
+
+def now() -> datetime:
+    moment = getattr(_local, 'moment', None)
+    if moment is not None:
+        return moment
+    return FIXED_MOMENT or datetime.now()
+
+@contextmanager
+def use_clock(moment: Optional[datetime]) -> Iterator[Optional[datetime]]:
+    previous = getattr(_local, 'moment', None)
+    _local.moment = moment
+    try:
+        yield moment
+    finally:
+        _local.moment = previous
+
+def request_moment(params: Dict[str, Any]) -> datetime:
+    value = params.get('date')
+    if not value:
+        return now()
+    if not (ALLOW_DATE or is_deterministic(params)):
+        raise DateNotAllowed('date is only accepted together with deterministic=1')
+    return parse_date(value)
+
+def is_deterministic(params: Dict[str, Any]) -> bool:
+    value = params.get('deterministic')
+    if value is None or value == '':
+        return DETERMINISTIC
+    return str(value).lower() in ('1', 'true', 'yes')
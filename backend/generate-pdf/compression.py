@@ -0,0 +1,62 @@
+'''
+Профили вывода PDF: fast — минимум сжатия ради задержки, small — максимум сжатия
+и более низкое разрешение изображений
+'''
+
+import os
+import re
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Optional
+from reportlab import rl_config
+from reportlab.pdfbase import pdfdoc
+
+class OutputProfile(NamedTuple):
+    name: str
+    page_compression: bool
+    zlib_level: int
+    image_dpi: int
+    jpeg_quality: int
+
+IMAGE_DPI = int(os.environ.get('IMAGE_DPI', '300'))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', '75'))
+
+PROFILES = {
+    'default': OutputProfile('default', True, 6, IMAGE_DPI, 85),
+    'fast': OutputProfile('fast', False, 1, IMAGE_DPI // 2, 85),
+    'small': OutputProfile('small', True, 9, IMAGE_DPI // 2, IMAGE_JPEG_QUALITY),
+}
+
+DEFAULT_PROFILE = os.environ.get('PDF_OUTPUT_PROFILE', 'default')
+
+# ASCII85 раздувает каждый поток на четверть; ответ и так бинарный
+rl_config.useA85 = 0
+
+_local = threading.local()
+
+class LevelFlateFilter(pdfdoc.PDFStreamFilterZCompress):
+    def encode(self, text):
+        if isinstance(text, str):
+            text = text.encode('utf8')
+        return zlib.compress(text, active_profile().zlib_level)
+
+pdfdoc.PDFZCompress = LevelFlateFilter()
+
+def get_profile(name: Optional[str]) -> Optional[OutputProfile]:
+    return PROFILES.get(name or DEFAULT_PROFILE)
+
+def active_profile() -> OutputProfile:
+    return getattr(_local, 'profile', None) or PROFILES['default']
+
+@contextmanager
+def use_profile(profile: OutputProfile) -> Iterator[OutputProfile]:
+    previous = getattr(_local, 'profile', None)
+    _local.profile = profile
+    try:
+        yield profile
+    finally:
+        _local.profile = previous
+
+def embedded_font_sizes(pdf: bytes) -> List[int]:
+    return [int(size) for size in re.findall(rb'/Length1 (\d+)', pdf)]
@@ -0,0 +1,372 @@
+'''
+Быстрый движок PDF для документов из строк: объекты, content stream и xref пишутся напрямую, без pdfgen.
+Шрифт встраивается заранее собранным подмножеством с постоянной кодировкой, поэтому неизменные части
+документа и объекты шрифта сериализуются один раз на процесс и дальше только склеиваются
+'''
+
+import codecs
+import hashlib
+import os
+import threading
+import uuid
+import zlib
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+from reportlab.lib.colors import Color, black
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.rl_accel import escapePDF, fp_str
+from reportlab.pdfbase import pdfmetrics, ttfonts
+from reportlab.pdfgen.pathobject import PDFPathObject
+from reportlab.pdfbase.ttfonts import FF_NONSYMBOLIC, FF_SYMBOLIC, SUBSETN
+from cache import LRUCache
+from compression import OutputProfile
+from images import CachedImage
+from layout import string_width
+from skeletons import CANVAS_STATE, Fragment, Skeleton
+from templates import Condition, Template
+
+PAGE_WIDTH, PAGE_HEIGHT = A4
+FONT_PROGRAM_CACHE_BYTES = int(os.environ.get('FONT_PROGRAM_CACHE_BYTES', str(16 * 1024 * 1024)))
+
+# Кириллица и типографика, которые встречаются в данных клиентов; символы шаблонов добавляются к ним
+BASE_REPERTOIRE = ''.join(map(chr, range(0x410, 0x450))) + 'Ёё«»—–•№₽…“”„‘’°×'
+MAX_EXTRA_CODES = 128
+
+HEADER = b'%PDF-1.4\n%\x93\x8c\x8b\x9e\n'
+CATALOG, PAGES, INFO, FIRST_FONT_OBJECT = 1, 2, 3, 4
+FONT_RESOURCE = 'F1+0'
+
+image_objects = LRUCache(8 * 1024 * 1024)
+
+class FastUnsupported(Exception):
+    '''Документ нельзя собрать быстрым движком, запрос отрисовывается через reportlab'''
+
+class FontProgram(NamedTuple):
+    key: Tuple
+    font_name: str
+    table: Dict[int, str]
+    block: bytes
+    offsets: Tuple[int, ...]
+
+    @property
+    def next_object(self) -> int:
+        return FIRST_FONT_OBJECT + len(self.offsets)
+
+# Ключи содержат версии шаблонов: программы устаревших версий вытесняются по LRU
+font_programs = LRUCache(FONT_PROGRAM_CACHE_BYTES)
+_repertoires = LRUCache(256 * 1024)
+_lock = threading.Lock()
+
+def _template_texts(template: Template) -> Iterator[str]:
+    for placed in template.header + template.overlay:
+        yield placed.text
+    for lines in template.blocks.values():
+        for _, text in lines:
+            yield text
+    items = list(template.body)
+    while items:
+        item = items.pop()
+        if isinstance(item, Condition):
+            items.extend(item.lines)
+        elif item.kind != 'block':
+            yield item.text
+
+def repertoire(pages: Tuple[Template, ...]) -> str:
+    key = tuple((template.name, template.version) for template in pages)
+    chars = _repertoires.get(key)
+    if chars is None:
+        used = set(BASE_REPERTOIRE)
+        for template in pages:
+            for text in _template_texts(template):
+                used.update(text)
+        chars = ''.join(sorted(char for char in used if ord(char) > 127 and char != '\xa0'))
+        _repertoires.put(key, chars, len(chars) + sum(len(name) + len(version) for name, version in key))
+    return chars
+
+def stream_object(dictionary: str, data: bytes, level: Optional[int]) -> bytes:
+    if level is not None:
+        data = zlib.compress(data, level)
+        dictionary += ' /Filter /FlateDecode'
+    return b'<< %s /Length %d >>\nstream\n%s\nendstream' % (dictionary.encode('ascii'), len(data), data)
+
+def _serialize_objects(first: int, bodies: List[bytes]) -> Tuple[bytes, Tuple[int, ...]]:
+    block = bytearray()
+    offsets = []
+    for number, body in enumerate(bodies, first):
+        offsets.append(len(block))
+        block += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    return bytes(block), tuple(offsets)
+
+def to_unicode_cmap(font_name: str, subset: List[int]) -> str:
+    # В отличие от makeToUnicodeCMap из reportlab символы вне BMP пишутся суррогатной парой UTF-16BE,
+    # а соответствия идут блоками по 100, как требует спецификация
+    pairs = [f'<{code:02X}> <{chr(value).encode("utf-16-be").hex().upper()}>' for code, value in enumerate(subset)]
+    blocks = []
+    for start in range(0, len(pairs), 100):
+        chunk = pairs[start:start + 100]
+        blocks += [f'{len(chunk)} beginbfchar', *chunk, 'endbfchar']
+    return '\n'.join([
+        '/CIDInit /ProcSet findresource begin', '12 dict begin', 'begincmap',
+        f'/CIDSystemInfo << /Registry ({font_name}) /Ordering ({font_name}) /Supplement 0 >> def',
+        f'/CMapName /{font_name} def', '/CMapType 2 def',
+        '1 begincodespacerange', f'<00> <{len(subset) - 1:02X}>', 'endcodespacerange',
+        *blocks,
+        'endcmap', 'CMapName currentdict /CMap defineresource pop', 'end', 'end'
+    ])
+
+# Движок reportlab строит свои подмножества той же функцией, иначе его карта для 💰 тоже была бы битой
+ttfonts.makeToUnicodeCMap = to_unicode_cmap
+
+def _build_program(font_name: str, chars: str, level: Optional[int]) -> FontProgram:
+    font = pdfmetrics.getFont(font_name)
+    if not getattr(font, '_dynamicFont', False):
+        raise FastUnsupported(f'{font_name} is not an embeddable TrueType font')
+    if len(chars) > MAX_EXTRA_CODES:
+        raise FastUnsupported(f'{len(chars)} non-ASCII characters do not fit one font subset')
+
+    face = font.face
+    # Как у reportlab: первые 128 кодов — ASCII один в один, остальные символы идут следом
+    subset = list(range(128)) + [ord(char) for char in chars]
+    table = {code: escapePDF(bytes((code,))) for code in range(128)}
+    table.update({ord(char): f'\\{code:03o}' for code, char in enumerate(chars, 128)})
+    table[0xa0] = ' '
+
+    base_font = (SUBSETN(0) + b'+' + face.name + face.subfontNameX).decode('ascii')
+    font_file = face.makeSubset(subset)
+    flags = face.flags & ~FF_NONSYMBOLIC | FF_SYMBOLIC
+    to_unicode, descriptor, font_file_object = FIRST_FONT_OBJECT + 1, FIRST_FONT_OBJECT + 2, FIRST_FONT_OBJECT + 3
+    bodies = [
+        (f'<< /BaseFont /{base_font} /FirstChar 0 /FontDescriptor {descriptor} 0 R /LastChar {len(subset) - 1} '
+         f'/Name /{FONT_RESOURCE} /Subtype /TrueType /ToUnicode {to_unicode} 0 R /Type /Font '
+         f'/Widths [{fp_str(*map(face.getCharWidth, subset))}] >>').encode('ascii'),
+        stream_object('', to_unicode_cmap(base_font, subset).encode('ascii'), level),
+        (f'<< /Ascent {face.ascent} /CapHeight {face.capHeight} /Descent {face.descent} /Flags {flags} '
+         f'/FontBBox [{fp_str(*face.bbox)}] /FontFile2 {font_file_object} 0 R /FontName /{base_font} '
+         f'/ItalicAngle {face.italicAngle} /StemV {face.stemV} /Type /FontDescriptor >>').encode('ascii'),
+        stream_object(f'/Length1 {len(font_file)}', font_file, level),
+    ]
+    block, offsets = _serialize_objects(FIRST_FONT_OBJECT, bodies)
+    return FontProgram((font_name, chars, level), font_name, table, block, offsets)
+
+def font_program(font_name: str, pages: Tuple[Template, ...], profile: OutputProfile) -> FontProgram:
+    level = profile.zlib_level if profile.page_compression else None
+    key = (font_name, repertoire(pages), level)
+    program = font_programs.get(key)
+    if program is None:
+        with _lock:
+            program = font_programs.get(key)
+            if program is None:
+                program = _build_program(font_name, key[1], level)
+                font_programs.put(key, program, len(program.block))
+    return program
+
+class FastCanvas:
+    '''Подмножество API reportlab Canvas, которым пользуются отрисовка документов, вёрстка и скелеты'''
+
+    def __init__(self, program: FontProgram, skeleton: Skeleton = None):
+        self.program = program
+        self.pages: List[Tuple[str, Tuple[str, ...]]] = []
+        self.images: Dict[str, Tuple[str, CachedImage]] = {}
+        self.fonts: Set[str] = {font for font, _ in skeleton.fonts} if skeleton else set()
+        self._code: List[str] = []
+        self._page_images: List[str] = []
+        self._init_state()
+
+    def _init_state(self):
+        self._fontname = 'Helvetica'
+        self._fontsize = 12
+        self._leading = 14.4
+        self._fillColorObj = black
+        self._strokeColorObj = black
+        self._lineWidth = 0
+
+    def setFont(self, name: str, size: float, leading: float = None):
+        self._fontname = name
+        self._fontsize = size
+        self._leading = leading if leading is not None else size * 1.2
+
+    def setFillColor(self, color: Color):
+        self._fillColorObj = color
+        self._code.append(f'{fp_str(color.red, color.green, color.blue)} rg')
+
+    def setStrokeColor(self, color: Color):
+        self._strokeColorObj = color
+        self._code.append(f'{fp_str(color.red, color.green, color.blue)} RG')
+
+    def setLineWidth(self, width: float):
+        self._lineWidth = width
+        self._code.append(f'{fp_str(width)} w')
+
+    def _paint(self, stroke: int, fill: int):
+        self._code.append('B' if stroke and fill else 'f' if fill else 'S' if stroke else 'n')
+
+    def rect(self, x: float, y: float, width: float, height: float, stroke: int = 1, fill: int = 0):
+        self._code.append(f'{fp_str(x, y, width, height)} re')
+        self._paint(stroke, fill)
+
+    def roundRect(self, x: float, y: float, width: float, height: float, radius: float, stroke: int = 1, fill: int = 0):
+        PDFPathObject(code=self._code).roundRect(x, y, width, height, radius)
+        self._paint(stroke, fill)
+
+    def line(self, x1: float, y1: float, x2: float, y2: float):
+        self._code.append(f'{fp_str(x1, y1)} m {fp_str(x2, y2)} l S')
+
+    def _text(self, text: str) -> str:
+        if self._fontname == self.program.font_name:
+            encoded = text.translate(self.program.table)
+            if not encoded.isascii():
+                missing = next(char for char in encoded if ord(char) > 127)
+                raise FastUnsupported(f'U+{ord(missing):04X} is outside the prebuilt font subset')
+            return f'/{FONT_RESOURCE} {fp_str(self._fontsize)} Tf {fp_str(self._leading)} TL ({encoded}) Tj'
+
+        font = pdfmetrics.getFont(self._fontname)
+        if getattr(font, '_dynamicFont', False):
+            raise FastUnsupported(f'{self._fontname} is not the document font')
+        parts = []
+        for part_font, data in pdfmetrics.unicode2T1(text, [font] + font.substitutionFonts):
+            # Стандартные шрифты не встраиваются, имя ресурса совпадает с именем шрифта
+            self.fonts.add(part_font.fontName)
+            parts.append(f'/{part_font.fontName} {fp_str(self._fontsize)} Tf '
+                         f'{fp_str(self._leading)} TL ({escapePDF(data)}) Tj')
+        return ' '.join(parts)
+
+    def drawString(self, x: float, y: float, text: str):
+        self._code.append(f'BT 1 0 0 1 {fp_str(x, y)} Tm {self._text(text)} T* ET')
+
+    def drawRightString(self, x: float, y: float, text: str):
+        self.drawString(x - string_width(text, self._fontname, self._fontsize), y, text)
+
+    def drawCentredString(self, x: float, y: float, text: str):
+        self.drawString(x - string_width(text, self._fontname, self._fontsize) / 2, y, text)
+
+    def draw_cached_image(self, image: CachedImage, x: float, y: float):
+        if image.name not in self.images:
+            self.images[image.name] = (f'Im{len(self.images)}', image)
+        resource = self.images[image.name][0]
+        if resource not in self._page_images:
+            self._page_images.append(resource)
+        self._code.append(f'q {fp_str(image.width)} 0 0 {fp_str(image.height)} {fp_str(x, y)} cm /{resource} Do Q')
+
+    def showPage(self):
+        self.pages.append(('\n'.join(self._code), tuple(self._page_images)))
+        self._code = []
+        self._page_images = []
+        self._init_state()
+
+    def getpdfdata(self, profile: OutputProfile, title: str, author: str, moment: datetime,
+                   digest: Optional[str] = None) -> bytes:
+        if self._code or not self.pages:
+            self.showPage()
+        return write_document(self, profile, title, author, moment, digest)
+
+def compile_skeleton(program: FontProgram) -> Callable[[List[Tuple[str, Callable[[Any], Any]]]], Skeleton]:
+    def compile_parts(parts: List[Tuple[str, Callable[[Any], Any]]]) -> Skeleton:
+        fragments = {}
+        fonts = set()
+        for name, draw in parts:
+            c = FastCanvas(program)
+            value = draw(c)
+            if c.pages:
+                raise ValueError(f'Skeleton part {name} must fit on one page')
+            fragments[name] = Fragment('\n'.join(c._code), tuple(getattr(c, attr) for attr in CANVAS_STATE), value)
+            fonts.update(c.fonts)
+        return Skeleton(fragments, [(font, font) for font in sorted(fonts)], {})
+    return compile_parts
+
+def _image_object(image: CachedImage) -> bytes:
+    body = image_objects.get(image.name)
+    if body is None:
+        xobject = image.xobject
+        filters = ' '.join(f'/{name}' for name in xobject._filters)
+        body = (b'<< /BitsPerComponent %d /ColorSpace /%s /Filter [%s] /Height %d /Length %d /Subtype /Image '
+                b'/Type /XObject /Width %d >>\nstream\n%s\nendstream' % (
+                    xobject.bitsPerComponent, xobject.colorSpace.encode('ascii'), filters.encode('ascii'),
+                    xobject.height, len(xobject.streamContent), xobject.width, xobject.streamContent))
+        image_objects.put(image.name, body, len(body))
+    return body
+
+def _pdf_string(text: str) -> str:
+    try:
+        return '(' + escapePDF(text.encode('latin-1')) + ')'
+    except UnicodeEncodeError:
+        return '<' + (codecs.BOM_UTF16_BE + text.encode('utf-16-be')).hex() + '>'
+
+def _pdf_date(moment: datetime) -> str:
+    # Время без зоны — местное, как у reportlab; детерминированный режим передаёт полночь в UTC
+    if moment.tzinfo is None:
+        moment = moment.astimezone()
+    minutes = int(moment.utcoffset().total_seconds()) // 60
+    return moment.strftime('D:%Y%m%d%H%M%S') + f"{'-' if minutes < 0 else '+'}{abs(minutes) // 60:02d}'{abs(minutes) % 60:02d}'"
+
+def info_object(title: str, author: str, moment: datetime) -> bytes:
+    stamp = _pdf_date(moment)
+    return (f'<< /Author {_pdf_string(author)} /CreationDate ({stamp}) /Creator {_pdf_string(author)} '
+            f'/ModDate ({stamp}) /Producer {_pdf_string(author)} /Title {_pdf_string(title)} >>').encode('latin-1')
+
+def trailer(objects: int, xref: int, digest: Optional[str] = None) -> bytes:
+    file_id = hashlib.md5((digest or uuid.uuid4().hex).encode('ascii')).hexdigest().encode('ascii')
+    return b'trailer\n<< /ID [<%s> <%s>] /Info %d 0 R /Root %d 0 R /Size %d >>\nstartxref\n%d\n%%%%EOF\n' % (
+        file_id, file_id, INFO, CATALOG, objects, xref)
+
+def resource_objects(c: FastCanvas, add: Callable[[int, bytes], None], number: int) -> Tuple[int, Dict[str, str], int]:
+    fonts = [f'/{FONT_RESOURCE} {FIRST_FONT_OBJECT} 0 R']
+    for font_name in sorted(c.fonts):
+        font = pdfmetrics.getFont(font_name)
+        encoding = ' /Encoding /WinAnsiEncoding' if font.encoding.name == 'WinAnsiEncoding' else ''
+        add(number, f'<< /BaseFont /{font_name}{encoding} /Name /{font_name} /Subtype /Type1 /Type /Font >>'
+                    .encode('ascii'))
+        fonts.append(f'/{font_name} {number} 0 R')
+        number += 1
+
+    font_dict = number
+    add(font_dict, f'<< {" ".join(fonts)} >>'.encode('ascii'))
+    number += 1
+
+    xobjects = {}
+    for resource, image in c.images.values():
+        add(number, _image_object(image))
+        xobjects[resource] = f'/{resource} {number} 0 R'
+        number += 1
+    return font_dict, xobjects, number
+
+def page_object(contents: str, font_dict: int, images: Tuple[str, ...], xobjects: Dict[str, str]) -> bytes:
+    resources = f'/Font {font_dict} 0 R /ProcSet [/PDF /Text /ImageB /ImageC /ImageI]'
+    if images:
+        resources += f' /XObject << {" ".join(xobjects[resource] for resource in images)} >>'
+    return (f'<< /Contents {contents} /MediaBox [0 0 {fp_str(PAGE_WIDTH, PAGE_HEIGHT)}] /Parent {PAGES} 0 R '
+            f'/Resources << {resources} >> /Type /Page >>').encode('ascii')
+
+def write_document(c: FastCanvas, profile: OutputProfile, title: str, author: str, moment: datetime,
+                   digest: Optional[str] = None) -> bytes:
+    program = c.program
+    level = profile.zlib_level if profile.page_compression else None
+    out = bytearray(HEADER)
+    offsets: Dict[int, int] = {}
+
+    def add(number: int, body: bytes):
+        offsets[number] = len(out)
+        out.extend(b'%d 0 obj\n%s\nendobj\n' % (number, body))
+
+    base = len(out)
+    out.extend(program.block)
+    for number, offset in enumerate(program.offsets, FIRST_FONT_OBJECT):
+        offsets[number] = base + offset
+    font_dict, xobjects, number = resource_objects(c, add, program.next_object)
+
+    kids = []
+    for content, images in c.pages:
+        add(number, stream_object('', content.encode('latin-1'), level))
+        add(number + 1, page_object(f'{number} 0 R', font_dict, images, xobjects))
+        kids.append(f'{number + 1} 0 R')
+        number += 2
+
+    add(CATALOG, b'<< /Pages %d 0 R /Type /Catalog >>' % PAGES)
+    add(PAGES, f'<< /Count {len(kids)} /Kids [{" ".join(kids)}] /Type /Pages >>'.encode('ascii'))
+    add(INFO, info_object(title, author, moment))
+
+    xref = len(out)
+    out.extend(b'xref\n0 %d\n0000000000 65535 f \n' % number)
+    for position in range(1, number):
+        out.extend(b'%010d 00000 n \n' % offsets[position])
+    out.extend(trailer(number, xref, digest))
+    return bytes(out)
@@ -0,0 +1,208 @@
+'''
+Загрузка удалённых логотипов и подписей: пул keep-alive соединений, таймауты, лимит размера
+и фоновая предзагрузка, пока документ верстается. Хосты ограничены списком, внутренние адреса
+отклоняются на каждом переходе по редиректу, а вся загрузка укладывается в общий срок
+'''
+
+import http.client
+import ipaddress
+import os
+import socket
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+ASSET_TIMEOUT = float(os.environ.get('ASSET_TIMEOUT', '3'))
+ASSET_MAX_BYTES = int(os.environ.get('ASSET_MAX_BYTES', str(5 * 1024 * 1024)))
+ASSET_DEADLINE = float(os.environ.get('ASSET_DEADLINE', '5'))
+# '*' снимает ограничение по имени хоста, но внутренние адреса всё равно отклоняются
+ASSET_ALLOWED_HOSTS = [h.strip() for h in os.environ.get('ASSET_ALLOWED_HOSTS', 'cdn.poehali.dev').split(',') if h.strip()]
+ASSET_ALLOW_PRIVATE = os.environ.get('ASSET_ALLOW_PRIVATE', '0') == '1'
+ASSET_FETCH_WORKERS = int(os.environ.get('ASSET_FETCH_WORKERS', '4'))
+MAX_REDIRECTS = 3
+MAX_IDLE_PER_HOST = 4
+MAX_PENDING = 32
+
+class FetchError(Exception):
+    pass
+
+def is_remote(data: Optional[str]) -> bool:
+    return bool(data) and data.startswith(('http://', 'https://'))
+
+def public_address(host: str, port: int) -> str:
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError as e:
+        raise FetchError(f'Cannot resolve asset host {host}: {e}')
+    for *_, sockaddr in infos:
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if not address.is_global:
+            raise FetchError(f'Asset host resolves to a non-public address: {host}')
+    return infos[0][4][0]
+
+def _abort(sock: socket.socket) -> None:
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+class AssetFetcher:
+    def __init__(self, timeout: float = ASSET_TIMEOUT, max_bytes: int = ASSET_MAX_BYTES,
+                 allowed_hosts: List[str] = None, workers: int = ASSET_FETCH_WORKERS,
+                 deadline: float = ASSET_DEADLINE, allow_private: bool = ASSET_ALLOW_PRIVATE):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.allowed_hosts = allowed_hosts if allowed_hosts is not None else ASSET_ALLOWED_HOSTS
+        self.deadline = deadline
+        self.allow_private = allow_private
+        self.requests = 0
+        self.reused = 0
+        self.failures = 0
+        self._idle: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='asset-fetch')
+
+    def _acquire(self, key: Tuple[str, str, int], timeout: float) -> http.client.HTTPConnection:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop()
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        if not self.allow_private:
+            # Подключаемся ровно к проверенному адресу, чтобы повторное разрешение имени не увело во внутреннюю сеть
+            address = public_address(host, port)
+            conn._create_connection = lambda _, *args: socket.create_connection((address, port), *args)
+        return conn
+
+    def _release(self, key: Tuple[str, str, int], conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < MAX_IDLE_PER_HOST:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _request(self, url: str, deadline: float) -> Tuple[int, Dict[str, str], bytes]:
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise FetchError(f'Unsupported asset URL: {url}')
+        if '*' not in self.allowed_hosts and parts.hostname not in self.allowed_hosts:
+            raise FetchError(f'Asset host is not allowed: {parts.hostname}')
+
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        for attempt in range(2):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise FetchError(f'Asset download took longer than {self.deadline}s')
+            conn = self._acquire(key, min(self.timeout, remaining))
+            watchdog = None
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(min(self.timeout, remaining))
+                # Таймаут сокета ограничивает только паузу между пакетами; медленную отдачу по байту обрывает сторож
+                watchdog = threading.Timer(remaining, _abort, (conn.sock,))
+                watchdog.daemon = True
+                watchdog.start()
+                conn.request('GET', path, headers={'Connection': 'keep-alive', 'Accept': 'image/*'})
+                response = conn.getresponse()
+                length = response.getheader('Content-Length')
+                if length and int(length) > self.max_bytes:
+                    conn.close()
+                    raise FetchError(f'Asset is larger than {self.max_bytes} bytes')
+                body = response.read(self.max_bytes + 1)
+                watchdog.cancel()
+                if time.monotonic() >= deadline:
+                    conn.close()
+                    raise FetchError(f'Asset download took longer than {self.deadline}s')
+                if len(body) > self.max_bytes:
+                    conn.close()
+                    raise FetchError(f'Asset is larger than {self.max_bytes} bytes')
+                headers = {k.lower(): v for k, v in response.getheaders()}
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._release(key, conn)
+                return response.status, headers, body
+            except FetchError:
+                conn.close()
+                raise
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if time.monotonic() >= deadline:
+                    raise FetchError(f'Asset download took longer than {self.deadline}s')
+                if attempt or not isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)):
+                    raise
+            except Exception:
+                conn.close()
+                raise
+            finally:
+                if watchdog is not None:
+                    watchdog.cancel()
+        raise FetchError(f'Could not fetch {url}')
+
+    def fetch(self, url: str) -> bytes:
+        self.requests += 1
+        deadline = time.monotonic() + self.deadline
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                status, headers, body = self._request(url, deadline)
+                if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                    url = urljoin(url, headers['location'])
+                    continue
+                if status != 200:
+                    raise FetchError(f'Asset request failed with HTTP {status}')
+                if not headers.get('content-type', 'image/').startswith('image/'):
+                    raise FetchError(f"Asset is not an image: {headers.get('content-type')}")
+                return body
+            raise FetchError('Too many redirects')
+        except Exception:
+            self.failures += 1
+            raise
+
+    def prefetch(self, url: str) -> Future:
+        with self._lock:
+            future = self._inflight.get(url)
+            if future is None:
+                if len(self._inflight) >= MAX_PENDING:
+                    for pending_url in [u for u, f in self._inflight.items() if f.done()]:
+                        del self._inflight[pending_url]
+                future = self._inflight[url] = self._executor.submit(self.fetch, url)
+        return future
+
+    def get(self, url: str) -> bytes:
+        with self._lock:
+            future = self._inflight.pop(url, None)
+        if future is not None:
+            return future.result(timeout=self.deadline + self.timeout)
+        return self.fetch(url)
+
+    def discard(self, url: str) -> None:
+        with self._lock:
+            future = self._inflight.pop(url, None)
+        if future is not None:
+            future.cancel()
+
+    def close(self) -> None:
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {'requests': self.requests, 'reused': self.reused, 'failures': self.failures}
+
+fetcher = AssetFetcher()
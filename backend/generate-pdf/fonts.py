@@ -0,0 +1,100 @@
+'''
+Реестр шрифтов процесса: TTF читаются с диска один раз и живут между тёплыми вызовами,
+после прогрева реестр pdfmetrics замораживается и потоки рендера только читают его
+'''
+
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase._fontdata import standardFonts
+from reportlab.pdfbase.ttfonts import TTFont
+
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts')
+FALLBACK_FONT = 'Helvetica'
+FREEZE_FONTS = os.environ.get('PDF_FREEZE_FONTS', '1') != '0'
+SUBSET_LOCK = os.environ.get('PDF_SUBSET_LOCK', '1') != '0'
+
+FONT_CANDIDATES: List[Tuple[str, str]] = [
+    ('OpenSans', os.path.join(FONT_DIR, 'OpenSans.ttf')),
+    ('DejaVuSans', os.path.join(FONT_DIR, 'DejaVuSans.ttf')),
+    ('DejaVuSans', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'),
+    ('DejaVuSans', '/usr/share/fonts/dejavu/DejaVuSans.ttf'),
+]
+
+_lock = threading.Lock()
+_fonts: Dict[str, TTFont] = {}
+_font_name: Optional[str] = None
+_loaded = False
+_frozen = False
+
+class FrozenRegistry(dict):
+    '''Реестр pdfmetrics после заморозки: потоки рендера его только читают, поздняя регистрация — ошибка'''
+
+    def _refuse(self, *args, **kwargs):
+        raise RuntimeError('Font registry is frozen, fonts must be registered before freeze_fonts()')
+
+    __setitem__ = __delitem__ = setdefault = update = pop = popitem = clear = _refuse
+
+def _candidates() -> List[Tuple[str, str]]:
+    override = os.environ.get('PDF_FONT_PATH')
+    if override:
+        return [(os.environ.get('PDF_FONT_NAME', 'OpenSans'), override)] + FONT_CANDIDATES
+    return FONT_CANDIDATES
+
+def _serialize_subsetting(font: TTFont) -> None:
+    # makeSubset читает глифы через общий курсор файла шрифта: потоки сервера, сохраняющие документы
+    # одновременно, сбивают друг другу чтение (KeyError в ttfonts), воспроизводится через bench.py subsetting
+    face = font.face
+    make_subset = face.makeSubset
+    lock = threading.Lock()
+
+    def locked_make_subset(subset):
+        with lock:
+            return make_subset(subset)
+
+    face.makeSubset = locked_make_subset
+
+def load_fonts() -> bool:
+    global _font_name, _loaded
+    if _loaded:
+        return _font_name is not None
+    with _lock:
+        if not _loaded:
+            for name, path in _candidates():
+                if not os.path.isfile(path):
+                    continue
+                try:
+                    font = TTFont(name, path)
+                except Exception:
+                    continue
+                if SUBSET_LOCK:
+                    _serialize_subsetting(font)
+                pdfmetrics.registerFont(font)
+                _fonts[name] = font
+                _font_name = name
+                break
+            _loaded = True
+    return _font_name is not None
+
+def fonts_ready() -> bool:
+    return _loaded and _font_name is not None
+
+def get_font_name() -> str:
+    load_fonts()
+    return _font_name or FALLBACK_FONT
+
+def freeze_fonts() -> bool:
+    global _frozen
+    if _frozen:
+        return True
+    load_fonts()
+    with _lock:
+        if not _frozen:
+            # Стандартные шрифты иначе регистрируются лениво при первом getFont из любого потока
+            for name in standardFonts:
+                pdfmetrics.getFont(name)
+            for registry in ('_fonts', '_typefaces', '_encodings', '_dynFaceNames'):
+                setattr(pdfmetrics, registry, FrozenRegistry(getattr(pdfmetrics, registry)))
+            _frozen = True
+    return _frozen
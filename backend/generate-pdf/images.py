@@ -0,0 +1,135 @@
+'''
+Логотипы и подписи, приведённые к размеру своей рамки: пересэмплирование до DPI профиля,
+однократное сведение альфа-канала на фон и компактное перекодирование.
+Готовый XObject кэшируется по хэшу содержимого, рамке и профилю и вставляется в документ без пересжатия
+'''
+
+import base64
+import copy
+import hashlib
+import os
+import zlib
+from functools import lru_cache
+from io import BytesIO
+from typing import NamedTuple, Optional, Tuple
+from reportlab.lib.colors import Color
+from reportlab.pdfbase import pdfdoc
+from assets import asset_store, is_asset_id
+from cache import LRUCache
+from compression import OutputProfile, active_profile
+from fetch import fetcher, is_remote
+
+IMAGE_CACHE_BYTES = int(os.environ.get('IMAGE_CACHE_BYTES', str(32 * 1024 * 1024)))
+PALETTE_COLORS = 256
+
+image_cache = LRUCache(IMAGE_CACHE_BYTES)
+
+class ImageBox(NamedTuple):
+    width: float
+    height: float
+    background: Color
+
+class CachedImage(NamedTuple):
+    name: str
+    xobject: pdfdoc.PDFImageXObject
+    width: float
+    height: float
+
+@lru_cache(maxsize=4)
+def image_key(data: str) -> str:
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def _read_bytes(data: str) -> Optional[bytes]:
+    if is_asset_id(data):
+        return asset_store.get(data)
+    if data.startswith('data:image'):
+        return base64.b64decode(data.split(',')[1])
+    if is_remote(data):
+        # Скачанные байты лежат в кэше рядом с нормализованными версиями: новая рамка или профиль не качает заново
+        img_bytes = image_cache.get(image_key(data))
+        if img_bytes is None:
+            img_bytes = fetcher.get(data)
+            image_cache.put(image_key(data), img_bytes, len(img_bytes))
+        return img_bytes
+    return base64.b64decode(data)
+
+def prefetch_images(*sources: Optional[str]) -> None:
+    for data in sources:
+        if is_remote(data) and image_key(data) not in image_cache:
+            fetcher.prefetch(data)
+
+def fit_box(iw: int, ih: int, box: ImageBox) -> Tuple[float, float]:
+    scale = min(box.width / iw, box.height / ih)
+    return iw * scale, ih * scale
+
+def _background(color: Color) -> Tuple[int, int, int]:
+    return tuple(int(round(channel * 255)) for channel in color.rgb())
+
+def _xobject(name: str, image, stream: bytes, image_filter: str) -> pdfdoc.PDFImageXObject:
+    xobject = pdfdoc.PDFImageXObject(name)
+    xobject.name = name
+    xobject.width, xobject.height = image.size
+    xobject.colorSpace = 'DeviceGray' if image.mode == 'L' else 'DeviceRGB'
+    xobject.bitsPerComponent = 8
+    xobject._filters = (image_filter,)
+    xobject.streamContent = stream
+    xobject.mask = None
+    return xobject
+
+def normalize_image(name: str, img_bytes: bytes, box: ImageBox, profile: OutputProfile) -> CachedImage:
+    from PIL import Image
+    image = Image.open(BytesIO(img_bytes))
+    image.load()
+    width, height = fit_box(image.width, image.height, box)
+    target = (max(1, round(width / 72 * profile.image_dpi)), max(1, round(height / 72 * profile.image_dpi)))
+
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        rgba = image.convert('RGBA')
+        image = Image.new('RGB', rgba.size, _background(box.background))
+        image.paste(rgba, mask=rgba.getchannel('A'))
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    lossless = image.getcolors(PALETTE_COLORS) is not None
+    if target[0] < image.width:
+        image = image.resize(target, Image.LANCZOS)
+
+    if lossless:
+        xobject = _xobject(name, image, zlib.compress(image.tobytes(), profile.zlib_level), 'FlateDecode')
+    else:
+        buffer = BytesIO()
+        image.save(buffer, 'JPEG', quality=profile.jpeg_quality, optimize=True)
+        xobject = _xobject(name, image, buffer.getvalue(), 'DCTDecode')
+    return CachedImage(name, xobject, width, height)
+
+def load_image(data: str, box: ImageBox) -> Optional[CachedImage]:
+    profile = active_profile()
+    key = f'{image_key(data)}:{box.width:.2f}x{box.height:.2f}:{profile.name}'
+    cached = image_cache.get(key)
+    if cached is not None:
+        if is_remote(data):
+            fetcher.discard(data)
+        return cached
+
+    img_bytes = _read_bytes(data)
+    if not img_bytes:
+        return None
+
+    name = hashlib.sha1(key.encode('ascii')).hexdigest()
+    image = normalize_image(name, img_bytes, box, profile)
+    image_cache.put(key, image, len(image.xobject.streamContent))
+    return image
+
+def place_image(c, image: CachedImage, x: float, y: float) -> None:
+    doc = c._doc
+    reg_name = doc.getXObjectName(image.name)
+    if reg_name not in doc.idToObject:
+        xobject = copy.copy(image.xobject)
+        doc.Reference(xobject, reg_name)
+        doc.addForm(image.name, xobject)
+    c._currentPageHasImages = 1
+    c.saveState()
+    c.translate(x, y)
+    c.scale(image.width, image.height)
+    c._code.append(f'/{reg_name} Do')
+    c.restoreState()
+    c._formsinuse.append(image.name)
@@ -1,146 +1,128 @@
 '''
 Business: Генерирует PDF документы с реквизитами самозанятого на русском языке
-Args: event с httpMethod и queryStringParameters (type: loan/consent/refund)
+Args: event с httpMethod и queryStringParameters (type: loan/consent/refund/bundle)
 Returns: PDF файл для скачивания с поддержкой кириллицы
 '''
 
 import json
-from typing import Dict, Any
+import os
+import sys
+from typing import Dict, Any, List, Tuple
+from reportlab.lib.colors import HexColor
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import mm
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from io import BytesIO
 import base64
-import urllib.request
+from datetime import timezone
+import hashlib
+from fonts import FREEZE_FONTS, freeze_fonts, load_fonts, fonts_ready, get_font_name
+from assets import AssetError, asset_store, image_size, is_asset_id, parse_upload
+from cache import LRUCache
+from clock import DateNotAllowed, is_deterministic, now, request_moment, use_clock
+from compression import OutputProfile, get_profile, use_profile
+from fastpdf import FastCanvas, FastUnsupported, compile_skeleton, font_program, font_programs, image_objects
+from fetch import fetcher
+from images import CachedImage, ImageBox, image_cache, image_key, load_image, place_image, prefetch_images
+from jobs import QueueFull, job_queue
+from output import binary_body
+from layout import BLOCK_ORIGIN, PAGE_BOTTOM, layout, render
+from skeletons import Skeleton, begin_skeleton, get_skeleton, skeleton_cache, stamp
+from stamping import StampOverflow, condition_flags, fill_stamp, get_stamp, sentinel_contexts, stamps
+from templates import CLIENT_FIELDS, Placed, Template, TemplateError, build_context, expand, registry
+from timing import dump_profile, log_request, stage, start_profile, start_timing, stop_timing
 
-def register_fonts():
-    try:
-        url = "https://github.com/google/fonts/raw/main/ofl/opensans/OpenSans%5Bwdth%2Cwght%5D.ttf"
-        response = urllib.request.urlopen(url)
-        font_data = response.read()
-        
-        font_file = BytesIO(font_data)
-        pdfmetrics.registerFont(TTFont('OpenSans', font_file))
-        return True
-    except:
-        return False
+SKELETONS_ENABLED = os.environ.get('PDF_SKELETONS', '1') != '0'
+PDF_CACHE_BYTES = int(os.environ.get('PDF_CACHE_BYTES', str(64 * 1024 * 1024)))
 
-def draw_logo(c, logo_data: str, x: float, y: float, max_width: float = 30*mm, max_height: float = 15*mm):
-    try:
-        from reportlab.lib.utils import ImageReader
-        if logo_data.startswith('data:image'):
-            logo_data = logo_data.split(',')[1]
-        
-        img_bytes = base64.b64decode(logo_data)
-        img = ImageReader(BytesIO(img_bytes))
-        
-        iw, ih = img.getSize()
-        aspect = ih / float(iw)
-        
-        if iw > max_width / (1/72*25.4):
-            iw = max_width / (1/72*25.4)
-            ih = iw * aspect
-        
-        if ih > max_height / (1/72*25.4):
-            ih = max_height / (1/72*25.4)
-            iw = ih / aspect
-        
-        c.drawImage(img, x, y, width=iw*72/25.4*mm, height=ih*72/25.4*mm, mask='auto')
-    except:
-        pass
+WARM_ON_IMPORT = os.environ.get('PDF_WARM_ON_IMPORT', '1') != '0'
+PDF_AUTHOR = os.environ.get('PDF_AUTHOR', 'generate-pdf')
+PDF_ENGINE = os.environ.get('PDF_ENGINE', 'reportlab')
 
-def draw_signature(c, sig_data: str, x: float, y: float, max_width: float = 40*mm, max_height: float = 15*mm):
-    try:
-        from reportlab.lib.utils import ImageReader
-        if sig_data.startswith('data:image') or sig_data.startswith('http'):
-            if sig_data.startswith('data:image'):
-                sig_data = sig_data.split(',')[1]
-                img_bytes = base64.b64decode(sig_data)
-            else:
-                import urllib.request
-                response = urllib.request.urlopen(sig_data)
-                img_bytes = response.read()
-            
-            img = ImageReader(BytesIO(img_bytes))
-            
-            iw, ih = img.getSize()
-            aspect = ih / float(iw)
-            
-            if iw > max_width / (1/72*25.4):
-                iw = max_width / (1/72*25.4)
-                ih = iw * aspect
-            
-            if ih > max_height / (1/72*25.4):
-                ih = max_height / (1/72*25.4)
-                iw = ih / aspect
-            
-            c.drawImage(img, x, y, width=iw*72/25.4*mm, height=ih*72/25.4*mm, mask='auto')
-    except:
-        pass
+ENGINES = ('reportlab', 'fast', 'stamp')
+
+pdf_cache = LRUCache(PDF_CACHE_BYTES)
+
+BLUE_DARK = HexColor('#1e40af')
+BLUE_LIGHT = HexColor('#3b82f6')
+BLUE_LIGHTER = HexColor('#60a5fa')
+BLUE_BG = HexColor('#f0f9ff')
+GOLD = HexColor('#fbbf24')
+GREEN = HexColor('#10b981')
+WHITE = HexColor('#ffffff')
+GRAY = HexColor('#6b7280')
+TEXT_COLOR = HexColor('#374151')
+
+def draw_image(c, image: CachedImage, x: float, y: float):
+    if isinstance(c, FastCanvas):
+        c.draw_cached_image(image, x, y)
+    else:
+        place_image(c, image, x, y)
+
+LOGO_BOX = ImageBox(30*mm, 15*mm, BLUE_BG)
+SIGNATURE_BOX = ImageBox(40*mm, 15*mm, WHITE)
+
+def draw_logo(c, logo_data: str, x: float, y: float, box: ImageBox = LOGO_BOX):
+    with stage('image'):
+        try:
+            image = load_image(logo_data, box)
+            if image:
+                draw_image(c, image, x, y)
+        except:
+            pass
+
+def draw_signature(c, sig_data: str, x: float, y: float, box: ImageBox = SIGNATURE_BOX):
+    with stage('image'):
+        try:
+            image = load_image(sig_data, box)
+            if image:
+                draw_image(c, image, x, y)
+        except:
+            pass
 
 def draw_text_signature(c, x: float, y: float, font_name: str = 'Helvetica'):
-    from reportlab.lib.colors import HexColor
-    blue_dark = HexColor('#1e40af')
     
-    c.setFillColor(blue_dark)
+    c.setFillColor(BLUE_DARK)
     c.setFont('Helvetica-BoldOblique', 16)
     c.drawString(x, y, "Малик С.В.")
 
 def draw_header_decoration(c, width, height):
-    from reportlab.lib.colors import HexColor
-    blue_light = HexColor('#3b82f6')
-    blue_bg = HexColor('#f0f9ff')
     
-    c.setFillColor(blue_bg)
+    c.setFillColor(BLUE_BG)
     c.rect(0, height - 50*mm, width, 50*mm, fill=1, stroke=0)
     
-    c.setStrokeColor(blue_light)
+    c.setStrokeColor(BLUE_LIGHT)
     c.setLineWidth(2)
     c.line(30*mm, height - 48*mm, width - 30*mm, height - 48*mm)
 
 def draw_document_icon(c, x, y):
-    from reportlab.lib.colors import HexColor
-    blue_dark = HexColor('#1e40af')
-    blue_light = HexColor('#3b82f6')
-    blue_lighter = HexColor('#60a5fa')
-    gold = HexColor('#fbbf24')
-    white = HexColor('#ffffff')
-    
-    c.setFillColor(blue_lighter)
+    
+    c.setFillColor(BLUE_LIGHTER)
     c.circle(x + 10*mm, y + 12*mm, 18*mm, fill=1, stroke=0)
     
-    c.setStrokeColor(blue_dark)
-    c.setFillColor(white)
+    c.setStrokeColor(BLUE_DARK)
+    c.setFillColor(WHITE)
     c.setLineWidth(2)
     c.rect(x + 2*mm, y + 2*mm, 16*mm, 20*mm, fill=1, stroke=1)
     
-    c.setFillColor(blue_light)
+    c.setFillColor(BLUE_LIGHT)
     c.rect(x + 4*mm, y + 16*mm, 12*mm, 2*mm, fill=1, stroke=0)
     c.rect(x + 4*mm, y + 12*mm, 12*mm, 2*mm, fill=1, stroke=0)
     c.rect(x + 4*mm, y + 8*mm, 8*mm, 2*mm, fill=1, stroke=0)
     
-    c.setFillColor(gold)
+    c.setFillColor(GOLD)
     c.circle(x + 15*mm, y + 20*mm, 3*mm, fill=1, stroke=0)
     
-    c.setFillColor(white)
+    c.setFillColor(WHITE)
     c.setFont('Helvetica-Bold', 12)
     c.drawString(x + 13*mm, y + 18*mm, '₽')
 
 def draw_shield_icon(c, x, y):
-    from reportlab.lib.colors import HexColor
-    blue_dark = HexColor('#1e40af')
-    blue_light = HexColor('#3b82f6')
-    blue_lighter = HexColor('#60a5fa')
-    green = HexColor('#10b981')
-    white = HexColor('#ffffff')
-    
-    c.setFillColor(blue_lighter)
+    
+    c.setFillColor(BLUE_LIGHTER)
     c.circle(x + 10*mm, y + 12*mm, 18*mm, fill=1, stroke=0)
     
-    c.setStrokeColor(blue_dark)
-    c.setFillColor(blue_light)
+    c.setStrokeColor(BLUE_DARK)
+    c.setFillColor(BLUE_LIGHT)
     c.setLineWidth(2)
     
     points = [
@@ -159,495 +141,553 @@ def draw_shield_icon(c, x, y):
     path.close()
     c.drawPath(path, fill=1, stroke=1)
     
-    c.setFillColor(white)
+    c.setFillColor(WHITE)
     c.setLineWidth(3)
-    c.setStrokeColor(white)
+    c.setStrokeColor(WHITE)
     c.line(x + 5*mm, y + 12*mm, x + 8*mm, y + 9*mm)
     c.line(x + 8*mm, y + 9*mm, x + 15*mm, y + 17*mm)
 
 def draw_money_icon(c, x, y):
-    from reportlab.lib.colors import HexColor
-    blue_dark = HexColor('#1e40af')
-    blue_light = HexColor('#3b82f6')
-    blue_lighter = HexColor('#60a5fa')
-    gold = HexColor('#fbbf24')
-    green = HexColor('#10b981')
-    white = HexColor('#ffffff')
-    
-    c.setFillColor(blue_lighter)
+    
+    c.setFillColor(BLUE_LIGHTER)
     c.circle(x + 10*mm, y + 12*mm, 18*mm, fill=1, stroke=0)
     
-    c.setStrokeColor(blue_dark)
-    c.setFillColor(green)
+    c.setStrokeColor(BLUE_DARK)
+    c.setFillColor(GREEN)
     c.setLineWidth(2)
     c.roundRect(x + 2*mm, y + 8*mm, 16*mm, 10*mm, 2*mm, fill=1, stroke=1)
     
-    c.setFillColor(gold)
+    c.setFillColor(GOLD)
     c.circle(x + 10*mm, y + 13*mm, 4*mm, fill=1, stroke=0)
     
-    c.setFillColor(white)
+    c.setFillColor(WHITE)
     c.setFont('Helvetica-Bold', 14)
     c.drawString(x + 7.5*mm, y + 11*mm, '₽')
     
-    c.setFillColor(blue_light)
+    c.setFillColor(BLUE_LIGHT)
     c.circle(x + 4*mm, y + 16*mm, 1.5*mm, fill=1, stroke=0)
     c.circle(x + 16*mm, y + 10*mm, 1.5*mm, fill=1, stroke=0)
 
-def create_loan_agreement(logo: str = None, signature: str = None, client_data: Dict[str, str] = None) -> bytes:
-    from reportlab.lib.colors import HexColor
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
+def draw_block_part(c, lines, font_name: str):
+    ops, _ = layout(lines, BLOCK_ORIGIN, font_name)
+    render(c, ops, font_name)
+
+def draw_footer_rule(c):
     width, height = A4
+    c.setStrokeColor(BLUE_LIGHT)
+    c.setLineWidth(1)
+    c.line(30*mm, 25*mm, width - 30*mm, 25*mm)
+
+SCHEDULE_COLUMNS = (
+    ('День', 40*mm, 'drawRightString'),
+    ('Дата', 47*mm, 'drawString'),
+    ('Начислено, ₽', 105*mm, 'drawRightString'),
+    ('Проценты всего, ₽', 142*mm, 'drawRightString'),
+    ('К возврату, ₽', A4[0] - 30*mm, 'drawRightString')
+)
+SCHEDULE_ROW = 5*mm
+
+def draw_schedule(c, template: Template, context: Dict[str, str], font_name: str):
+    if not (template.schedule and context['totalAmount']):
+        return
+    from loans import loan_schedule
     
-    has_font = register_fonts()
-    font_name = 'OpenSans' if has_font else 'Helvetica'
-    
-    blue_dark = HexColor('#1e40af')
-    blue_text = HexColor('#1e3a8a')
-    gray_text = HexColor('#374151')
+    with stage('schedule'):
+        rows = loan_schedule(context['amount'], context['term'], template.daily_rate, now())
+    if not rows:
+        return
     
+    width, height = A4
+    top = height - 62*mm
+    per_page = int((top - PAGE_BOTTOM) // SCHEDULE_ROW)
+    count = (len(rows) + per_page - 1) // per_page
+    with stage('draw'):
+        for page in range(count):
+            c.showPage()
+            draw_header_decoration(c, width, height)
+            c.setFillColor(BLUE_DARK)
+            c.setFont(font_name, 16)
+            c.drawCentredString(width / 2, height - 20*mm, 'ГРАФИК НАЧИСЛЕНИЙ И ВОЗВРАТА')
+            c.setFillColor(GRAY)
+            c.setFont(font_name, 9)
+            c.drawCentredString(width / 2, height - 27*mm, f"Приложение к договору займа от {context['date']}")
+            c.drawString(30*mm, height - 40*mm, f"Сумма займа: {context['amount']} ₽, срок: {context['term']} дн.")
+            c.drawString(30*mm, height - 45*mm,
+                         f"К возврату: {context['totalAmount']} ₽ до {context['returnDate']}")
+            c.drawRightString(width - 30*mm, height - 45*mm, f'Страница {page + 1} из {count}')
+            
+            c.setFillColor(BLUE_DARK)
+            for title, x, method in SCHEDULE_COLUMNS:
+                getattr(c, method)(x, top, title)
+            c.setStrokeColor(BLUE_LIGHT)
+            c.setLineWidth(0.5)
+            c.line(30*mm, top - 2*mm, width - 30*mm, top - 2*mm)
+            
+            chunk = rows[page * per_page:(page + 1) * per_page]
+            c.setFillColor(BLUE_BG)
+            for index in range(0, len(chunk), 2):
+                c.rect(30*mm, top - (index + 1) * SCHEDULE_ROW - 1.5*mm, width - 60*mm, SCHEDULE_ROW, fill=1, stroke=0)
+            c.setFillColor(TEXT_COLOR)
+            for index, row in enumerate(chunk):
+                if page == count - 1 and index == len(chunk) - 1:
+                    c.setFillColor(GREEN)
+                y = top - (index + 1) * SCHEDULE_ROW
+                for text, (_, x, method) in zip(row, SCHEDULE_COLUMNS):
+                    getattr(c, method)(x, y, text)
+            draw_footer_rule(c)
+
+def draw_placed(c, lines: Tuple[Placed, ...], font_name: str, context: Dict[str, str] = None):
+    font = c._fontsize if c._fontname == font_name else None
+    fill = c._fillColorObj
+    for line in lines:
+        if fill != line.color:
+            c.setFillColor(line.color)
+            fill = line.color
+        if font != line.size:
+            c.setFont(font_name, line.size)
+            font = line.size
+        text = line.text.format_map(context) if line.dynamic else line.text
+        getattr(c, line.method)(line.x, line.y, text)
+    return font, fill
+
+def draw_header(c, template: Template, font_name: str):
+    width, height = A4
     draw_header_decoration(c, width, height)
-    
+    font, fill = draw_placed(c, template.header, font_name)
+    if font != 10:
+        c.setFont(font_name, 10)
+    if fill != TEXT_COLOR:
+        c.setFillColor(TEXT_COLOR)
+
+def skeleton_parts(pages: Tuple[Template, ...], font_name: str):
+    result = [('footer', draw_footer_rule)]
+    for template in pages:
+        result.append((f'{template.name}.header', lambda c, template=template: draw_header(c, template, font_name)))
+        for name, lines in template.blocks.items():
+            result.append((name, lambda c, lines=lines: draw_block_part(c, lines, font_name)))
+    return result
+
+def document_skeleton(pages: Tuple[Template, ...], font_name: str) -> Skeleton:
+    return get_skeleton((tuple((t.name, t.version) for t in pages), font_name), lambda: skeleton_parts(pages, font_name))
+
+def fast_skeleton(pages: Tuple[Template, ...], font_name: str, program) -> Skeleton:
+    return get_skeleton(('fast', tuple((t.name, t.version) for t in pages), program.key),
+                        lambda: skeleton_parts(pages, font_name), compile_skeleton(program))
+
+def prepare_skeleton(c, pages: Tuple[Template, ...], font_name: str) -> Skeleton:
+    if SKELETONS_ENABLED:
+        skeleton = document_skeleton(pages, font_name)
+        if begin_skeleton(c, skeleton):
+            return skeleton
+    return None
+
+def start_document(c, template: Template, font_name: str, skeleton: Skeleton = None):
+    if skeleton:
+        stamp(c, skeleton, f'{template.name}.header')
+    else:
+        draw_header(c, template, font_name)
+
+def draw_body(c, text_lines, y: float, font_name: str, skeleton: Skeleton = None, logo: str = None,
+              blocks: Dict[str, Any] = None):
+    with stage('layout'):
+        ops, _ = layout(text_lines, y, font_name, blocks)
     if logo:
+        width, height = A4
         draw_logo(c, logo, width - 60*mm, height - 20*mm)
-    
-    y = height - 20*mm
-    c.setFillColor(blue_dark)
-    c.setFont(font_name, 22)
-    c.drawString(30*mm, y, "ДОГОВОР ЗАЙМА")
-    
-    from reportlab.lib.colors import HexColor
-    c.setFillColor(HexColor('#6b7280'))
-    c.setFont(font_name, 9)
-    y -= 5*mm
-    c.drawString(30*mm, y, "Официальный документ | Защищено законодательством РФ")
-    
-    from datetime import datetime
-    current_date = datetime.now()
-    date_str = current_date.strftime('%d.%m.%Y')
-    day = current_date.strftime('%d')
-    month_names = ['января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 
-                   'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря']
-    month = month_names[current_date.month - 1]
-    year = current_date.strftime('%Y')
-    
-    y = height - 50*mm
-    c.setFillColor(gray_text)
-    c.setFont(font_name, 10)
-    c.drawString(30*mm, y, "г. Москва")
-    c.drawRightString(width - 30*mm, y, f"«{day}» {month} {year} г.")
-    y -= 12*mm
-    
-    c.setFont(font_name, 10)
-    c.setFillColor(gray_text)
-    
-    if not client_data:
-        client_data = {}
-    
-    full_name = client_data.get('fullName', '________________________________')
-    birth_date = client_data.get('birthDate', '__.__.____ г.р.')
-    if birth_date and birth_date != '__.__.____ г.р.' and '-' in birth_date:
-        parts = birth_date.split('-')
-        birth_date = f"{parts[2]}.{parts[1]}.{parts[0]} г.р."
-    
-    passport = f"{client_data.get('passportSeries', '____')} {client_data.get('passportNumber', '______')}"
-    amount = client_data.get('amount', '_____________')
-    term = client_data.get('term', '__')
-    phone = client_data.get('phone', '_________________')
-    email = client_data.get('email', '_________________')
-    
-    from datetime import datetime, timedelta
-    if term and term != '__':
-        try:
-            return_date = datetime.now() + timedelta(days=int(term))
-            return_date_str = return_date.strftime('%d.%m.%Y')
-        except:
-            return_date_str = '«__» __________ 20__ г.'
+    with stage('draw'):
+        render(c, ops, font_name, skeleton, blocks)
+
+def finish_document(c, skeleton: Skeleton, signature: str = None, font_name: str = 'Helvetica'):
+    if skeleton:
+        stamp(c, skeleton, 'footer')
     else:
-        return_date_str = '«__» __________ 20__ г.'
-    
-    interest_amount = ''
-    total_amount = ''
-    if amount and amount != '_____________' and term and term != '__':
-        try:
-            loan_amount = float(amount)
-            loan_days = int(term)
-            interest = loan_amount * loan_days * 0.01
-            total = loan_amount + interest
-            interest_amount = f"{interest:,.2f}".replace(',', ' ')
-            total_amount = f"{total:,.2f}".replace(',', ' ')
-        except:
-            pass
-    
-    text_lines = [
-        ("normal", "Самозанятый Малик Степан Владимирович, ИНН 503303222876,"),
-        ("normal", "именуемый в дальнейшем «Займодавец», с одной стороны, и"),
-        ("normal", f"{full_name}, именуемый в дальнейшем «Заемщик»,"),
-        ("normal", f"паспорт {passport}, дата рождения {birth_date},"),
-        ("normal", "с другой стороны, заключили настоящий договор о нижеследующем:"),
-        ("space", ""),
-        ("header", "1. ПРЕДМЕТ ДОГОВОРА"),
-        ("space", ""),
-        ("normal", "1.1. Займодавец передает в собственность Заемщику денежные средства"),
-        ("normal", f"в сумме {amount} рублей (заем), а Заемщик обязуется вернуть"),
-        ("normal", "заем и уплатить проценты на него в сроке и в порядке, которые"),
-        ("normal", "предусмотрены настоящим договором."),
-        ("space", ""),
-        ("header", "2. УСЛОВИЯ ЗАЙМА"),
-        ("space", ""),
-        ("normal", f"2.1. Сумма займа: {amount} рублей."),
-        ("normal", f"2.2. Срок возврата займа: до {return_date_str}."),
-        ("normal", f"2.3. Срок займа: {term} дней."),
-        ("normal", "2.4. Проценты за пользование займом: 1% в день."),
-    ]
-    
-    if interest_amount and total_amount:
-        text_lines.extend([
-            ("normal", f"2.5. Сумма процентов за весь период: {interest_amount} рублей."),
-            ("space", ""),
-            ("highlight", f"💰 ИТОГО К ВОЗВРАТУ: {total_amount} рублей"),
-            ("space", ""),
-        ])
-    
-    text_lines.extend([
-        ("space", ""),
-        ("header", "3. КОНТАКТНЫЕ ДАННЫЕ ЗАЙМОДАВЦА"),
-        ("space", ""),
-        ("contact", "Адрес: г. Москва, улица маршала Жукова, дом 53, офис 183"),
-        ("contact", "Телефон: +7 (499) 273-38-29"),
-        ("contact", "ИНН: 503303222876"),
-        ("space", ""),
-        ("header", "4. КОНТАКТНЫЕ ДАННЫЕ ЗАЕМЩИКА"),
-        ("space", ""),
-        ("contact", f"ФИО: {full_name}"),
-        ("contact", f"Паспорт: {passport}"),
-        ("contact", f"Дата рождения: {birth_date}"),
-        ("contact", f"Телефон: {phone}"),
-        ("contact", f"Email: {email}"),
-        ("space", ""),
-        ("header", "5. ПРАВА И ОБЯЗАННОСТИ СТОРОН"),
-        ("space", ""),
-        ("normal", "5.1. Займодавец обязуется передать сумму займа в срок,"),
-        ("normal", "указанный в п. 1.1 настоящего договора."),
-        ("space", ""),
-        ("normal", "5.2. Заемщик обязуется:"),
-        ("normal", "  • вернуть полученные денежные средства в установленный срок;"),
-        ("normal", "  • уплатить проценты за пользование займом."),
-        ("space", ""),
-        ("header", "6. ПОДПИСИ СТОРОН"),
-        ("space", ""),
-        ("normal", "Займодавец: " + ("" if signature else "_________________") + " / Малик С.В. /"),
-        ("normal", f"Дата подписания: {date_str}"),
-        ("space", ""),
-        ("normal", f"Заемщик: _________________ / {full_name} /"),
-        ("normal", f"Дата подписания: {date_str}")
-    ])
-    
-    for line_type, line in text_lines:
-        if y < 30*mm:
-            c.showPage()
-            y = height - 30*mm
-        
-        if line_type == "header":
-            c.setFont(font_name, 11)
-            c.setFillColor(blue_text)
-            c.drawString(30*mm, y, line)
-            c.setFont(font_name, 10)
-            c.setFillColor(gray_text)
-            y -= 6*mm
-        elif line_type == "highlight":
-            c.setFillColor(HexColor('#10b981'))
-            c.roundRect(28*mm, y - 3*mm, width - 56*mm, 8*mm, 2*mm, fill=1, stroke=0)
-            c.setFillColor(HexColor('#ffffff'))
-            c.setFont(font_name, 12)
-            c.drawString(32*mm, y, line)
-            c.setFont(font_name, 10)
-            c.setFillColor(gray_text)
-            y -= 10*mm
-        elif line_type == "contact":
-            c.setFillColor(blue_dark)
-            c.drawString(30*mm, y, line)
-            c.setFillColor(gray_text)
-            y -= 5*mm
-        elif line_type == "space":
-            y -= 3*mm
-        else:
-            c.drawString(30*mm, y, line)
-            y -= 5*mm
-    
-    c.setStrokeColor(HexColor('#3b82f6'))
-    c.setLineWidth(1)
-    c.line(30*mm, 25*mm, width - 30*mm, 25*mm)
+        draw_footer_rule(c)
     
     if signature:
         draw_signature(c, signature, 45*mm, 32*mm)
     else:
         draw_text_signature(c, 45*mm, 35*mm, font_name)
-    
-    c.save()
-    buffer.seek(0)
-    return buffer.getvalue()
 
-def create_consent_form(logo: str = None, signature: str = None, client_data: Dict[str, str] = None) -> bytes:
-    from reportlab.lib.colors import HexColor
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
-    
-    has_font = register_fonts()
-    font_name = 'OpenSans' if has_font else 'Helvetica'
-    
-    blue_dark = HexColor('#1e40af')
-    blue_text = HexColor('#1e3a8a')
-    gray_text = HexColor('#374151')
-    
-    draw_header_decoration(c, width, height)
+def draw_document(c, template: Template, logo: str, signature: str, client_data: Dict[str, str], font_name: str,
+                  skeleton: Skeleton = None, context: Dict[str, str] = None):
+    start_document(c, template, font_name, skeleton)
+    if context is None:
+        context = build_context(template, client_data, signature)
+    if template.overlay:
+        draw_placed(c, template.overlay, font_name, context)
+    draw_body(c, expand(template.body, context), template.body_top, font_name, skeleton, logo, template.blocks)
+    finish_document(c, skeleton, signature, font_name)
+    draw_schedule(c, template, context, font_name)
+
+def make_reproducible(c, title: str, digest: str):
+    c.setTitle(title)
+    c.setAuthor(PDF_AUTHOR)
+    c.setCreator(PDF_AUTHOR)
+    c.setProducer(PDF_AUTHOR)
+    c._doc._timeStamp.YMDhms = now().timetuple()[:3] + (0, 0, 0)
+    c._doc.signature.update(digest.encode('ascii'))
+
+def render_fast(doc_type: str, pages: Tuple[Template, ...], logo: str, signature: str, client_data: Dict[str, str],
+                output_profile: OutputProfile, profile: str, deterministic: bool) -> bytes:
+    font_name = get_font_name()
+    with use_profile(output_profile):
+        with stage('skeleton'):
+            program = font_program(font_name, pages, output_profile)
+            skeleton = fast_skeleton(pages, font_name, program) if SKELETONS_ENABLED else None
+        
+        c = FastCanvas(program, skeleton)
+        for position, template in enumerate(pages):
+            if position:
+                c.showPage()
+            draw_document(c, template, logo, signature, client_data, font_name, skeleton)
+        
+        with stage('save'):
+            moment = now()
+            if deterministic:
+                return c.getpdfdata(output_profile, registry.get(doc_type).title, PDF_AUTHOR,
+                                    moment.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc),
+                                    input_digest(doc_type, logo, signature, client_data or {}, profile, 'fast'))
+            return c.getpdfdata(output_profile, registry.get(doc_type).title, PDF_AUTHOR, moment)
+
+def draw_stamp(c, pages: Tuple[Template, ...], logo: str, signature: str, font_name: str, flags):
+    for position, context in enumerate(sentinel_contexts(pages, flags, font_name)):
+        if position:
+            c.showPage()
+        draw_document(c, pages[position], logo, signature, None, font_name, context=context)
+        c.end_document()
+
+def schedule_appendix(program, pages: Tuple[Template, ...], contexts, font_name: str) -> Dict[int, List[str]]:
+    appendix = {}
+    for position, (template, context) in enumerate(zip(pages, contexts)):
+        c = FastCanvas(program)
+        draw_schedule(c, template, context, font_name)
+        if not c._code:
+            continue
+        c.showPage()
+        if c.fonts or c.images:
+            raise StampOverflow(f'{template.name}: schedule needs resources outside the stamp')
+        # Первый showPage графика закрывает пустую страницу нового холста
+        appendix[position] = [content for content, _ in c.pages[1:]]
+    return appendix
+
+def render_stamped(doc_type: str, pages: Tuple[Template, ...], logo: str, signature: str, client_data: Dict[str, str],
+                   output_profile: OutputProfile, profile: str, deterministic: bool) -> bytes:
+    font_name = get_font_name()
+    with use_profile(output_profile):
+        contexts = [build_context(template, client_data, signature) for template in pages]
+        with stage('skeleton'):
+            program = font_program(font_name, pages, output_profile)
+            flags = condition_flags(pages, contexts)
+            key = (tuple((t.name, t.version) for t in pages), program.key, output_profile, flags,
+                   image_key(logo) if logo else '', image_key(signature) if signature else '')
+            prepared = get_stamp(key, program, output_profile,
+                                 lambda c: draw_stamp(c, pages, logo, signature, font_name, flags))
+        appendix = lambda: schedule_appendix(program, pages, contexts, font_name)
+        
+        with stage('save'):
+            moment = now()
+            if deterministic:
+                return fill_stamp(prepared, contexts, registry.get(doc_type).title, PDF_AUTHOR,
+                                  moment.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc),
+                                  input_digest(doc_type, logo, signature, client_data or {}, profile, 'stamp'),
+                                  appendix)
+            return fill_stamp(prepared, contexts, registry.get(doc_type).title, PDF_AUTHOR, moment,
+                              appendix=appendix)
+
+def render_documents(doc_type: str, logo: str = None, signature: str = None,
+                     client_data: Dict[str, str] = None, profile: str = None,
+                     deterministic: bool = False, engine: str = None) -> bytes:
+    pages = registry.pages(doc_type)
+    output_profile = get_profile(profile)
+    engine = engine or PDF_ENGINE
+    try:
+        if engine == 'stamp':
+            try:
+                return render_stamped(doc_type, pages, logo, signature, client_data, output_profile, profile,
+                                      deterministic)
+            except StampOverflow:
+                pass
+        if engine in ('fast', 'stamp'):
+            return render_fast(doc_type, pages, logo, signature, client_data, output_profile, profile, deterministic)
+    except FastUnsupported:
+        pass
+    c = canvas.Canvas(None, pagesize=A4, pageCompression=int(output_profile.page_compression),
+                      invariant=int(deterministic))
+    if deterministic:
+        make_reproducible(c, registry.get(doc_type).title,
+                          input_digest(doc_type, logo, signature, client_data or {}, profile, 'reportlab'))
+    font_name = get_font_name()
+    with use_profile(output_profile):
+        with stage('skeleton'):
+            skeleton = prepare_skeleton(c, pages, font_name)
+        
+        for position, template in enumerate(pages):
+            if position:
+                c.showPage()
+            draw_document(c, template, logo, signature, client_data, font_name, skeleton)
+        
+        with stage('save'):
+            return c.getpdfdata()
+
+def create_loan_agreement(logo: str = None, signature: str = None, client_data: Dict[str, str] = None,
+                          profile: str = None, deterministic: bool = False, engine: str = None) -> bytes:
+    return render_documents('loan', logo, signature, client_data, profile, deterministic, engine)
+
+def create_consent_form(logo: str = None, signature: str = None, client_data: Dict[str, str] = None,
+                        profile: str = None, deterministic: bool = False, engine: str = None) -> bytes:
+    return render_documents('consent', logo, signature, client_data, profile, deterministic, engine)
+
+def create_refund_policy(logo: str = None, signature: str = None, client_data: Dict[str, str] = None,
+                         profile: str = None, deterministic: bool = False, engine: str = None) -> bytes:
+    return render_documents('refund', logo, signature, client_data, profile, deterministic, engine)
+
+def create_client_package(logo: str = None, signature: str = None, client_data: Dict[str, str] = None,
+                          profile: str = None, deterministic: bool = False, engine: str = None) -> bytes:
+    return render_documents('bundle', logo, signature, client_data, profile, deterministic, engine)
+
+def warm_up() -> bool:
+    if not load_fonts():
+        return False
+    font_name = get_font_name()
+    for doc_type in registry.names():
+        try:
+            document_skeleton(registry.pages(doc_type), font_name)
+        except TemplateError:
+            continue
+    for doc_type in registry.names():
+        if registry.get(doc_type).documents:
+            try:
+                render_documents(doc_type)
+                if PDF_ENGINE != 'reportlab':
+                    render_documents(doc_type, engine=PDF_ENGINE)
+            except (TemplateError, StampOverflow, FastUnsupported) as e:
+                print(f'warm-up skipped {doc_type}: {e}', file=sys.stderr, flush=True)
+    if FREEZE_FONTS:
+        freeze_fonts()
+    return True
+
+def client_data_from(params: Dict[str, Any]) -> Dict[str, str]:
+    return {field: str(params.get(field) or '') for field in CLIENT_FIELDS}
+
+def input_digest(doc_type: str, logo: str, signature: str, client_data: Dict[str, str],
+                 profile: str = None, engine: str = None) -> str:
+    normalized = {
+        'type': doc_type,
+        'profile': get_profile(profile).name,
+        'logo': logo or '',
+        'signature': signature or '',
+        'client': {k: v for k, v in client_data.items() if v},
+        'date': now().strftime('%Y-%m-%d'),
+        'template': [template.version for template in registry.pages(doc_type)]
+    }
+    if (engine or PDF_ENGINE) != 'reportlab':
+        normalized['engine'] = engine or PDF_ENGINE
+    payload = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def document_cache_key(doc_type: str, logo: str, signature: str, client_data: Dict[str, str],
+                       profile: str = None, deterministic: bool = False, engine: str = None) -> str:
+    digest = input_digest(doc_type, logo, signature, client_data, profile, engine)
+    return f'd-{digest}' if deterministic else digest
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # If-None-Match сравнивает слабо: W/ у тега не учитывается
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    return opaque in [tag.strip()[2:] if tag.strip().startswith('W/') else tag.strip() for tag in if_none_match.split(',')]
+
+def handle_batch(event: Dict[str, Any], params: Dict[str, str]) -> Dict[str, Any]:
+    from batch import parse_batch, render_batch
     
-    if logo:
-        draw_logo(c, logo, width - 60*mm, height - 20*mm)
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
     
-    y = height - 20*mm
-    c.setFillColor(blue_dark)
-    c.setFont(font_name, 18)
-    c.drawString(30*mm, y, "СОГЛАСИЕ НА ОБРАБОТКУ")
-    y -= 6*mm
-    c.drawString(30*mm, y, "ПЕРСОНАЛЬНЫХ ДАННЫХ")
-    
-    from reportlab.lib.colors import HexColor
-    c.setFillColor(HexColor('#6b7280'))
-    c.setFont(font_name, 8)
-    y -= 4*mm
-    c.drawString(30*mm, y, "В соответствии с ФЗ-152 «О персональных данных»")
-    
-    y = height - 50*mm
-    c.setFont(font_name, 10)
-    c.setFillColor(gray_text)
-    
-    if not client_data:
-        client_data = {}
-    
-    full_name = client_data.get('fullName', '________________________________________')
-    phone = client_data.get('phone', '_________________')
-    email = client_data.get('email', '_________________')
-    
-    from datetime import datetime
-    current_date = datetime.now().strftime('%d.%m.%Y')
-    
-    text_lines = [
-        ("normal", f"Я, {full_name},"),
-        ("space", ""),
-        ("normal", "в соответствии с требованиями ст. 9 Федерального закона"),
-        ("normal", "от 27.07.2006 № 152-ФЗ «О персональных данных» даю согласие"),
-        ("normal", "самозанятому Малик Степану Владимировичу (ИНН 503303222876)"),
-        ("normal", "на обработку моих персональных данных."),
-        ("space", ""),
-        ("header", "Цель обработки персональных данных:"),
-        ("normal", "  • заключение и исполнение договоров"),
-        ("normal", "  • ведение бухгалтерского и налогового учета"),
-        ("normal", "  • информирование о новых услугах"),
-        ("space", ""),
-        ("header", "Перечень персональных данных:"),
-        ("normal", "  • фамилия, имя, отчество"),
-        ("normal", "  • дата рождения"),
-        ("normal", "  • адрес регистрации и фактического проживания"),
-        ("normal", "  • контактные телефоны"),
-        ("normal", "  • адрес электронной почты"),
-        ("normal", "  • паспортные данные"),
-        ("space", ""),
-        ("normal", "Согласие дается на период действия договорных отношений"),
-        ("normal", "и 5 (пять) лет после их окончания."),
-        ("space", ""),
-        ("header", "Контактные данные оператора:"),
-        ("contact", "ФИО: Малик Степан Владимирович"),
-        ("contact", "ИНН: 503303222876"),
-        ("contact", "Адрес: г. Москва, улица маршала Жукова, дом 53, офис 183"),
-        ("contact", "Телефон: +7 (499) 273-38-29"),
-        ("space", ""),
-        ("header", "Мои контактные данные:"),
-        ("contact", f"Телефон: {phone}"),
-        ("contact", f"Email: {email}"),
-        ("space", ""),
-        ("normal", f"Дата: {current_date}"),
-        ("space", ""),
-        ("normal", "Подпись: " + ("" if signature else "_________________") + f" / {full_name} /")
-    ]
+    try:
+        doc_type, logo, signature, records = parse_batch(body, params)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)})
+        }
     
-    for line_type, line in text_lines:
-        if y < 30*mm:
-            c.showPage()
-            y = height - 30*mm
-        
-        if line_type == "header":
-            c.setFont(font_name, 11)
-            c.setFillColor(blue_text)
-            c.drawString(30*mm, y, line)
-            c.setFont(font_name, 10)
-            c.setFillColor(gray_text)
-            y -= 6*mm
-        elif line_type == "contact":
-            c.setFillColor(blue_dark)
-            c.drawString(30*mm, y, line)
-            c.setFillColor(gray_text)
-            y -= 5*mm
-        elif line_type == "space":
-            y -= 3*mm
-        else:
-            c.drawString(30*mm, y, line)
-            y -= 5*mm
-    
-    c.setStrokeColor(HexColor('#3b82f6'))
-    c.setLineWidth(1)
-    c.line(30*mm, 25*mm, width - 30*mm, 25*mm)
+    template = registry.get(doc_type)
+    if template is None:
+        return {
+            'statusCode': 400,
+            'headers': {'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid document type'})
+        }
     
-    if signature:
-        draw_signature(c, signature, 45*mm, 32*mm)
-    else:
-        draw_text_signature(c, 45*mm, 35*mm, font_name)
+    filename = template.filename
+    archive, manifest = render_batch(doc_type, logo, signature, records, filename, params.get('output'),
+                                     is_deterministic(params), params.get('engine'))
+    errors = sum(1 for entry in manifest if 'error' in entry)
     
-    c.save()
-    buffer.seek(0)
-    return buffer.getvalue()
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/zip',
+            'Content-Disposition': 'attachment; filename="documents.zip"',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'X-Batch-Items, X-Batch-Errors',
+            'Cache-Control': 'no-store',
+            'X-Batch-Items': str(len(manifest)),
+            'X-Batch-Errors': str(errors)
+        },
+        **encode_body(event, archive)
+    }
 
-def create_refund_policy(logo: str = None, signature: str = None, client_data: Dict[str, str] = None) -> bytes:
-    from reportlab.lib.colors import HexColor
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
+def handle_loans(event: Dict[str, Any], params: Dict[str, str]) -> Dict[str, Any]:
+    from batch import parse_batch
+    from loans import LOANS_MAX_ITEMS, portfolio_report
     
-    has_font = register_fonts()
-    font_name = 'OpenSans' if has_font else 'Helvetica'
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
     
-    blue_dark = HexColor('#1e40af')
-    blue_text = HexColor('#1e3a8a')
-    gray_text = HexColor('#374151')
-    
-    draw_header_decoration(c, width, height)
+    try:
+        doc_type, _, _, records = parse_batch(body, params, LOANS_MAX_ITEMS)
+    except ValueError as e:
+        return json_response(400, {'error': str(e)})
+    if not all(isinstance(record, dict) for record in records):
+        return json_response(400, {'error': 'Client record must be an object'})
     
-    if logo:
-        draw_logo(c, logo, width - 60*mm, height - 20*mm)
+    try:
+        pages = registry.pages(doc_type)
+    except TemplateError:
+        return json_response(400, {'error': 'Invalid document type'})
+    rate = next((template.daily_rate for template in pages if template.daily_rate), 0.0)
+    
+    report = portfolio_report(records, rate, now())
+    return json_response(200, {'type': doc_type, 'date': now().strftime('%d.%m.%Y'), **report},
+                         {'Cache-Control': 'no-store'})
+
+def handle_asset_upload(event: Dict[str, Any], params: Dict[str, str]) -> Dict[str, Any]:
+    try:
+        data = parse_upload(event.get('body') or '', bool(event.get('isBase64Encoded')))
+        width, height = image_size(data)
+        asset_id = asset_store.put(data)
+    except AssetError as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)})
+        }
     
-    y = height - 20*mm
-    c.setFillColor(blue_dark)
-    c.setFont(font_name, 22)
-    c.drawString(30*mm, y, "ВОЗВРАТ ПЛАТЕЖЕЙ")
-    
-    from reportlab.lib.colors import HexColor
-    c.setFillColor(HexColor('#6b7280'))
-    c.setFont(font_name, 9)
-    y -= 5*mm
-    c.drawString(30*mm, y, "Политика возврата денежных средств")
-    
-    y = height - 50*mm
-    c.setFont(font_name, 10)
-    c.setFillColor(gray_text)
-    
-    if not client_data:
-        client_data = {}
-    
-    full_name = client_data.get('fullName', '')
-    phone = client_data.get('phone', '')
-    email = client_data.get('email', '')
-    
-    text_lines = [
-        ("contact", "Самозанятый: Малик Степан Владимирович"),
-        ("contact", "ИНН: 503303222876"),
-        ("contact", "Адрес: г. Москва, улица маршала Жукова, дом 53, офис 183"),
-        ("contact", "Телефон: +7 (499) 273-38-29"),
-        ("space", ""),
-    ]
+    with use_profile(get_profile(params.get('output'))):
+        for box in (LOGO_BOX, SIGNATURE_BOX):
+            load_image(asset_id, box)
     
-    if full_name:
-        text_lines.extend([
-            ("header", "ДАННЫЕ КЛИЕНТА:"),
-            ("contact", f"ФИО: {full_name}"),
-            ("contact", f"Телефон: {phone}"),
-            ("contact", f"Email: {email}"),
-        ])
-    
-    text_lines.extend([
-        ("space", ""),
-        ("header", "1. ОСНОВАНИЕ ДЛЯ ВОЗВРАТА"),
-        ("space", ""),
-        ("normal", "1.1. Возврат платежей осуществляется в следующих случаях:"),
-        ("normal", "  • ошибочного зачисления средств"),
-        ("normal", "  • ненадлежащего исполнения обязательств"),
-        ("normal", "  • в других случаях, предусмотренных законодательством РФ"),
-        ("space", ""),
-        ("header", "2. ПОРЯДОК ОФОРМЛЕНИЯ ВОЗВРАТА"),
-        ("space", ""),
-        ("normal", "2.1. Для оформления возврата необходимо:"),
-        ("normal", "  • написать заявление на возврат с указанием основания"),
-        ("normal", "  • приложить копии подтверждающих документов"),
-        ("normal", "  • указать реквизиты для перечисления средств"),
-        ("space", ""),
-        ("normal", "2.2. Заявление можно подать:"),
-        ("normal", "  • лично по адресу: г. Москва, ул. маршала Жукова, д. 53, оф. 183"),
-        ("normal", "  • по телефону: +7 (499) 273-38-29"),
-        ("space", ""),
-        ("header", "3. СРОКИ ВОЗВРАТА"),
-        ("space", ""),
-        ("normal", "3.1. Рассмотрение заявления: до 10 рабочих дней"),
-        ("normal", "3.2. Перечисление средств: до 10 рабочих дней после принятия"),
-        ("normal", "положительного решения"),
-        ("space", ""),
-        ("header", "4. СПОСОБЫ ВОЗВРАТА"),
-        ("space", ""),
-        ("normal", "4.1. Возврат осуществляется тем же способом, которым был"),
-        ("normal", "проведен платеж, если иное не предусмотрено законодательством"),
-        ("normal", "или соглашением сторон."),
-        ("space", ""),
-        ("normal", "4.2. По желанию заказчика возврат может быть осуществлен"),
-        ("normal", "на банковский счет при предоставлении соответствующих реквизитов."),
-        ("space", ""),
-        ("header", "5. ОТВЕТСТВЕННОСТЬ СТОРОН"),
-        ("space", ""),
-        ("normal", "5.1. За необоснованный отказ в возврате средств самозанятый"),
-        ("normal", "несет ответственность в соответствии с законодательством РФ."),
-        ("space", ""),
-        ("normal", "5.2. Заказчик несет ответственность за предоставление"),
-        ("normal", "недостоверной информации при оформлении заявления на возврат."),
-        ("space", ""),
-        ("space", ""),
-        ("normal", "Данные условия действуют с момента публикации и до их изменения.")
-    ])
-    
-    for line_type, line in text_lines:
-        if y < 30*mm:
-            c.showPage()
-            y = height - 30*mm
-        
-        if line_type == "header":
-            c.setFont(font_name, 11)
-            c.setFillColor(blue_text)
-            c.drawString(30*mm, y, line)
-            c.setFont(font_name, 10)
-            c.setFillColor(gray_text)
-            y -= 6*mm
-        elif line_type == "contact":
-            c.setFillColor(blue_dark)
-            c.drawString(30*mm, y, line)
-            c.setFillColor(gray_text)
-            y -= 5*mm
-        elif line_type == "space":
-            y -= 3*mm
-        else:
-            c.drawString(30*mm, y, line)
-            y -= 5*mm
-    
-    c.setStrokeColor(HexColor('#3b82f6'))
-    c.setLineWidth(1)
-    c.line(30*mm, 25*mm, width - 30*mm, 25*mm)
+    return {
+        'statusCode': 201,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({'id': asset_id, 'size': len(data), 'width': width, 'height': height})
+    }
+
+def cache_stats() -> Dict[str, Any]:
+    return {
+        'pdf': pdf_cache.stats(),
+        'images': image_cache.stats(),
+        'imageObjects': image_objects.stats(),
+        'stamps': stamps.stats(),
+        'skeletons': skeleton_cache.stats(),
+        'fontPrograms': font_programs.stats(),
+        'fetch': fetcher.stats()
+    }
+
+def json_response(status: int, payload: Dict[str, Any], headers: Dict[str, str] = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **(headers or {})},
+        'body': json.dumps(payload, ensure_ascii=False)
+    }
+
+def submit_job(event: Dict[str, Any], params: Dict[str, str], moment) -> Dict[str, Any]:
+    if event.get('httpMethod') != 'POST' and registry.get(params.get('type', 'loan')) is None:
+        return json_response(400, {'error': 'Invalid document type'})
     
-    if signature:
-        draw_signature(c, signature, 45*mm, 32*mm)
-    else:
-        draw_text_signature(c, 45*mm, 35*mm, font_name)
+    job_params = {k: v for k, v in params.items() if k != 'async'}
+    # Задание печатает дату приёма, а не выполнения; date= в параметрах без deterministic=1 не пропускается
+    job_event = dict(event, queryStringParameters=job_params, binary=True, moment=moment)
+    try:
+        job = job_queue.submit(job_event, lambda queued: handle_request(queued, None))
+    except QueueFull as e:
+        return json_response(503, {'error': str(e)}, {'Retry-After': '5'})
+    
+    return json_response(202, {
+        'id': job['id'],
+        'status': job['status'],
+        'queueDepth': job_queue.queued
+    }, {'Location': f"?job={job['id']}", 'Access-Control-Expose-Headers': 'Location'})
+
+def handle_job_status(event: Dict[str, Any], params: Dict[str, str]) -> Dict[str, Any]:
+    job_id = params['job']
+    job = job_queue.store.load(job_id)
+    if job is None:
+        return json_response(404, {'error': 'Unknown or expired job', 'job': job_id})
+    
+    headers = job.pop('headers', {})
+    if params.get('download') not in ('1', 'true', 'yes'):
+        return json_response(200, {**job, 'queueDepth': job_queue.queued})
+    
+    if job['status'] == 'failed':
+        return json_response(job.get('statusCode') or 500, {'error': job.get('error'), 'job': job_id})
+    result = job_queue.store.result(job_id) if job['status'] == 'done' else None
+    if result is None:
+        return json_response(202, {**job, 'queueDepth': job_queue.queued}, {'Retry-After': '1'})
     
-    c.save()
-    buffer.seek(0)
-    return buffer.getvalue()
+    return {
+        'statusCode': 200,
+        'headers': {
+            **headers,
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': ', '.join(name for name in headers if name.startswith(('ETag', 'X-'))),
+            'Cache-Control': 'no-store'
+        },
+        **encode_body(event, result)
+    }
+
+def encode_body(event: Dict[str, Any], data: bytes) -> Dict[str, Any]:
+    with stage('encode'):
+        return binary_body(event, data)
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    params = event.get('queryStringParameters') or {}
+    timings = start_timing()
+    profiler = start_profile(params)
+    try:
+        response = handle_request(event, context)
+    finally:
+        stop_timing()
+        if profiler:
+            doc_type = params.get('type', 'loan')
+            dump_profile(profiler, doc_type if registry.get(doc_type) else 'unknown')
+    
+    headers = response.setdefault('headers', {})
+    headers['Server-Timing'] = timings.header()
+    exposed = headers.get('Access-Control-Expose-Headers')
+    headers['Access-Control-Expose-Headers'] = f'{exposed}, Server-Timing' if exposed else 'Server-Timing'
+    log_request(
+        timings,
+        method=event.get('httpMethod', 'GET'),
+        type=params.get('type', 'loan'),
+        status=response['statusCode'],
+        cache=headers.get('X-Cache'),
+        profile=headers.get('X-PDF-Profile'),
+        size=int(headers.get('X-PDF-Size', 0)),
+        bytes=len(response.get('body') or '')
+    )
+    return response
+
+def handle_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -655,62 +695,158 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
-    if method != 'GET':
+    if method not in ('GET', 'POST'):
         return {
             'statusCode': 405,
             'headers': {'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Method not allowed'})
         }
     
-    params = event.get('queryStringParameters', {})
+    params = event.get('queryStringParameters') or {}
+    if params.get('job'):
+        return handle_job_status(event, params)
+    if params.get('action') == 'jobs':
+        return json_response(200, job_queue.stats())
+    if params.get('action') == 'templates':
+        return json_response(200, registry.describe())
+    if params.get('action') == 'caches':
+        return json_response(200, cache_stats())
+    
+    with stage('font'):
+        font_loaded = fonts_ready() or load_fonts()
+    if not font_loaded:
+        return {
+            'statusCode': 503,
+            'headers': {'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Cyrillic font is not available'})
+        }
+
+    profile = params.get('output')
+    if get_profile(profile) is None:
+        return {
+            'statusCode': 400,
+            'headers': {'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid output profile'})
+        }
+    
+    if (params.get('engine') or PDF_ENGINE) not in ENGINES:
+        return {
+            'statusCode': 400,
+            'headers': {'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f"Invalid engine, expected one of: {', '.join(ENGINES)}"})
+        }
+    
+    if method == 'POST' and params.get('action') == 'asset':
+        return handle_asset_upload(event, params)
+    
+    for asset_id in (params.get('logo'), params.get('signature')):
+        if is_asset_id(asset_id) and asset_id not in asset_store:
+            return {
+                'statusCode': 404,
+                'headers': {'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Unknown asset', 'asset': asset_id})
+            }
+    
+    try:
+        moment = event.get('moment') or request_moment(params)
+    except DateNotAllowed as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)})
+        }
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid date, expected YYYY-MM-DD'})
+        }
+    
+    # Скачивание начинается только для запроса, прошедшего проверки, и идёт параллельно с вёрсткой
+    prefetch_images(params.get('logo'), params.get('signature'))
+    
+    if str(params.get('async', '')).lower() in ('1', 'true', 'yes'):
+        return submit_job(event, params, moment)
+    
+    with use_clock(moment):
+        if method == 'POST' and params.get('action') == 'loans':
+            return handle_loans(event, params)
+        if method == 'POST':
+            return handle_batch(event, params)
+        return handle_document(event, params)
+
+def handle_document(event: Dict[str, Any], params: Dict[str, str]) -> Dict[str, Any]:
     doc_type = params.get('type', 'loan')
+    profile = params.get('output')
+    deterministic = is_deterministic(params)
+    engine = params.get('engine') or PDF_ENGINE
     logo = params.get('logo')
     signature = params.get('signature')
     
-    client_data = {
-        'fullName': params.get('fullName', ''),
-        'birthDate': params.get('birthDate', ''),
-        'passportSeries': params.get('passportSeries', ''),
-        'passportNumber': params.get('passportNumber', ''),
-        'amount': params.get('amount', ''),
-        'term': params.get('term', ''),
-        'phone': params.get('phone', ''),
-        'email': params.get('email', '')
-    }
+    client_data = client_data_from(params)
     
-    if doc_type == 'loan':
-        pdf_content = create_loan_agreement(logo, signature, client_data)
-        filename = 'dogovor-zajma.pdf'
-    elif doc_type == 'consent':
-        pdf_content = create_consent_form(logo, signature, client_data)
-        filename = 'soglasie-na-obrabotku-dannyh.pdf'
-    elif doc_type == 'refund':
-        pdf_content = create_refund_policy(logo, signature, client_data)
-        filename = 'vozvrat-platezhej.pdf'
-    else:
+    template = registry.get(doc_type)
+    if template is None:
         return {
             'statusCode': 400,
             'headers': {'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Invalid document type'})
         }
+    try:
+        registry.pages(doc_type)
+    except TemplateError as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)})
+        }
     
-    pdf_base64 = base64.b64encode(pdf_content).decode('utf-8')
+    filename = template.filename
+    cache_key = document_cache_key(doc_type, logo, signature, client_data, profile, deterministic, engine)
+    # Без детерминированного режима перерисовка после вытеснения из кэша даёт другие байты, поэтому тег слабый
+    etag = f'"{cache_key}"' if deterministic else f'W/"{cache_key}"'
+    response_headers = {
+        'Content-Type': 'application/pdf',
+        'Content-Disposition': f'inline; filename="{filename}"',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag, X-PDF-Profile, X-PDF-Size',
+        'Cache-Control': 'no-cache',
+        'ETag': etag,
+        'X-PDF-Profile': get_profile(profile).name
+    }
+    
+    request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    if etag_matches(request_headers.get('if-none-match', ''), etag):
+        return {
+            'statusCode': 304,
+            'headers': response_headers,
+            'body': ''
+        }
+    
+    pdf_content = pdf_cache.get(cache_key)
+    if pdf_content is None:
+        pdf_content = render_documents(doc_type, logo, signature, client_data, profile, deterministic, engine)
+        pdf_cache.put(cache_key, pdf_content, len(pdf_content))
+        response_headers['X-Cache'] = 'MISS'
+    else:
+        response_headers['X-Cache'] = 'HIT'
+    response_headers['X-PDF-Size'] = str(len(pdf_content))
+    if deterministic:
+        response_headers['X-PDF-SHA256'] = hashlib.sha256(pdf_content).hexdigest()
+        response_headers['Access-Control-Expose-Headers'] += ', X-PDF-SHA256'
     
     return {
         'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/pdf',
-            'Content-Disposition': f'inline; filename="{filename}"',
-            'Access-Control-Allow-Origin': '*',
-            'Cache-Control': 'no-cache'
-        },
-        'body': pdf_base64,
-        'isBase64Encoded': True
-    }
\ No newline at end of file
+        'headers': response_headers,
+        **encode_body(event, pdf_content)
+    }
+
+if WARM_ON_IMPORT:
+    warm_up()
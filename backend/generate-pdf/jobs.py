@@ -0,0 +1,216 @@
+'''
+Асинхронные задания: запрос ставится в очередь локального пула потоков и сразу получает ID,
+результат пишется на диск и живёт JOB_TTL секунд в пределах JOB_STORE_MAX_BYTES
+'''
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+JOB_DIR = os.environ.get('JOB_DIR', os.path.join(tempfile.gettempdir(), 'generate-pdf-jobs'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_MAX_QUEUE = int(os.environ.get('JOB_MAX_QUEUE', '256'))
+JOB_TTL = float(os.environ.get('JOB_TTL', '3600'))
+JOB_STORE_MAX_BYTES = int(os.environ.get('JOB_STORE_MAX_BYTES', str(256 * 1024 * 1024)))
+JOB_SWEEP_INTERVAL = float(os.environ.get('JOB_SWEEP_INTERVAL', '60'))
+
+JOB_ID = re.compile(r'^job_[0-9a-f]{32}$')
+
+# Заголовки ответа, которые сохраняются вместе с результатом и отдаются при скачивании
+KEPT_HEADERS = ('Content-Type', 'Content-Disposition', 'ETag', 'X-PDF-Profile', 'X-PDF-Size', 'X-PDF-SHA256',
+                'X-Batch-Items', 'X-Batch-Errors')
+
+Runner = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+class QueueFull(Exception):
+    pass
+
+def is_job_id(value: Optional[str]) -> bool:
+    return bool(value) and JOB_ID.match(value) is not None
+
+def _write_atomic(path: str, data: bytes) -> None:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class JobStore:
+    '''Статус задания в <id>.json, результат в <id>.bin; файлы видны всем воркерам сервера'''
+
+    def __init__(self, root: str = JOB_DIR, ttl: float = JOB_TTL, max_bytes: int = JOB_STORE_MAX_BYTES):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.expired = 0
+        self.evicted = 0
+        self._swept = 0.0
+        self._lock = threading.Lock()
+
+    def _meta_path(self, job_id: str) -> str:
+        return os.path.join(self.root, f'{job_id}.json')
+
+    def _result_path(self, job_id: str) -> str:
+        return os.path.join(self.root, f'{job_id}.bin')
+
+    def save(self, job: Dict[str, Any], result: Optional[bytes] = None) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        if result is not None:
+            _write_atomic(self._result_path(job['id']), result)
+        _write_atomic(self._meta_path(job['id']), json.dumps(job, ensure_ascii=False).encode('utf-8'))
+
+    def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        if not is_job_id(job_id):
+            return None
+        try:
+            with open(self._meta_path(job_id), 'rb') as f:
+                job = json.loads(f.read())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if job.get('finishedAt') and time.time() - job['finishedAt'] > self.ttl:
+            self.delete(job_id)
+            return None
+        return job
+
+    def result(self, job_id: str) -> Optional[bytes]:
+        try:
+            with open(self._result_path(job_id), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, job_id: str) -> None:
+        _remove(self._result_path(job_id))
+        _remove(self._meta_path(job_id))
+
+    def _entries(self) -> List[Tuple[float, str, int]]:
+        sizes: Dict[str, int] = {}
+        updated: Dict[str, float] = {}
+        if not os.path.isdir(self.root):
+            return []
+        for entry in os.scandir(self.root):
+            job_id, ext = os.path.splitext(entry.name)
+            if ext == '.bin':
+                sizes[job_id] = entry.stat().st_size
+            elif ext == '.json':
+                updated[job_id] = entry.stat().st_mtime
+        return [(mtime, job_id, sizes.get(job_id, 0)) for job_id, mtime in updated.items()]
+
+    def sweep(self, force: bool = False) -> None:
+        now = time.time()
+        with self._lock:
+            if not force and now - self._swept < JOB_SWEEP_INTERVAL:
+                return
+            self._swept = now
+        jobs = sorted(self._entries())
+        size = sum(nbytes for _, _, nbytes in jobs)
+        for updated, job_id, nbytes in jobs:
+            if now - updated > self.ttl:
+                self.expired += 1
+            elif size > self.max_bytes:
+                self.evicted += 1
+            else:
+                continue
+            self.delete(job_id)
+            size -= nbytes
+
+    def stats(self) -> Dict[str, int]:
+        jobs = self._entries()
+        return {'jobs': len(jobs), 'bytes': sum(nbytes for _, _, nbytes in jobs), 'maxBytes': self.max_bytes,
+                'expired': self.expired, 'evicted': self.evicted}
+
+class JobQueue:
+    def __init__(self, store: JobStore, workers: int = JOB_WORKERS, max_queue: int = JOB_MAX_QUEUE):
+        self.store = store
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pdf-job')
+        return self._executor
+
+    def submit(self, event: Dict[str, Any], run: Runner) -> Dict[str, Any]:
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(f'Job queue is limited to {self.max_queue} waiting jobs')
+            self.queued += 1
+        self.store.sweep()
+        job = {'id': f'job_{uuid.uuid4().hex}', 'status': 'queued', 'createdAt': time.time()}
+        try:
+            self.store.save(job)
+            with self._lock:
+                executor = self._get_executor()
+            executor.submit(self._run, job, event, run)
+        except Exception:
+            with self._lock:
+                self.queued -= 1
+            raise
+        return job
+
+    def _run(self, job: Dict[str, Any], event: Dict[str, Any], run: Runner) -> None:
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        job = dict(job, status='running', startedAt=time.time())
+        self.store.save(job)
+        result = None
+        try:
+            response = run(event)
+            body = response.get('body') or b''
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            if response.get('statusCode') == 200:
+                headers = response.get('headers') or {}
+                job.update(status='done', size=len(body),
+                           headers={name: headers[name] for name in KEPT_HEADERS if name in headers})
+                result = bytes(body)
+            else:
+                job.update(status='failed', statusCode=response.get('statusCode'),
+                           error=_error_message(body))
+        except Exception as e:
+            traceback.print_exc()
+            job.update(status='failed', statusCode=500, error=f'{type(e).__name__}: {e}')
+        job['finishedAt'] = time.time()
+        self.store.save(job, result)
+        with self._lock:
+            self.running -= 1
+            if job['status'] == 'done':
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {'queueDepth': self.queued, 'running': self.running, 'workers': self.workers,
+                        'maxQueue': self.max_queue, 'completed': self.completed, 'failed': self.failed,
+                        'rejected': self.rejected}
+        return {**counters, 'store': self.store.stats()}
+
+def _error_message(body: bytes) -> str:
+    try:
+        return json.loads(body).get('error', '')
+    except (ValueError, AttributeError):
+        return body[:200].decode('utf-8', 'replace')
+
+job_queue = JobQueue(JobStore())
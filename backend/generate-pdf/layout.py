@@ -0,0 +1,148 @@
+'''
+Движок вёрстки строк документа: перенос по ширине, разбиение на страницы заранее
+и отрисовка без повторных setFont/setFillColor
+'''
+
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from reportlab.lib.colors import HexColor
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from skeletons import Skeleton, stamp_at
+
+PAGE_WIDTH, PAGE_HEIGHT = A4
+PAGE_TOP = PAGE_HEIGHT - 30*mm
+PAGE_BOTTOM = 30*mm
+BLOCK_ORIGIN = PAGE_TOP
+
+class LineStyle(NamedTuple):
+    size: float
+    color: str
+    x: float
+    advance: float
+    max_width: float
+    box: Optional[str] = None
+
+STYLES: Dict[str, LineStyle] = {
+    'normal': LineStyle(10, '#374151', 30*mm, 5*mm, PAGE_WIDTH - 60*mm),
+    'contact': LineStyle(10, '#1e40af', 30*mm, 5*mm, PAGE_WIDTH - 60*mm),
+    'header': LineStyle(11, '#1e3a8a', 30*mm, 6*mm, PAGE_WIDTH - 60*mm),
+    'highlight': LineStyle(12, '#ffffff', 32*mm, 10*mm, PAGE_WIDTH - 64*mm, box='#10b981'),
+    'space': LineStyle(10, '#374151', 30*mm, 3*mm, 0),
+}
+
+COLORS = {style.color: HexColor(style.color) for style in STYLES.values()}
+COLORS['#10b981'] = HexColor('#10b981')
+
+class Op(NamedTuple):
+    kind: str
+    y: float = 0
+    style: str = ''
+    text: str = ''
+
+class RenderState(NamedTuple):
+    font: Optional[Tuple[str, float]] = None
+    fill: Optional[str] = None
+
+Lines = Sequence[Tuple[str, str]]
+
+@lru_cache(maxsize=16384)
+def string_width(text: str, font_name: str, size: float) -> float:
+    return stringWidth(text, font_name, size)
+
+@lru_cache(maxsize=4096)
+def wrap_text(text: str, font_name: str, size: float, max_width: float) -> Tuple[str, ...]:
+    if string_width(text, font_name, size) <= max_width:
+        return (text,)
+
+    space = string_width(' ', font_name, size)
+    lines: List[str] = []
+    current: List[str] = []
+    current_width = 0.0
+    for word in text.split(' '):
+        word_width = string_width(word, font_name, size)
+        while word_width > max_width:
+            if current:
+                lines.append(' '.join(current))
+                current, current_width = [], 0.0
+            cut = max(1, len(word) - 1)
+            while cut > 1 and string_width(word[:cut], font_name, size) > max_width:
+                cut -= 1
+            lines.append(word[:cut])
+            word = word[cut:]
+            word_width = string_width(word, font_name, size)
+        if current and current_width + space + word_width > max_width:
+            lines.append(' '.join(current))
+            current, current_width = [], 0.0
+        if current:
+            current_width += space
+        current.append(word)
+        current_width += word_width
+    if current:
+        lines.append(' '.join(current))
+    return tuple(lines)
+
+@lru_cache(maxsize=256)
+def block_metrics(lines: Tuple[Tuple[str, str], ...], font_name: str) -> Tuple[float, float]:
+    ops, end_y = layout(lines, BLOCK_ORIGIN, font_name)
+    if any(op.kind == 'page' for op in ops):
+        return PAGE_HEIGHT, PAGE_HEIGHT
+    height = BLOCK_ORIGIN - end_y
+    return height, height - STYLES[lines[-1][0]].advance
+
+def layout(text_lines: Lines, y: float, font_name: str, blocks: Dict[str, Lines] = None) -> Tuple[List[Op], float]:
+    ops: List[Op] = []
+    for line_type, text in text_lines:
+        if line_type == 'block':
+            lines = tuple(blocks[text])
+            height, last_drop = block_metrics(lines, font_name)
+            if y >= PAGE_BOTTOM and y - last_drop >= PAGE_BOTTOM:
+                ops.append(Op('block', y, text=text))
+                y -= height
+            else:
+                block_ops, y = layout(lines, y, font_name)
+                ops.extend(block_ops)
+            continue
+
+        style = STYLES[line_type]
+        pieces = ('',) if line_type == 'space' else wrap_text(text, font_name, style.size, style.max_width)
+        for piece in pieces:
+            if y < PAGE_BOTTOM:
+                ops.append(Op('page'))
+                y = PAGE_TOP
+            if line_type != 'space':
+                ops.append(Op('line', y, line_type, piece))
+            y -= style.advance
+    return ops, y
+
+def render(c, ops: List[Op], font_name: str, skeleton: Skeleton = None,
+           blocks: Dict[str, Lines] = None, state: RenderState = RenderState()) -> RenderState:
+    font, fill = state
+    for op in ops:
+        if op.kind == 'page':
+            c.showPage()
+            font = fill = None
+            continue
+
+        if op.kind == 'block':
+            if skeleton and op.text in skeleton.fragments:
+                stamp_at(c, skeleton, op.text, BLOCK_ORIGIN, op.y)
+            else:
+                block_ops, _ = layout(blocks[op.text], op.y, font_name)
+                font, fill = render(c, block_ops, font_name, state=RenderState(font, fill))
+            continue
+
+        style = STYLES[op.style]
+        if style.box:
+            c.setFillColor(COLORS[style.box])
+            fill = style.box
+            c.roundRect(28*mm, op.y - 3*mm, PAGE_WIDTH - 56*mm, 8*mm, 2*mm, fill=1, stroke=0)
+        if font != (font_name, style.size):
+            c.setFont(font_name, style.size)
+            font = (font_name, style.size)
+        if fill != style.color:
+            c.setFillColor(COLORS[style.color])
+            fill = style.color
+        c.drawString(style.x, op.y, op.text)
+    return RenderState(font, fill)
@@ -0,0 +1,117 @@
+'''
+Расчёт займов массивами NumPy: проценты, итоги и даты возврата сразу для всего портфеля
+и подневный график начислений, который договор выводит отдельными страницами
+'''
+
+import os
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Sequence, Tuple
+import numpy as np
+
+SCHEDULE_MAX_DAYS = int(os.environ.get('SCHEDULE_MAX_DAYS', '730'))
+LOANS_MAX_ITEMS = int(os.environ.get('LOANS_MAX_ITEMS', '100000'))
+
+FIRST_DAY = np.datetime64('0001-01-01', 'D')
+LAST_DAY = np.datetime64('9999-12-31', 'D')
+
+class Portfolio(NamedTuple):
+    amount: np.ndarray
+    term: np.ndarray
+    has_term: np.ndarray
+    rate: np.ndarray
+
+class Totals(NamedTuple):
+    interest: np.ndarray
+    total: np.ndarray
+    due: np.ndarray
+    valid: np.ndarray
+    due_valid: np.ndarray
+
+class Schedule(NamedTuple):
+    offsets: np.ndarray
+    day: np.ndarray
+    date: np.ndarray
+    accrued: np.ndarray
+    interest: np.ndarray
+    due: np.ndarray
+
+def parse_portfolio(records: Sequence[Dict[str, Any]], rate: float) -> Portfolio:
+    amount = np.full(len(records), np.nan)
+    term = np.zeros(len(records), dtype=np.int64)
+    has_term = np.zeros(len(records), dtype=bool)
+    for position, record in enumerate(records):
+        try:
+            amount[position] = float(str(record.get('amount') or ''))
+        except ValueError:
+            pass
+        try:
+            term[position] = int(str(record.get('term') or ''))
+            has_term[position] = True
+        except (ValueError, OverflowError):
+            pass
+    return Portfolio(amount, term, has_term, np.full(len(records), float(rate)))
+
+def loan_totals(portfolio: Portfolio, start: datetime) -> Totals:
+    valid = portfolio.has_term & np.isfinite(portfolio.amount)
+    amount = np.where(valid, portfolio.amount, 0.0)
+    # Тот же порядок операций, что в templates.build_context: суммы в договоре и в графике совпадают до копейки
+    interest = amount * portfolio.term * portfolio.rate
+    limit = (LAST_DAY - FIRST_DAY).astype(np.int64)
+    days = np.clip(portfolio.term, -limit, limit)
+    due = np.datetime64(start.date(), 'D') + days.astype('timedelta64[D]')
+    due_valid = portfolio.has_term & (days == portfolio.term) & (due >= FIRST_DAY) & (due <= LAST_DAY)
+    return Totals(interest, amount + interest, due, valid, due_valid)
+
+def build_schedules(portfolio: Portfolio, totals: Totals, start: datetime,
+                    max_days: int = SCHEDULE_MAX_DAYS) -> Schedule:
+    days = np.where(totals.valid & totals.due_valid & (portfolio.term > 0) & (portfolio.term <= max_days),
+                    portfolio.term, 0)
+    offsets = np.zeros(len(days) + 1, dtype=np.int64)
+    np.cumsum(days, out=offsets[1:])
+    loan = np.repeat(np.arange(len(days)), days)
+    day = np.arange(offsets[-1], dtype=np.int64) - offsets[loan] + 1
+    amount = portfolio.amount[loan]
+    rate = portfolio.rate[loan]
+    interest = amount * day * rate
+    return Schedule(offsets, day, np.datetime64(start.date(), 'D') + day.astype('timedelta64[D]'),
+                    amount * rate, interest, amount + interest)
+
+def money_text(value: float) -> str:
+    return f'{value:,.2f}'.replace(',', ' ')
+
+def money(values: np.ndarray) -> List[str]:
+    return [money_text(value) for value in values.tolist()]
+
+def dates(values: np.ndarray) -> List[str]:
+    return [f'{text[8:10]}.{text[5:7]}.{text[:4]}' for text in np.datetime_as_string(values, unit='D').tolist()]
+
+def schedule_rows(schedule: Schedule, position: int) -> List[Tuple[str, str, str, str, str]]:
+    rows = slice(schedule.offsets[position], schedule.offsets[position + 1])
+    return list(zip(map(str, schedule.day[rows].tolist()), dates(schedule.date[rows]), money(schedule.accrued[rows]),
+                    money(schedule.interest[rows]), money(schedule.due[rows])))
+
+def loan_schedule(amount: str, term: str, rate: float, start: datetime) -> List[Tuple[str, str, str, str, str]]:
+    portfolio = parse_portfolio([{'amount': amount, 'term': term}], rate)
+    return schedule_rows(build_schedules(portfolio, loan_totals(portfolio, start), start), 0)
+
+def portfolio_report(records: Sequence[Dict[str, Any]], rate: float, start: datetime) -> Dict[str, Any]:
+    portfolio = parse_portfolio(records, rate)
+    totals = loan_totals(portfolio, start)
+    interest, total, due = money(totals.interest), money(totals.total), dates(totals.due)
+    items = []
+    for position, record in enumerate(records):
+        valid, due_valid = bool(totals.valid[position]), bool(totals.due_valid[position])
+        items.append({
+            'index': position + 1,
+            'fullName': str(record.get('fullName') or ''),
+            'interestAmount': interest[position] if valid else '',
+            'totalAmount': total[position] if valid else '',
+            'returnDate': due[position] if due_valid else ''
+        })
+    return {
+        'loans': int(totals.valid.sum()),
+        'amount': money_text(float(portfolio.amount[totals.valid].sum())),
+        'interestAmount': money_text(float(totals.interest[totals.valid].sum())),
+        'totalAmount': money_text(float(totals.total[totals.valid].sum())),
+        'items': items
+    }
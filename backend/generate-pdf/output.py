@@ -0,0 +1,17 @@
+'''
+Выдача PDF: base64 прямо из байтов getpdfdata() без промежуточного BytesIO либо сырые байты без кодирования
+'''
+
+import base64
+from typing import Any, Dict, Union
+
+def encode_base64(data: Union[bytes, bytearray, memoryview]) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+def wants_binary(event: Dict[str, Any]) -> bool:
+    return bool(event.get('binary'))
+
+def binary_body(event: Dict[str, Any], data: bytes) -> Dict[str, Any]:
+    if wants_binary(event):
+        return {'body': data, 'isBase64Encoded': False}
+    return {'body': encode_base64(data), 'isBase64Encoded': True}
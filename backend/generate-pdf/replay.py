@@ -0,0 +1,392 @@
+'''
+Локальный эмулятор среды выполнения функции и нагрузочный прогон записанного или синтетического трафика.
+Запуск: python replay.py --requests 2000 --concurrency 4 --processes 2 [--input traffic.jsonl] [--record traffic.jsonl]
+Режим --soak гонит трафик в одном процессе и падает, если память растёт быстрее порога на 1000 запросов
+'''
+
+import argparse
+import base64
+import gc
+import json
+import multiprocessing
+import os
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+import uuid
+from io import BytesIO
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+RUNTIME_TIMEOUT = float(os.environ.get('RUNTIME_TIMEOUT', '10'))
+RUNTIME_MAX_RESPONSE_BYTES = int(os.environ.get('RUNTIME_MAX_RESPONSE_BYTES', str(3 * 1024 * 1024 + 512 * 1024)))
+REPLAY_MIX = os.environ.get('REPLAY_MIX', 'loan=5,consent=3,refund=2')
+SOAK_MAX_GROWTH_KB = float(os.environ.get('SOAK_MAX_GROWTH_KB', '256'))
+SOAK_MAX_RSS_GROWTH_KB = float(os.environ.get('SOAK_MAX_RSS_GROWTH_KB', '2048'))
+
+NAMES = ('Иванов Иван Иванович', 'Петрова Мария Сергеевна', 'Сидоров Алексей Петрович',
+         'Константинопольская-Преображенская Александра-Мария Владиславовна')
+
+STARTXREF = re.compile(rb'startxref\s+(\d+)\s+%%EOF\s*$')
+
+class Result(NamedTuple):
+    status: int
+    latency_ms: float
+    body_bytes: int
+    error: Optional[str]
+
+class Sample(NamedTuple):
+    requests: int
+    traced_kb: float
+    rss_kb: float
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    body: str = ''
+    headers: Dict[str, str] = {}
+
+def parse_mix(mix: str) -> List[Tuple[str, int]]:
+    weights = []
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        weights.append((name.strip(), int(weight or 1)))
+    return weights
+
+def sample_images(count: int) -> List[str]:
+    from PIL import Image
+    images = []
+    for number in range(count):
+        buffer = BytesIO()
+        Image.new('RGB', (120 + number, 60), (40 * number % 256, 90, 160)).save(buffer, 'PNG')
+        images.append('data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii'))
+    return images
+
+def synthetic_requests(count: int, mix: str = REPLAY_MIX, seed: int = 1, images: List[str] = ()) -> List[Request]:
+    rng = random.Random(seed)
+    types, weights = zip(*parse_mix(mix))
+    requests = []
+    for number in range(count):
+        params = {
+            'type': rng.choices(types, weights)[0],
+            'fullName': f'{rng.choice(NAMES)} {number}',
+            'birthDate': f'19{rng.randint(60, 99)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+            'passportSeries': str(rng.randint(1000, 9999)),
+            'passportNumber': str(rng.randint(100000, 999999)),
+            'amount': str(rng.choice((5000, 15000, 30000, 100000))),
+            'term': str(rng.choice((7, 14, 30, 60))),
+            'phone': f'+7 (9{rng.randint(10, 99)}) {rng.randint(100, 999)}-{rng.randint(10, 99)}-{rng.randint(10, 99)}',
+            'email': f'client{number}@example.ru'
+        }
+        if images and rng.random() < 0.5:
+            params['logo'] = rng.choice(images)
+            params['signature'] = rng.choice(images)
+        requests.append(Request('GET', '/?' + urlencode(params)))
+    return requests
+
+def load_requests(path: str) -> List[Request]:
+    requests = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                requests.append(Request(item.get('method', 'GET'), item.get('path', '/'), item.get('body', ''),
+                                        item.get('headers', {})))
+    return requests
+
+def save_requests(path: str, requests: Iterable[Request]) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        for request in requests:
+            f.write(json.dumps(request._asdict(), ensure_ascii=False) + '\n')
+
+def build_event(request: Request) -> Dict[str, Any]:
+    parts = urlsplit(request.path)
+    return {
+        'httpMethod': request.method,
+        'path': parts.path,
+        'headers': dict(request.headers),
+        'queryStringParameters': dict(parse_qsl(parts.query, keep_blank_values=True)),
+        'body': request.body,
+        'isBase64Encoded': False,
+        'requestContext': {'requestId': str(uuid.uuid4()), 'identity': {'sourceIp': '127.0.0.1'}}
+    }
+
+def build_context(timeout: float = RUNTIME_TIMEOUT) -> SimpleNamespace:
+    deadline = time.monotonic() + timeout
+    return SimpleNamespace(request_id=str(uuid.uuid4()), function_name='generate-pdf', memory_limit_in_mb=128,
+                           get_remaining_time_in_millis=lambda: int((deadline - time.monotonic()) * 1000))
+
+def encode_response(response: Any) -> Tuple[int, bytes, Dict[str, str]]:
+    '''Проверяет ответ так же, как среда выполнения: JSON-сериализуемый словарь, строковое тело, base64 по флагу'''
+    if not isinstance(response, dict) or not isinstance(response.get('statusCode'), int):
+        raise ValueError('response must be a dict with an integer statusCode')
+    headers = response.get('headers') or {}
+    if not all(isinstance(k, str) and isinstance(v, str) for k, v in headers.items()):
+        raise ValueError('header names and values must be strings')
+    body = response.get('body', '')
+    if not isinstance(body, str):
+        raise ValueError(f'body must be a string, got {type(body).__name__}')
+    wire = json.dumps(response)
+    if len(wire) > RUNTIME_MAX_RESPONSE_BYTES:
+        raise ValueError(f'response is {len(wire)} bytes, over the {RUNTIME_MAX_RESPONSE_BYTES} byte limit')
+    payload = base64.b64decode(body, validate=True) if response.get('isBase64Encoded') else body.encode('utf-8')
+    return response['statusCode'], payload, headers
+
+def check_pdf(payload: bytes) -> Optional[str]:
+    if not payload.startswith(b'%PDF-'):
+        return 'missing %PDF- header'
+    match = STARTXREF.search(payload[-64:])
+    if not match:
+        return 'missing startxref/%%EOF trailer'
+    offset = int(match.group(1))
+    if payload[offset:offset + 4] != b'xref':
+        return f'startxref {offset} does not point at the xref table'
+    if b'/Root' not in payload[offset:]:
+        return 'trailer has no /Root'
+    return None
+
+def check_payload(status: int, payload: bytes, headers: Dict[str, str]) -> Optional[str]:
+    content_type = headers.get('Content-Type', '')
+    if status == 200 and content_type == 'application/pdf':
+        return check_pdf(payload)
+    if status == 200 and content_type == 'application/zip' and not payload.startswith(b'PK'):
+        return 'ZIP body does not start with PK'
+    return None
+
+def invoke(handler, request: Request) -> Result:
+    event = build_event(request)
+    start = time.perf_counter()
+    try:
+        response = handler(event, build_context())
+        status, payload, headers = encode_response(response)
+        error = check_payload(status, payload, headers)
+    except Exception as e:
+        frame = traceback.extract_tb(e.__traceback__)[-1]
+        status, payload, error = 500, b'', f'{type(e).__name__}: {e} at {os.path.basename(frame.filename)}:{frame.lineno}'
+    elapsed = time.perf_counter() - start
+    if error is None and elapsed > RUNTIME_TIMEOUT:
+        error = f'took {elapsed:.1f}s, over the {RUNTIME_TIMEOUT:.0f}s timeout'
+    return Result(status, elapsed * 1000, len(payload), error)
+
+def run_share(requests: List[Request], concurrency: int) -> List[Result]:
+    import index
+    results: List[Optional[Result]] = [None] * len(requests)
+    position = iter(range(len(requests)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                number = next(position, None)
+            if number is None:
+                return
+            results[number] = invoke(index.handler, requests[number])
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def _child(requests: List[Request], concurrency: int, connection) -> None:
+    connection.send(run_share(requests, concurrency))
+    connection.close()
+
+def replay(requests: List[Request], concurrency: int = 1, processes: int = 1) -> Tuple[List[Result], float]:
+    import index
+    index.warm_up()
+    if processes <= 1:
+        started = time.perf_counter()
+        return run_share(requests, concurrency), time.perf_counter() - started
+
+    context = multiprocessing.get_context('fork')
+    children = []
+    started = time.perf_counter()
+    for number in range(processes):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_child, args=(requests[number::processes], concurrency, sender))
+        process.start()
+        children.append((process, receiver))
+    results: List[Result] = []
+    for process, receiver in children:
+        results.extend(receiver.recv())
+        process.join()
+    return results, time.perf_counter() - started
+
+def rss_kb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024
+    except (OSError, ValueError):
+        import resource
+        return float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def reset_caches() -> None:
+    '''Ограниченные кэши заполняются до своего предела и не считаются утечкой, поэтому перед замером они пустеют'''
+    import images
+    import index
+    import layout
+    index.pdf_cache.clear()
+    images.image_cache.clear()
+    for cached in (layout.string_width, layout.wrap_text, layout.block_metrics, images.image_key, urlsplit):
+        cached.cache_clear()
+
+def traced_snapshot() -> tracemalloc.Snapshot:
+    # Результаты и события самого прогона не относятся к обработчику
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__, all_frames=True),
+    ))
+
+def take_sample(done: int) -> Tuple[Sample, tracemalloc.Snapshot]:
+    reset_caches()
+    gc.collect()
+    snapshot = traced_snapshot()
+    traced = sum(stat.size for stat in snapshot.statistics('filename'))
+    # Собственные таблицы tracemalloc тоже лежат в RSS и растут вместе с числом объектов
+    rss = rss_kb() - tracemalloc.get_tracemalloc_memory() / 1024
+    return Sample(done, traced / 1024, rss), snapshot
+
+def growth_per_1000(samples: List[Sample], field: str) -> float:
+    # Первый интервал заново наполняет очищенные кэши, рост считается по установившемуся режиму
+    samples = samples[1:] if len(samples) > 2 else samples
+    if len(samples) < 2:
+        return 0.0
+    xs = [sample.requests for sample in samples]
+    ys = [getattr(sample, field) for sample in samples]
+    return statistics.linear_regression(xs, ys).slope * 1000
+
+def soak(requests: List[Request], interval: int = 500, warmup: int = 500, top: int = 10,
+         frames: int = 2) -> Dict[str, Any]:
+    '''Гонит запросы в текущем процессе, снимая tracemalloc и RSS каждые interval запросов после прогрева'''
+    import index
+    index.warm_up()
+    for request in requests[:warmup]:
+        invoke(index.handler, request)
+    requests = requests[warmup:]
+
+    tracemalloc.start(frames)
+    try:
+        sample, baseline = take_sample(0)
+        samples = [sample]
+        print(f'soak     {0:7} requests  traced {sample.traced_kb:9.0f} KB  rss {sample.rss_kb:9.0f} KB', flush=True)
+        results = []
+        started = time.perf_counter()
+        for number, request in enumerate(requests, 1):
+            results.append(invoke(index.handler, request))
+            if number % interval == 0 or number == len(requests):
+                sample, snapshot = take_sample(number)
+                samples.append(sample)
+                print(f'soak     {number:7} requests  traced {sample.traced_kb:9.0f} KB  rss {sample.rss_kb:9.0f} KB',
+                      flush=True)
+        elapsed = time.perf_counter() - started
+    finally:
+        tracemalloc.stop()
+
+    top_sites = []
+    for stat in snapshot.compare_to(baseline, 'traceback')[:top]:
+        frame = stat.traceback[-1]
+        top_sites.append({'site': f'{frame.filename}:{frame.lineno}', 'sizeDiffKB': stat.size_diff / 1024,
+                          'countDiff': stat.count_diff, 'traceback': stat.traceback.format()})
+    summary = summarize(results, elapsed)
+    summary.update({
+        'samples': [sample._asdict() for sample in samples],
+        'tracedGrowthKBPer1000': growth_per_1000(samples, 'traced_kb'),
+        'rssGrowthKBPer1000': growth_per_1000(samples, 'rss_kb'),
+        'topSites': top_sites
+    })
+    summary['leaking'] = (summary['tracedGrowthKBPer1000'] > SOAK_MAX_GROWTH_KB or
+                          summary['rssGrowthKBPer1000'] > SOAK_MAX_RSS_GROWTH_KB)
+    return summary
+
+def print_soak(summary: Dict[str, Any]) -> None:
+    print(f"soak     growth per 1000 requests: traced {summary['tracedGrowthKBPer1000']:.1f} KB "
+          f"(limit {SOAK_MAX_GROWTH_KB:.0f})  rss {summary['rssGrowthKBPer1000']:.1f} KB "
+          f"(limit {SOAK_MAX_RSS_GROWTH_KB:.0f})  {'LEAKING' if summary['leaking'] else 'ok'}")
+    for site in summary['topSites']:
+        print(f"soak     {site['sizeDiffKB']:+9.1f} KB {site['countDiff']:+7} blocks  {site['site']}")
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def summarize(results: List[Result], elapsed: float) -> Dict[str, Any]:
+    latencies = [result.latency_ms for result in results]
+    statuses: Dict[str, int] = {}
+    errors: Dict[str, int] = {}
+    for result in results:
+        statuses[str(result.status)] = statuses.get(str(result.status), 0) + 1
+        if result.error:
+            errors[result.error] = errors.get(result.error, 0) + 1
+    failed = sum(1 for result in results if result.error or result.status >= 500)
+    return {
+        'requests': len(results),
+        'seconds': elapsed,
+        'rps': len(results) / elapsed if elapsed else 0.0,
+        'p50Ms': percentile(latencies, 50),
+        'p90Ms': percentile(latencies, 90),
+        'p95Ms': percentile(latencies, 95),
+        'p99Ms': percentile(latencies, 99),
+        'maxMs': max(latencies),
+        'meanMs': statistics.mean(latencies),
+        'avgKB': statistics.mean(result.body_bytes for result in results) / 1024,
+        'errorRate': failed / len(results),
+        'statuses': statuses,
+        'errors': errors
+    }
+
+def print_summary(summary: Dict[str, Any], concurrency: int, processes: int) -> None:
+    print(f"replay   {summary['requests']} requests  {processes} proc x {concurrency} threads  "
+          f"{summary['rps']:.1f} req/s  p50 {summary['p50Ms']:.2f}  p90 {summary['p90Ms']:.2f}  "
+          f"p95 {summary['p95Ms']:.2f}  p99 {summary['p99Ms']:.2f}  max {summary['maxMs']:.2f} ms  "
+          f"avg {summary['avgKB']:.1f} KB  errors {summary['errorRate'] * 100:.2f}%")
+    print(f"statuses {json.dumps(summary['statuses'])}")
+    for error, count in sorted(summary['errors'].items(), key=lambda item: -item[1]):
+        print(f"ERROR    {count:6}  {error}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay traffic against handler in an emulated function runtime')
+    parser.add_argument('--input', help='JSONL file of {"method", "path", "body", "headers"} requests')
+    parser.add_argument('--record', help='write the replayed requests to this JSONL file')
+    parser.add_argument('--requests', type=int, default=1000, help='synthetic requests when no --input is given')
+    parser.add_argument('--mix', default=REPLAY_MIX, help='synthetic document mix, e.g. loan=5,consent=3,refund=2')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=1, help='threads per process')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--output', help='write the summary as JSON')
+    parser.add_argument('--max-error-rate', type=float, default=0.0, help='exit 1 above this error rate')
+    parser.add_argument('--soak', action='store_true', help='single-process memory growth test')
+    parser.add_argument('--interval', type=int, default=500, help='soak: requests between memory samples')
+    parser.add_argument('--warmup', type=int, default=500,
+                        help='soak: requests before the baseline, at least --interval so caches reach their high-water mark')
+    parser.add_argument('--images', type=int, default=8, help='soak: distinct logos/signatures in synthetic traffic')
+    parser.add_argument('--top', type=int, default=10, help='soak: allocation sites to report')
+    parser.add_argument('--frames', type=int, default=2, help='soak: traceback depth kept by tracemalloc')
+    args = parser.parse_args()
+
+    os.environ.setdefault('PDF_TIMING_LOG', '0')
+    sample = sample_images(args.images) if args.soak and not args.input else []
+    traffic = load_requests(args.input) if args.input else synthetic_requests(args.requests, args.mix, args.seed, sample)
+    if args.record:
+        save_requests(args.record, traffic)
+    if args.soak:
+        summary = soak(traffic, args.interval, args.warmup, args.top, args.frames)
+        print_summary(summary, 1, 1)
+        print_soak(summary)
+        failed = summary['leaking']
+    else:
+        results, elapsed = replay(traffic, args.concurrency, args.processes)
+        summary = summarize(results, elapsed)
+        print_summary(summary, args.concurrency, args.processes)
+        failed = False
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if failed or summary['errorRate'] > args.max_error_rate else 0)
@@ -0,0 +1,251 @@
+'''
+Собственный HTTP-сервер вокруг handler: предварительно форкнутые воркеры с загруженными шрифтами,
+keep-alive, лимит одновременных запросов с очередью и отказом 503, плавная остановка по SIGTERM.
+Запуск: python server.py --port 8000 --workers 4
+'''
+
+import argparse
+import base64
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List
+from urllib.parse import parse_qsl, urlsplit
+
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', '8000'))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', str(os.cpu_count() or 1)))
+SERVER_CONCURRENCY = int(os.environ.get('SERVER_CONCURRENCY', '2'))
+SERVER_MAX_QUEUE = int(os.environ.get('SERVER_MAX_QUEUE', '64'))
+SERVER_QUEUE_TIMEOUT = float(os.environ.get('SERVER_QUEUE_TIMEOUT', '10'))
+SERVER_KEEPALIVE_TIMEOUT = float(os.environ.get('SERVER_KEEPALIVE_TIMEOUT', '15'))
+SERVER_SHUTDOWN_TIMEOUT = float(os.environ.get('SERVER_SHUTDOWN_TIMEOUT', '30'))
+SERVER_MAX_BODY = int(os.environ.get('SERVER_MAX_BODY', str(32 * 1024 * 1024)))
+
+TEXT_TYPES = ('text/', 'application/json', 'application/x-ndjson', 'application/x-www-form-urlencoded')
+
+def build_event(method: str, target: str, headers: Dict[str, str], body: bytes, client_ip: str) -> Dict[str, Any]:
+    parts = urlsplit(target)
+    params = dict(parse_qsl(parts.query, keep_blank_values=True))
+    content_type = headers.get('content-type', '')
+    is_text = not body or content_type.startswith(TEXT_TYPES)
+    return {
+        'httpMethod': method,
+        'path': parts.path,
+        'headers': headers,
+        'queryStringParameters': params,
+        'body': body.decode('utf-8') if is_text else base64.b64encode(body).decode('ascii'),
+        'isBase64Encoded': not is_text,
+        'requestContext': {'requestId': str(uuid.uuid4()), 'identity': {'sourceIp': client_ip}},
+        'binary': True
+    }
+
+def response_bytes(response: Dict[str, Any]) -> bytes:
+    body = response.get('body') or b''
+    if isinstance(body, str):
+        body = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode('utf-8')
+    return bytes(body)
+
+class Limiter:
+    def __init__(self, concurrency: int, max_queue: int, timeout: float):
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        with self._lock:
+            self.waiting -= 1
+            if acquired:
+                self.active += 1
+            else:
+                self.rejected += 1
+        return acquired
+
+    def release(self) -> None:
+        self._slots.release()
+        with self._lock:
+            self.active -= 1
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'generate-pdf'
+    timeout = SERVER_KEEPALIVE_TIMEOUT
+
+    def _dispatch(self) -> None:
+        # Запрос считается идущим до последнего записанного байта ответа: воркер не выходит посреди записи
+        with self.server.in_flight():
+            self._handle()
+
+    def _handle(self) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > SERVER_MAX_BODY:
+            self._reply(413, {'Content-Type': 'application/json'}, b'{"error": "Request body is too large"}')
+            self.close_connection = True
+            return
+        body = self.rfile.read(length) if length else b''
+
+        limiter: Limiter = self.server.limiter
+        if self.server.draining or not limiter.acquire():
+            self._reply(503, {'Content-Type': 'application/json', 'Retry-After': '1'}, b'{"error": "Server is busy"}')
+            return
+        try:
+            headers = {k.lower(): v for k, v in self.headers.items()}
+            event = build_event(self.command, self.path, headers, body, self.client_address[0])
+            context = SimpleNamespace(request_id=event['requestContext']['requestId'], function_name='generate-pdf')
+            try:
+                response = self.server.app(event, context)
+            except Exception as e:
+                self.log_error('handler failed: %r', e)
+                response = {'statusCode': 500, 'headers': {'Content-Type': 'application/json'},
+                            'body': '{"error": "Internal server error"}'}
+            self._reply(response.get('statusCode', 200), response.get('headers') or {}, response_bytes(response))
+        finally:
+            limiter.release()
+
+    def _reply(self, status: int, headers: Dict[str, str], payload: bytes) -> None:
+        self.send_response(status)
+        for name, value in headers.items():
+            if name.lower() not in ('content-length', 'connection'):
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        if self.server.draining:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_OPTIONS = do_PUT = do_DELETE = do_PATCH = _dispatch
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+class WorkerServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, sock: socket.socket, app, limiter: Limiter):
+        super().__init__(sock.getsockname()[:2], RequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.app = app
+        self.limiter = limiter
+        self.draining = False
+        self.active = 0
+        self._idle = threading.Condition()
+
+    @contextmanager
+    def in_flight(self) -> Iterator[None]:
+        with self._idle:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self.active -= 1
+                if not self.active:
+                    self._idle.notify_all()
+
+    def wait_idle(self, timeout: float) -> bool:
+        with self._idle:
+            return self._idle.wait_for(lambda: not self.active, timeout)
+
+def listen(host: str, port: int, backlog: int = 1024) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+def run_worker(sock: socket.socket, app, concurrency: int, max_queue: int) -> None:
+    server = WorkerServer(sock, app, Limiter(concurrency, max_queue, SERVER_QUEUE_TIMEOUT))
+
+    def stop(signum, frame):
+        server.draining = True
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server.serve_forever(poll_interval=0.2)
+    server.wait_idle(SERVER_SHUTDOWN_TIMEOUT)
+
+def serve(host: str = SERVER_HOST, port: int = SERVER_PORT, workers: int = SERVER_WORKERS,
+          concurrency: int = SERVER_CONCURRENCY, max_queue: int = SERVER_MAX_QUEUE) -> None:
+    import index
+    index.warm_up()
+
+    sock = listen(host, port)
+    children: List[int] = []
+    stopping = False
+
+    def spawn() -> int:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(sock, index.handler, concurrency, max_queue)
+            finally:
+                os._exit(0)
+        return pid
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    children.extend(spawn() for _ in range(max(1, workers)))
+    print(f'generate-pdf listening on {host}:{sock.getsockname()[1]} with {len(children)} workers', flush=True)
+
+    deadline = None
+    while children:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            children.remove(pid)
+            if not stopping:
+                children.append(spawn())
+            continue
+        if stopping:
+            deadline = deadline or time.monotonic() + SERVER_SHUTDOWN_TIMEOUT + 5
+            if time.monotonic() > deadline:
+                for pid in children:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+        time.sleep(0.1)
+    sock.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-forking HTTP server for the PDF generator')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS)
+    parser.add_argument('--concurrency', type=int, default=SERVER_CONCURRENCY, help='in-flight requests per worker')
+    parser.add_argument('--max-queue', type=int, default=SERVER_MAX_QUEUE, help='waiting requests per worker before 503')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.concurrency, args.max_queue)
+    sys.exit(0)
@@ -0,0 +1,93 @@
+'''
+Скелеты документов: неизменные части каждого типа документа рисуются один раз на процесс
+и затем вклеиваются в content stream новых PDF готовыми фрагментами
+'''
+
+import copy
+import os
+import threading
+from io import BytesIO
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfgen import canvas
+from cache import LRUCache
+
+SKELETON_CACHE_BYTES = int(os.environ.get('SKELETON_CACHE_BYTES', str(8 * 1024 * 1024)))
+
+CANVAS_STATE = ('_fontname', '_fontsize', '_leading', '_fillColorObj', '_strokeColorObj', '_lineWidth')
+
+class Fragment(NamedTuple):
+    code: str
+    state: Tuple[Any, ...]
+    value: Any
+
+class Skeleton(NamedTuple):
+    fragments: Dict[str, Fragment]
+    fonts: List[Tuple[str, str]]
+    font_states: Dict[str, Any]
+
+# Ключ содержит версию шаблона: после перезагрузки старые скелеты вытесняются, а не копятся
+skeleton_cache = LRUCache(SKELETON_CACHE_BYTES)
+_lock = threading.Lock()
+
+def _snapshot_state(state):
+    clone = copy.copy(state)
+    clone.assignments = dict(state.assignments)
+    clone.subsets = [list(subset) for subset in state.subsets]
+    return clone
+
+def compile_skeleton(parts: List[Tuple[str, Callable[[canvas.Canvas], Any]]]) -> Skeleton:
+    c = canvas.Canvas(BytesIO(), pagesize=A4)
+    fragments = {}
+    for name, draw in parts:
+        page = c.getPageNumber()
+        start = len(c._code)
+        value = draw(c)
+        if c.getPageNumber() != page:
+            raise ValueError(f'Skeleton part {name} must fit on one page')
+        state = tuple(getattr(c, attr) for attr in CANVAS_STATE)
+        fragments[name] = Fragment('\n'.join(c._code[start:]), state, value)
+        c.showPage()
+
+    doc = c._doc
+    font_states = {font.fontName: _snapshot_state(font.state[doc]) for font in doc.delayedFonts}
+    return Skeleton(fragments, list(doc.fontMapping.items()), font_states)
+
+def get_skeleton(key: Tuple, parts: Callable[[], List[Tuple[str, Callable[[canvas.Canvas], Any]]]],
+                 compile: Callable[[List[Tuple[str, Callable[[Any], Any]]]], Skeleton] = compile_skeleton) -> Skeleton:
+    skeleton = skeleton_cache.get(key)
+    if skeleton is None:
+        with _lock:
+            skeleton = skeleton_cache.get(key)
+            if skeleton is None:
+                skeleton = compile(parts())
+                skeleton_cache.put(key, skeleton, sum(len(fragment.code) for fragment in skeleton.fragments.values()))
+    return skeleton
+
+def begin_skeleton(c: canvas.Canvas, skeleton: Skeleton) -> bool:
+    doc = c._doc
+    for name, internal in skeleton.fonts:
+        if name not in doc.fontMapping:
+            font = pdfmetrics.getFont(name)
+            if font._dynamicFont:
+                font.state[doc] = _snapshot_state(skeleton.font_states[name])
+                doc.fontMapping[name] = internal
+                doc.delayedFonts.append(font)
+            else:
+                doc.getInternalFontName(name)
+        if doc.fontMapping[name] != internal:
+            return False
+    return True
+
+def stamp(c: canvas.Canvas, skeleton: Skeleton, name: str) -> Any:
+    fragment = skeleton.fragments[name]
+    c._code.append(fragment.code)
+    for attr, value in zip(CANVAS_STATE, fragment.state):
+        setattr(c, attr, value)
+    return fragment.value
+
+def stamp_at(c: canvas.Canvas, skeleton: Skeleton, name: str, origin: float, y: float) -> None:
+    c._code.append(f'q 1 0 0 1 0 {y - origin:.4f} cm')
+    c._code.append(skeleton.fragments[name].code)
+    c._code.append('Q')
@@ -0,0 +1,282 @@
+'''
+Штамповка: каждый тип документа один раз собирается быстрым движком в готовый PDF со слотами
+под строки с полями клиента, а на запрос в него вклеиваются только эти строки, длины потоков и xref
+'''
+
+import os
+import threading
+from datetime import datetime
+from itertools import groupby
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+from cache import LRUCache
+from compression import OutputProfile
+from fastpdf import (CATALOG, FIRST_FONT_OBJECT, HEADER, INFO, PAGES, FastCanvas, FastUnsupported, FontProgram,
+                     info_object, page_object, resource_objects, stream_object, trailer)
+from layout import STYLES, string_width, wrap_text
+from templates import FIELDS, Condition, Template, expand
+
+STAMP_CACHE_BYTES = int(os.environ.get('STAMP_CACHE_BYTES', str(32 * 1024 * 1024)))
+# Неизменные куски страницы короче этого остаются внутри вклеиваемого потока и сжимаются вместе с полями:
+# порог меньше — быстрее штамповка, больше — меньше файл
+INLINE_STATIC_BYTES = int(os.environ.get('STAMP_INLINE_STATIC_BYTES', '512'))
+
+MARK = '\x00'
+
+# Строки тела переносятся по ширине стиля; строка со слотом должна остаться одной строкой
+CAPACITIES = {(style.x, style.size): style.max_width for style in STYLES.values() if style.max_width}
+
+Piece = Union[str, Tuple[int, str]]
+
+class StampOverflow(Exception):
+    '''Значение не помещается в свой слот, документ отрисовывается полностью'''
+
+class Slot(NamedTuple):
+    pieces: Tuple[Piece, ...]
+    method: str
+    x: float
+    y: float
+    size: float
+    leading: float
+    capacity: Optional[float]
+
+class Stamp(NamedTuple):
+    program: FontProgram
+    level: Optional[int]
+    prefix: bytes
+    xref_head: bytes
+    xref_tail: bytes
+    first_spliced: int
+    spliced: Tuple[Tuple[Union[str, int], ...], ...]
+    slots: Tuple[Slot, ...]
+    font_dict: int
+    kids: Tuple[int, ...]
+    breaks: Tuple[int, ...]
+
+stamps = LRUCache(STAMP_CACHE_BYTES)
+_conditions = LRUCache(256 * 1024)
+_lock = threading.Lock()
+
+def condition_fields(template: Template) -> Tuple[str, ...]:
+    key = (template.name, template.version)
+    fields = _conditions.get(key)
+    if fields is None:
+        found = []
+        items = list(template.body)
+        while items:
+            item = items.pop()
+            if isinstance(item, Condition):
+                found.append(item.field)
+                items.extend(item.lines)
+        fields = tuple(sorted(set(found)))
+        _conditions.put(key, fields, sum(map(len, key + fields)))
+    return fields
+
+def condition_flags(pages: Tuple[Template, ...], contexts: List[Dict[str, str]]) -> Tuple[Tuple[bool, ...], ...]:
+    return tuple(tuple(bool(context[field]) for field in condition_fields(template))
+                 for template, context in zip(pages, contexts))
+
+def sentinel_contexts(pages: Tuple[Template, ...], flags: Tuple[Tuple[bool, ...], ...],
+                      font_name: str) -> List[Dict[str, str]]:
+    contexts = []
+    for position, (template, template_flags) in enumerate(zip(pages, flags)):
+        context = {field: f'{MARK}{position}.{field}{MARK}' for field in FIELDS}
+        for field, enabled in zip(condition_fields(template), template_flags):
+            if not enabled:
+                context[field] = ''
+        for kind, text in expand(template.body, context):
+            if MARK in text and len(wrap_text(text, font_name, STYLES[kind].size, STYLES[kind].max_width)) > 1:
+                raise StampOverflow(f'{template.name}: field line {text!r} wraps even before filling')
+        contexts.append(context)
+    return contexts
+
+class StampCanvas(FastCanvas):
+    '''Холст компиляции: строки с маркерами полей не рисуются, а становятся слотами в content stream'''
+
+    def __init__(self, program: FontProgram):
+        super().__init__(program)
+        self.slots: List[Slot] = []
+        self.breaks: List[int] = []
+
+    def end_document(self):
+        # После документа пакета на запрос могут вставляться его собственные страницы, например график платежей
+        self.breaks.append(len(self.pages) + 1)
+
+    def _slot(self, method: str, x: float, y: float, text: str) -> bool:
+        if MARK not in text:
+            return False
+        parts = text.split(MARK)
+        if len(parts) % 2 == 0:
+            raise StampOverflow(f'field marker is split in {text!r}')
+        if self._fontname != self.program.font_name:
+            raise FastUnsupported(f'field text must use the document font, not {self._fontname}')
+        pieces = tuple(part if index % 2 == 0 else (int(part.split('.', 1)[0]), part.split('.', 1)[1])
+                       for index, part in enumerate(parts) if part or index % 2)
+        capacity = CAPACITIES.get((x, self._fontsize)) if method == 'drawString' else None
+        self._code.append(len(self.slots))
+        self.slots.append(Slot(pieces, method, x, y, self._fontsize, self._leading, capacity))
+        return True
+
+    def drawString(self, x: float, y: float, text: str):
+        if not self._slot('drawString', x, y, text):
+            super().drawString(x, y, text)
+
+    def drawRightString(self, x: float, y: float, text: str):
+        if not self._slot('drawRightString', x, y, text):
+            super().drawRightString(x, y, text)
+
+    def drawCentredString(self, x: float, y: float, text: str):
+        if not self._slot('drawCentredString', x, y, text):
+            super().drawCentredString(x, y, text)
+
+    def showPage(self):
+        self.pages.append((self._code, tuple(self._page_images)))
+        self._code = []
+        self._page_images = []
+        self._init_state()
+
+def _segments(code: List[Union[str, int]], level: Optional[int]) -> List[Union[str, Tuple[Union[str, int], ...]]]:
+    items: List[Union[str, int]] = []
+    for entry in code:
+        if items:
+            items.append('\n')
+        items.append(entry)
+    merged: List[Union[str, int]] = []
+    for is_text, group in groupby(items, key=lambda item: isinstance(item, str)):
+        if is_text:
+            merged.append(''.join(group))
+        else:
+            merged.extend(group)
+
+    segments: List[Union[str, Tuple[Union[str, int], ...]]] = []
+    spliced: List[Union[str, int]] = []
+    for item in merged:
+        if isinstance(item, str) and level is not None and len(item) >= INLINE_STATIC_BYTES:
+            if spliced:
+                segments.append(tuple(spliced))
+                spliced = []
+            segments.append(item)
+        else:
+            spliced.append(item)
+    if spliced:
+        segments.append(tuple(spliced))
+    # Кусок без слотов нечего вклеивать, он пишется как обычный поток
+    return [''.join(segment) if isinstance(segment, tuple) and all(isinstance(item, str) for item in segment)
+            else segment for segment in segments]
+
+def compile_stamp(program: FontProgram, profile: OutputProfile, draw: Callable[[StampCanvas], None]) -> Stamp:
+    c = StampCanvas(program)
+    draw(c)
+    if c._code or not c.pages:
+        c.showPage()
+    level = profile.zlib_level if profile.page_compression else None
+
+    out = bytearray(HEADER)
+    offsets: Dict[int, int] = {}
+
+    def add(number: int, body: bytes):
+        offsets[number] = len(out)
+        out.extend(b'%d 0 obj\n%s\nendobj\n' % (number, body))
+
+    base = len(out)
+    out.extend(program.block)
+    for number, offset in enumerate(program.offsets, FIRST_FONT_OBJECT):
+        offsets[number] = base + offset
+    font_dict, xobjects, number = resource_objects(c, add, program.next_object)
+
+    # Вклеиваемые потоки нумеруются после всех неизменных объектов, чтобы xref до них был готовым
+    pages = [(_segments(code, level), images) for code, images in c.pages]
+    first_spliced = number + sum(1 + sum(isinstance(segment, str) for segment in segments) for segments, _ in pages)
+    spliced = []
+    kids = []
+    for segments, images in pages:
+        contents = []
+        for segment in segments:
+            if isinstance(segment, str):
+                add(number, stream_object('', segment.encode('latin-1'), level))
+                contents.append(f'{number} 0 R')
+                number += 1
+            else:
+                contents.append(f'{first_spliced + len(spliced)} 0 R')
+                spliced.append(segment)
+        add(number, page_object(f'[{" ".join(contents)}]', font_dict, images, xobjects))
+        kids.append(number)
+        number += 1
+
+    add(CATALOG, b'<< /Pages %d 0 R /Type /Catalog >>' % PAGES)
+    return Stamp(
+        program=program,
+        level=level,
+        prefix=bytes(out),
+        xref_head=b''.join(b'%010d 00000 n \n' % offsets[position] for position in range(1, PAGES)),
+        xref_tail=b''.join(b'%010d 00000 n \n' % offsets[position] for position in range(INFO + 1, first_spliced)),
+        first_spliced=first_spliced,
+        spliced=tuple(spliced),
+        slots=tuple(c.slots),
+        font_dict=font_dict,
+        kids=tuple(kids),
+        breaks=tuple(c.breaks) or (len(kids),)
+    )
+
+def get_stamp(key: Tuple, program: FontProgram, profile: OutputProfile, draw: Callable[[StampCanvas], None]) -> Stamp:
+    stamp = stamps.get(key)
+    if stamp is None:
+        with _lock:
+            stamp = stamps.get(key)
+            if stamp is None:
+                try:
+                    stamp = compile_stamp(program, profile, draw)
+                except StampOverflow as e:
+                    # Шаблон без слотов запоминается, чтобы не компилировать его на каждый запрос
+                    stamp = e
+                stamps.put(key, stamp, len(stamp.prefix) if isinstance(stamp, Stamp) else 256)
+    if isinstance(stamp, StampOverflow):
+        raise StampOverflow(*stamp.args)
+    return stamp
+
+def _fill_slot(c: FastCanvas, slot: Slot, contexts: List[Dict[str, str]]) -> str:
+    text = ''.join(piece if isinstance(piece, str) else contexts[piece[0]][piece[1]] for piece in slot.pieces)
+    if slot.capacity is not None and string_width(text, c.program.font_name, slot.size) > slot.capacity:
+        raise StampOverflow(f'{text!r} does not fit its slot')
+    c.setFont(c.program.font_name, slot.size, slot.leading)
+    getattr(c, slot.method)(slot.x, slot.y, text)
+    return c._code.pop()
+
+def fill_stamp(stamp: Stamp, contexts: List[Dict[str, str]], title: str, author: str, moment: datetime,
+               digest: Optional[str] = None, appendix: Callable[[], Dict[int, List[str]]] = None) -> bytes:
+    c = FastCanvas(stamp.program)
+    code = [_fill_slot(c, slot, contexts) for slot in stamp.slots]
+    pages = appendix() if appendix else {}
+
+    # Дописанные страницы идут после вклеиваемых потоков, а в /Kids встают сразу за страницами своего документа
+    number = stamp.first_spliced + len(stamp.spliced)
+    kids = [f'{kid} 0 R' for kid in stamp.kids]
+    extra = []
+    for position, contents in sorted(pages.items(), reverse=True):
+        refs = []
+        for content in contents:
+            extra.append((number, stream_object('', content.encode('latin-1'), stamp.level)))
+            extra.append((number + 1, page_object(f'{number} 0 R', stamp.font_dict, (), {})))
+            refs.append(f'{number + 1} 0 R')
+            number += 2
+        kids[stamp.breaks[position]:stamp.breaks[position]] = refs
+    extra.sort()
+
+    chunks = [stamp.prefix]
+    position = len(stamp.prefix)
+    lines = []
+    for number, body in [(PAGES, f'<< /Count {len(kids)} /Kids [{" ".join(kids)}] /Type /Pages >>'.encode('ascii')),
+                         (INFO, info_object(title, author, moment))] + [
+            (number, stream_object('', ''.join(part if isinstance(part, str) else code[part] for part in parts)
+                                   .encode('latin-1'), stamp.level))
+            for number, parts in enumerate(stamp.spliced, stamp.first_spliced)] + extra:
+        chunk = b'%d 0 obj\n%s\nendobj\n' % (number, body)
+        lines.append(b'%010d 00000 n \n' % position)
+        chunks.append(chunk)
+        position += len(chunk)
+
+    objects = stamp.first_spliced + len(stamp.spliced) + len(extra)
+    chunks.extend((b'xref\n0 %d\n0000000000 65535 f \n' % objects, stamp.xref_head, lines[0], lines[1],
+                   stamp.xref_tail))
+    chunks.extend(lines[2:])
+    chunks.append(trailer(objects, position, digest))
+    return b''.join(chunks)
@@ -0,0 +1,282 @@
+'''
+Реестр шаблонов документов: JSON-файлы из documents/ компилируются один раз на процесс
+и перекомпилируются только при смене mtime. Новый тип документа — новый файл, без кода
+'''
+
+import hashlib
+import json
+import os
+import string
+import sys
+import threading
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+from reportlab.lib.colors import Color, HexColor
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from clock import now
+from layout import STYLES
+
+TEMPLATE_DIR = os.environ.get('TEMPLATE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'documents'))
+TEMPLATE_CHECK_INTERVAL = float(os.environ.get('TEMPLATE_CHECK_INTERVAL', '2'))
+
+PAGE_WIDTH, PAGE_HEIGHT = A4
+
+MONTH_NAMES = ('января', 'февраля', 'марта', 'апреля', 'мая', 'июня',
+               'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря')
+
+CLIENT_FIELDS = ['fullName', 'birthDate', 'passportSeries', 'passportNumber', 'amount', 'term', 'phone', 'email']
+DERIVED_FIELDS = ['passport', 'returnDate', 'interestAmount', 'totalAmount', 'date', 'day', 'month', 'year',
+                  'signatureBlank']
+FIELDS = frozenset(CLIENT_FIELDS + DERIVED_FIELDS)
+
+ALIGN_METHODS = {'left': 'drawString', 'right': 'drawRightString', 'center': 'drawCentredString'}
+
+class TemplateError(ValueError):
+    pass
+
+class Placed(NamedTuple):
+    text: str
+    dynamic: bool
+    x: float
+    y: float
+    size: float
+    color: Color
+    method: str
+
+class Line(NamedTuple):
+    kind: str
+    text: str
+    dynamic: bool
+
+class Condition(NamedTuple):
+    field: str
+    lines: Tuple[Union[Line, 'Condition'], ...]
+
+class Template(NamedTuple):
+    name: str
+    version: str
+    title: str
+    filename: str
+    documents: Tuple[str, ...]
+    header: Tuple[Placed, ...]
+    overlay: Tuple[Placed, ...]
+    body_top: float
+    blocks: Dict[str, Tuple[Tuple[str, str], ...]]
+    body: Tuple[Union[Line, Condition], ...]
+    defaults: Dict[str, str]
+    daily_rate: float
+    schedule: bool = False
+
+def _fields(name: str, text: str) -> List[str]:
+    try:
+        fields = [field for _, field, _, _ in string.Formatter().parse(text) if field is not None]
+    except ValueError as e:
+        raise TemplateError(f'{name}: bad placeholder in {text!r}: {e}')
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise TemplateError(f"{name}: unknown field {unknown[0]!r} in {text!r}")
+    return fields
+
+def _placed(name: str, item: Dict[str, Any], static: bool) -> Placed:
+    text = str(item.get('text', ''))
+    dynamic = bool(_fields(name, text))
+    if dynamic and static:
+        raise TemplateError(f'{name}: header text cannot use fields: {text!r}')
+    align = item.get('align', 'left')
+    if align not in ALIGN_METHODS:
+        raise TemplateError(f'{name}: unknown align {align!r}')
+    default_x = {'left': 30, 'right': PAGE_WIDTH / mm - 30, 'center': PAGE_WIDTH / mm / 2}[align]
+    return Placed(text, dynamic, float(item.get('x', default_x)) * mm, PAGE_HEIGHT - float(item['top']) * mm,
+                  float(item.get('size', 10)), HexColor(item.get('color', '#374151')), ALIGN_METHODS[align])
+
+def _line(name: str, item: Any, blocks: Dict[str, Any]) -> Union[Line, Condition]:
+    if isinstance(item, dict):
+        if 'if' not in item:
+            raise TemplateError(f'{name}: conditional lines need an "if" field')
+        if item['if'] not in FIELDS:
+            raise TemplateError(f"{name}: unknown field {item['if']!r} in condition")
+        return Condition(item['if'], tuple(_line(name, line, blocks) for line in item.get('lines', [])))
+
+    kind, text = item
+    if kind == 'block':
+        block = f'{name}/{text}'
+        if block not in blocks:
+            raise TemplateError(f'{name}: unknown block {text!r}')
+        return Line(kind, block, False)
+    if kind not in STYLES:
+        raise TemplateError(f'{name}: unknown line style {kind!r}')
+    return Line(kind, str(text), bool(_fields(name, str(text))))
+
+def _block(name: str, block: str, lines: List[Any]) -> Tuple[Tuple[str, str], ...]:
+    if not lines:
+        raise TemplateError(f'{name}: block {block!r} is empty')
+    compiled = []
+    for kind, text in lines:
+        if kind not in STYLES:
+            raise TemplateError(f'{name}: unknown line style {kind!r} in block {block!r}')
+        if _fields(name, str(text)):
+            raise TemplateError(f'{name}: block {block!r} cannot use fields: {text!r}')
+        compiled.append((kind, str(text)))
+    return tuple(compiled)
+
+def compile_template(name: str, data: Dict[str, Any], version: str = '') -> Template:
+    if not isinstance(data, dict):
+        raise TemplateError(f'{name}: template must be a JSON object')
+    title = data.get('title') or name
+    filename = data.get('filename') or f'{name}.pdf'
+    documents = tuple(data.get('documents') or ())
+    if documents:
+        return Template(name, version, title, filename, documents, (), (), 0.0, {}, (), {}, 0.0)
+
+    try:
+        blocks = {f'{name}/{block}': _block(name, block, lines) for block, lines in (data.get('blocks') or {}).items()}
+        return Template(
+            name=name,
+            version=version,
+            title=title,
+            filename=filename,
+            documents=(),
+            header=tuple(_placed(name, item, static=True) for item in data.get('header') or ()),
+            overlay=tuple(_placed(name, item, static=False) for item in data.get('overlay') or ()),
+            body_top=PAGE_HEIGHT - float(data.get('bodyTop', 50)) * mm,
+            blocks=blocks,
+            body=tuple(_line(name, item, blocks) for item in data.get('body') or ()),
+            defaults={field: str(value) for field, value in (data.get('defaults') or {}).items()},
+            daily_rate=float(data.get('dailyRate', 0)),
+            schedule=bool(data.get('schedule'))
+        )
+    except (KeyError, TypeError) as e:
+        raise TemplateError(f'{name}: malformed template: {e!r}')
+
+def load_template(name: str, path: str) -> Template:
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return compile_template(name, json.loads(raw), hashlib.sha1(raw).hexdigest()[:12])
+
+def build_context(template: Template, client_data: Optional[Dict[str, str]], signature: Optional[str]) -> Dict[str, str]:
+    client_data = client_data or {}
+    defaults = template.defaults
+    context = {field: client_data.get(field, defaults.get(field, '')) for field in CLIENT_FIELDS}
+
+    def provided(field: str) -> bool:
+        return bool(context[field]) and context[field] != defaults.get(field)
+
+    if provided('birthDate') and '-' in context['birthDate']:
+        parts = context['birthDate'].split('-')
+        if len(parts) == 3:
+            context['birthDate'] = f'{parts[2]}.{parts[1]}.{parts[0]} г.р.'
+
+    moment = now()
+    context['passport'] = f"{context['passportSeries']} {context['passportNumber']}"
+    context['returnDate'] = defaults.get('returnDate', '')
+    context['interestAmount'] = context['totalAmount'] = ''
+    if provided('term'):
+        try:
+            context['returnDate'] = (moment + timedelta(days=int(context['term']))).strftime('%d.%m.%Y')
+        except (ValueError, OverflowError):
+            pass
+        if provided('amount'):
+            try:
+                loan_amount = float(context['amount'])
+                interest = loan_amount * int(context['term']) * template.daily_rate
+                context['interestAmount'] = f'{interest:,.2f}'.replace(',', ' ')
+                context['totalAmount'] = f'{loan_amount + interest:,.2f}'.replace(',', ' ')
+            except ValueError:
+                pass
+
+    context['date'] = moment.strftime('%d.%m.%Y')
+    context['day'] = moment.strftime('%d')
+    context['month'] = MONTH_NAMES[moment.month - 1]
+    context['year'] = moment.strftime('%Y')
+    context['signatureBlank'] = '' if signature else '_________________'
+    return context
+
+def expand(items: Tuple[Union[Line, Condition], ...], context: Dict[str, str],
+           lines: List[Tuple[str, str]] = None) -> List[Tuple[str, str]]:
+    if lines is None:
+        lines = []
+    for item in items:
+        if isinstance(item, Condition):
+            if context.get(item.field):
+                expand(item.lines, context, lines)
+        else:
+            lines.append((item.kind, item.text.format_map(context) if item.dynamic else item.text))
+    return lines
+
+class TemplateRegistry:
+    def __init__(self, root: str = TEMPLATE_DIR, check_interval: float = TEMPLATE_CHECK_INTERVAL):
+        self.root = root
+        self.check_interval = check_interval
+        self.reloads = 0
+        self.errors: Dict[str, str] = {}
+        self._templates: Dict[str, Template] = {}
+        self._mtimes: Dict[str, int] = {}
+        self._checked: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _fresh(self) -> bool:
+        return self._checked is not None and time.monotonic() - self._checked < self.check_interval
+
+    def refresh(self, force: bool = False) -> None:
+        if not force and self._fresh():
+            return
+        with self._lock:
+            if not force and self._fresh():
+                return
+            try:
+                entries = {entry.name[:-5]: entry for entry in os.scandir(self.root)
+                           if entry.name.endswith('.json') and entry.is_file()}
+            except FileNotFoundError:
+                entries = {}
+
+            templates = {name: template for name, template in self._templates.items() if name in entries}
+            mtimes = {name: mtime for name, mtime in self._mtimes.items() if name in entries}
+            for name, entry in entries.items():
+                mtime = entry.stat().st_mtime_ns
+                if mtimes.get(name) == mtime:
+                    continue
+                mtimes[name] = mtime
+                try:
+                    templates[name] = load_template(name, entry.path)
+                    self.errors.pop(name, None)
+                    self.reloads += 1
+                except (OSError, ValueError) as e:
+                    self.errors[name] = str(e)
+                    print(f'template {name} is invalid, keeping the previous version: {e}', file=sys.stderr, flush=True)
+            # Читатели берут словарь без блокировки, поэтому он подменяется целиком
+            self._templates = templates
+            self._mtimes = mtimes
+            self._checked = time.monotonic()
+
+    def get(self, name: str) -> Optional[Template]:
+        self.refresh()
+        return self._templates.get(name)
+
+    def pages(self, name: str) -> Tuple[Template, ...]:
+        template = self.get(name)
+        if template is None:
+            raise TemplateError(f'Unknown document type {name!r}')
+        if not template.documents:
+            return (template,)
+        pages = tuple(self._templates.get(document) for document in template.documents)
+        for document, page in zip(template.documents, pages):
+            if page is None or page.documents:
+                raise TemplateError(f'{name}: {document!r} is not a single document template')
+        return pages
+
+    def names(self) -> List[str]:
+        self.refresh()
+        return sorted(self._templates)
+
+    def describe(self) -> Dict[str, Any]:
+        self.refresh()
+        return {
+            'templates': [{'type': t.name, 'title': t.title, 'filename': t.filename, 'version': t.version,
+                           'documents': list(t.documents)} for _, t in sorted(self._templates.items())],
+            'errors': dict(self.errors),
+            'reloads': self.reloads
+        }
+
+registry = TemplateRegistry()
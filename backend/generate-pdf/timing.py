@@ -0,0 +1,101 @@
+'''
+Таймеры этапов запроса для заголовка Server-Timing и структурных логов,
+плюс выборочный cProfile по переменной окружения или флагу запроса (если он разрешён)
+'''
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+TIMING_LOG = os.environ.get('PDF_TIMING_LOG', '1') != '0'
+PROFILE_RATE = float(os.environ.get('PDF_PROFILE_RATE', '0'))
+PROFILE_DIR = os.environ.get('PDF_PROFILE_DIR', '')
+PROFILE_QUERY = os.environ.get('PDF_PROFILE_QUERY', '0') == '1'
+PROFILE_TOP = int(os.environ.get('PDF_PROFILE_TOP', '30'))
+
+STAGE_ORDER = ('font', 'skeleton', 'image', 'layout', 'schedule', 'draw', 'save', 'encode')
+
+_local = threading.local()
+
+class Timings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> Dict[str, float]:
+        result = {name: round(self.stages[name] * 1000, 3) for name in sorted(self.stages, key=_stage_rank)}
+        result['total'] = round(self.total() * 1000, 3)
+        return result
+
+    def header(self) -> str:
+        return ', '.join(f'{name};dur={ms:.2f}' for name, ms in self.as_dict().items())
+
+def _stage_rank(name: str):
+    return (STAGE_ORDER.index(name) if name in STAGE_ORDER else len(STAGE_ORDER), name)
+
+def start_timing() -> Timings:
+    timings = _local.timings = Timings()
+    return timings
+
+def stop_timing() -> Optional[Timings]:
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    return timings
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+def log_request(timings: Timings, **fields: Any) -> None:
+    if TIMING_LOG:
+        print(json.dumps({'event': 'pdf_request', **fields, 'timings': timings.as_dict()}, ensure_ascii=False), flush=True)
+
+def wants_profile(params: Dict[str, Any]) -> bool:
+    # Флаг ?profile=1 включает профилировщик только там, где это явно разрешено окружением
+    if PROFILE_QUERY and str(params.get('profile', '')).lower() in ('1', 'true', 'yes'):
+        return True
+    return PROFILE_RATE > 0 and random.random() < PROFILE_RATE
+
+def start_profile(params: Dict[str, Any]) -> Optional[cProfile.Profile]:
+    if not wants_profile(params):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    return profiler
+
+def dump_profile(profiler: cProfile.Profile, label: str) -> None:
+    profiler.disable()
+    # Метка попадает в имя файла, поэтому оставляем только безопасные символы
+    label = re.sub(r'[^a-z0-9_-]', '', str(label).lower()) or 'request'
+    if PROFILE_DIR:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f'{label}-{time.time():.6f}.prof'))
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    print(f'profile {label}\n{report.getvalue()}', file=sys.stderr, flush=True)
@@ -1,4 +1,4 @@
-import { useState } from "react";
+import { useRef, useState } from "react";
 import { useToast } from "@/hooks/use-toast";
 import DocumentCard from "@/components/DocumentCard";
 import LogoSignatureUpload from "@/components/LogoSignatureUpload";
@@ -7,6 +7,16 @@ import TemplateManager from "@/components/TemplateManager";
 
 const BASE_URL = "https://functions.poehali.dev/502d518c-5d60-4ce9-a293-c916a64f50db";
 
+const uploadAsset = (dataUrl: string): Promise<string | null> =>
+  fetch(`${BASE_URL}?action=asset`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'text/plain' },
+    body: dataUrl
+  })
+    .then(response => (response.ok ? response.json() : Promise.reject(response.status)))
+    .then((asset: { id: string }) => asset.id)
+    .catch(() => null);
+
 const documents = [
   {
     id: 1,
@@ -40,6 +50,8 @@ const Index = () => {
   const [copiedId, setCopiedId] = useState<number | null>(null);
   const [logo, setLogo] = useState<string | null>("https://cdn.poehali.dev/files/f057e0f1-7582-451c-9ab8-5032ba8a2f4d.jpg");
   const [signature, setSignature] = useState<string | null>(null);
+  // Asset IDs only exist on the instance that stored them, so links keep the inline image
+  const assetIds = useRef<Record<string, string>>({});
   const [openDialog, setOpenDialog] = useState<string | null>(null);
   const [loanFormData, setLoanFormData] = useState<LoanFormData>({
     fullName: '',
@@ -132,12 +144,16 @@ const Index = () => {
       url += `&fullName=${encodeURIComponent(contactFormData.fullName)}`;
     }
     
-    if (logo) {
-      url += `&logo=${encodeURIComponent(logo)}`;
-    }
-    if (signature) {
-      url += `&signature=${encodeURIComponent(signature)}`;
-    }
+    const withImages = (useAssets: boolean) => {
+      let finalUrl = url;
+      if (logo) {
+        finalUrl += `&logo=${encodeURIComponent((useAssets && assetIds.current[logo]) || logo)}`;
+      }
+      if (signature) {
+        finalUrl += `&signature=${encodeURIComponent((useAssets && assetIds.current[signature]) || signature)}`;
+      }
+      return finalUrl;
+    };
 
     setOpenDialog(null);
     toast({
@@ -145,7 +161,8 @@ const Index = () => {
       description: "Пожалуйста, подождите"
     });
 
-    fetch(url)
+    fetch(withImages(true))
+      .then(response => (response.status === 404 ? fetch(withImages(false)) : response))
       .then(response => response.blob())
       .then(blob => {
         const blobUrl = window.URL.createObjectURL(blob);
@@ -176,11 +193,17 @@ const Index = () => {
     if (file) {
       const reader = new FileReader();
       reader.onloadend = () => {
-        setLogo(reader.result as string);
+        const dataUrl = reader.result as string;
+        setLogo(dataUrl);
         toast({
           title: "Логотип загружен",
           description: "Логотип будет добавлен в документы",
         });
+        uploadAsset(dataUrl).then(assetId => {
+          if (assetId) {
+            assetIds.current[dataUrl] = assetId;
+          }
+        });
       };
       reader.readAsDataURL(file);
     }
@@ -191,11 +214,17 @@ const Index = () => {
     if (file) {
       const reader = new FileReader();
       reader.onloadend = () => {
-        setSignature(reader.result as string);
+        const dataUrl = reader.result as string;
+        setSignature(dataUrl);
         toast({
           title: "Подпись загружена",
           description: "Подпись будет добавлена в документы",
         });
+        uploadAsset(dataUrl).then(assetId => {
+          if (assetId) {
+            assetIds.current[dataUrl] = assetId;
+          }
+        });
       };
       reader.readAsDataURL(file);
     }